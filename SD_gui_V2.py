@@ -1,9 +1,18 @@
+from desicurer.startup import PROFILE  # First, so the profile covers every import below
+import os
+import sys
 import tkinter as tk
 from tkinter import messagebox, font as tkfont, ttk  # Use ttk for modern widgets
-import serial
-import serial.tools.list_ports
-import time
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from desicurer.discovery import DeviceCache, PortWatcher
+from desicurer.dispatch import UiDispatcher
+from desicurer.journal import RunJournal, abandon, find_unfinished, resume_steps
+# pyserial, asyncio and the protocol runner are imported where first used, after the window is up
+PROFILE.mark("imports")
+
+TELEMETRY_INTERVAL = 100  # ms between device state samples
+TIMELINE_REFRESH = 500  # ms between timeline redraws
+PROTOCOL_LABELS = {"step1": "Step 1", "step2": "Step 2"}
 
 class App:
     def __init__(self, master):
@@ -11,12 +20,23 @@ class App:
         master.title("Control Protocol")
         master.attributes('-fullscreen', True)  # Make the window fullscreen
 
+        # Worker threads hand UI updates to the main loop through this queue
+        self.ui = UiDispatcher(master)
+        self.ui.start()
+
         # Initialize serial connection variables
-        self.ser = None
+        self.link = None  # SerialLink to the Arduino
         self.is_connected = False
+        self.connecting = False  # A connection attempt is running in the background
+        self.port_infos = {}  # device -> PortInfo from the latest scan
+        self.known_devices = DeviceCache()  # Which adapters have been desicurers before
+        self.first_scan = True  # The startup profile ends with the first scan's connection
+        self.pending_resume = None  # Interrupted run to resume once connected
 
         # Thread control variables
         self.protocol_thread = None
+        self.launch_lock = Lock()  # The hardware button can start a protocol from the link's reader
+        self.step2_armed = False  # Step 1 has completed, so the hardware button may start Step 2
         self.pause_event = Event()
         self.stop_event = Event()
 
@@ -45,9 +65,6 @@ class App:
 
         self.port_var = tk.StringVar()
         self.port_dropdown = ttk.Combobox(port_frame, textvariable=self.port_var, state="readonly", font=self.button_font)
-        self.port_dropdown['values'] = self.get_serial_ports()
-        if self.port_dropdown['values']:
-            self.port_dropdown.current(0)
         self.port_dropdown.pack(side=tk.LEFT, padx=10)
 
         refresh_button = tk.Button(port_frame, text="Refresh", command=self.refresh_ports, font=40, bg='blue', fg='white', relief='ridge')
@@ -81,153 +98,291 @@ class App:
                                    font=self.button_font, bg='red', fg='white', height=1, width=7, relief='ridge')
         self.close_btn.place(relx=0.5, rely=0.85, anchor='center')
 
+        # Emergency stop: motor and LED off at once
+        self.stop_btn = tk.Button(master, text="Stop", command=self.stop_protocol, font=self.button_font, bg='darkred', fg='white', height=1, width=7, relief='ridge')
+        self.stop_btn.place(relx=0.7, rely=0.85, anchor='center')
+
         # Status label
-        self.status = tk.Label(master, text="Select COM port and connect.", fg="black", font=self.button_font)
+        self.status = tk.Label(master, text="Looking for the desicurer...", fg="black", font=self.button_font)
         self.status.pack(pady=0)
 
-        # Automatically try to connect to the first available COM port
-        self.auto_connect()
+        # Live motor (top) and LED (bottom) timeline from device telemetry
+        self.telemetry = None  # TelemetryBuffer once the device streams samples
+        self.timeline = tk.Canvas(master, height=100, bg='black', highlightthickness=0)
+        self.timeline.place(relx=0.5, rely=0.74, relwidth=0.8, anchor='center')
+        self.motor_line = self.timeline.create_line(0, 0, 0, 0, fill='#32CD32', width=2)
+        self.led_line = self.timeline.create_line(0, 0, 0, 0, fill='yellow', width=2)
+
+        # Scans for ports in the background once start_background() is called
+        self.watcher = PortWatcher(self.ports_scanned)
+
+    def start_background(self):
+        """Start port discovery and auto-connect; called once the first frame is on screen"""
+        self.watcher.start()
+        self.master.after(TIMELINE_REFRESH, self.draw_timeline)
+        self.offer_resume()
+
+    def offer_resume(self):
+        """Offer to finish a run that was cut short by a crash or power loss"""
+        run = find_unfinished()
+        if run is None:
+            return
+        label = PROTOCOL_LABELS.get(run.protocol, run.protocol or "A protocol")
+        left = resume_steps(run)[0][1]
+        if messagebox.askyesno("Resume Protocol", f"{label} was interrupted at step {run.index + 1} of {len(run.steps)} "
+                               f"with {left} s left in that step.\nResume it when the device is connected?"):
+            self.pending_resume = run
+            if self.is_connected:
+                self.resume_interrupted()
+        else:
+            abandon(run)
 
-    def get_serial_ports(self):
-        """Returns a list of available serial ports"""
-        ports = serial.tools.list_ports.comports()
-        return [port.device for port in ports]
+    def resume_interrupted(self):
+        """Run what was left of the interrupted protocol"""
+        from desicurer.plans import compile_steps
+        run, self.pending_resume = self.pending_resume, None
+        if self.protocol_thread and self.protocol_thread.is_alive():
+            return
+        abandon(run)  # The resumed run keeps its own journal from here on
+        label = PROTOCOL_LABELS.get(run.protocol, run.protocol or "Protocol")
+        self.launch(compile_steps(resume_steps(run), run.protocol), f"{label} (resumed)", run.protocol)
+
+    def draw_timeline(self):
+        """Redraw the timeline from a decimated view, so the cost stays flat however long the run"""
+        buffer = self.telemetry
+        width = self.timeline.winfo_width()
+        if buffer is not None and len(buffer) > 1 and width > 1:
+            time, motor, led = buffer.decimated(width)
+            span = max(time[-1] - time[0], 1e-9)
+            xs = (time - time[0]) * ((width - 1) / span)
+            for item, values, top in ((self.motor_line, motor, 5), (self.led_line, led, 55)):
+                ys = top + 40 - values * (40 / 255)
+                points = [value for pair in zip(xs.tolist(), ys.tolist()) for value in pair]
+                self.timeline.coords(item, *points)
+        self.master.after(TIMELINE_REFRESH, self.draw_timeline)
+
+    def set_status(self, text):
+        """Show text in the status label; safe to call from any thread"""
+        self.ui.post(self.status.config, key="status", text=text)
 
     def refresh_ports(self):
         """Refresh the list of available COM ports"""
-        ports = self.get_serial_ports()
-        self.port_dropdown['values'] = ports
-        if ports:
-            self.port_dropdown.current(0)
-        self.status.config(text="COM ports refreshed.")
-
-    def auto_connect(self):
-        """Attempt to auto-connect to the first available COM port"""
-        ports = self.get_serial_ports()
-        if len(ports) == 1:
-            self.connect_serial(auto_connect=True)
+        self.watcher.rescan()
+        self.set_status("Refreshing COM ports...")
+
+    def ports_scanned(self, ports, added, removed):
+        """Called on the watcher thread whenever the set of ports changes"""
+        self.ui.post(self.ports_changed, ports, key="ports")
+
+    def ports_changed(self, ports):
+        """Update the port list, notice an unplugged device and connect to a returning one"""
+        self.port_infos = {port.device: port for port in ports}
+        devices = [port.device for port in ports]
+        self.port_dropdown['values'] = devices
+        if self.port_var.get() not in devices:
+            self.port_var.set(devices[0] if devices else "")
+        if self.is_connected and self.link.port not in self.port_infos:
+            self.connection_lost()
+        if self.first_scan:
+            PROFILE.mark("port scan")
+            self.first_scan = False
+        if self.is_connected or self.connecting:
+            return
+        known = self.known_devices.known(ports)
+        if known:
+            self.connect_in_background(known[0].device)  # The desicurer used last time
+            return
+        if len(devices) == 1:
+            self.connect_in_background(devices[0])  # Auto-select the only available port
+            return
+        if devices:
+            self.set_status("Please select a COM port to connect.")
         else:
-            self.status.config(text="Please select a COM port to connect.")
+            self.set_status("Waiting for the desicurer to be plugged in...")
+        PROFILE.finish()  # Nothing to auto-connect to
 
-    def connect_serial(self, auto_connect=False):
-        """Establish serial connection based on user selection or automatically"""
+    def connect_serial(self):
+        """Establish serial connection to the selected port"""
         if self.is_connected:
             messagebox.showinfo("Already Connected", "Serial connection is already established.")
             return
-        
-        if auto_connect:
-            ports = self.get_serial_ports()
-            if len(ports) == 1:
-                selected_port = ports[0]  # Auto-select the only available port
-                self.port_var.set(selected_port)
-            else:
-                messagebox.showwarning("Multiple Ports", "Multiple COM ports found. Please select one.")
-                return
-        else:
-            selected_port = self.port_var.get()
-
+        selected_port = self.port_var.get()
         if not selected_port:
             messagebox.showwarning("No Port Selected", "Please select a COM port to connect.")
             return
-        
+        self.connect_in_background(selected_port, manual=True)
+
+    def connect_in_background(self, port, manual=False):
+        """Open port on a worker thread so the window stays responsive while the Arduino resets"""
+        if self.connecting:
+            return
+        self.connecting = True
+        self.port_var.set(port)
+        self.set_status(f"Connecting to {port}...")
+        Thread(target=self.connect_worker, args=(port, manual), daemon=True).start()
+
+    def connect_worker(self, port, manual):
+        """Runs on a worker thread; hands the result back through self.ui"""
+        import serial
+        from desicurer.link import SerialLink
+        link = SerialLink(port, 9600)
         try:
-            self.ser = serial.Serial(selected_port, 9600, timeout=1)
-            time.sleep(2)  # Wait for the connection to establish
-            self.is_connected = True
-            self.status.config(text=f"Connected to {selected_port}.")
-            messagebox.showinfo("Connected", f"Successfully connected to {selected_port}.")
-        except serial.SerialException as e:
-            messagebox.showerror("Connection Error", f"Failed to connect to {selected_port}.\nError: {e}")
-            self.status.config(text="Connection failed.")
+            link.connect()  # Returns on the firmware's READY, or after the reset wait
+        except (serial.SerialException, OSError) as e:
+            self.ui.post(self.connect_failed, port, e, manual)
+            return
+        self.telemetry = link.start_telemetry(TELEMETRY_INTERVAL)  # None on firmware without telemetry
+        link.subscribe("CONTINUE", self.button_pressed)
+        self.ui.post(self.connected, link, manual)
+
+    def connected(self, link, manual):
+        """Handle a finished connection attempt"""
+        self.connecting = False
+        self.link = link
+        self.is_connected = True
+        self.step2_armed = False  # Maybe another device, or a fresh sample
+        if link.port in self.port_infos:
+            self.known_devices.remember(self.port_infos[link.port])  # Reconnect to it next time
+        self.set_status(f"Connected to {link.port}.")
+        PROFILE.mark("auto-connect")
+        PROFILE.finish()
+        if manual:
+            messagebox.showinfo("Connected", f"Successfully connected to {link.port}.")
+        if self.pending_resume:
+            self.resume_interrupted()
+
+    def connect_failed(self, port, error, manual):
+        """Handle a failed connection attempt"""
+        self.connecting = False
+        self.set_status("Connection failed.")
+        PROFILE.finish()
+        if manual:
+            messagebox.showerror("Connection Error", f"Failed to connect to {port}.\nError: {error}")
+
+    def connection_lost(self):
+        """The connected device was unplugged; wait for it to come back"""
+        link, self.link = self.link, None
+        self.is_connected = False
+        self.stop_event.set()
+        link.close()  # Also stops a running protocol
+        self.step1_btn.config(state=tk.NORMAL)
+        self.step2_btn.config(state=tk.NORMAL)
+        self.set_status("Device unplugged. Waiting for it to come back...")
 
     def send_command(self, movement, motor_duration, led_duration):
         """Send command to Arduino"""
+        import serial
         if not self.is_connected:
-            self.status.config(text="Not connected to any COM port.")
+            self.set_status("Not connected to any COM port.")
             return
-        command = f"{movement} {motor_duration} LED {led_duration}"
         try:
-            self.ser.write((command + '\n').encode())
-            self.status.config(text=f"Command sent: {command}")
+            command = self.link.send_command(movement, motor_duration, led_duration)
+            self.set_status(f"Command sent: {command}")
         except serial.SerialException as e:
-            self.status.config(text="Failed to send command.")
+            self.set_status("Failed to send command.")
             messagebox.showerror("Serial Error", f"Failed to send command.\nError: {e}")
 
-    def protocol_steps(self, steps):
-        """Execute a list of protocol steps"""
-        for step in steps:
-            if self.stop_event.is_set():
-                self.status.config(text="Protocol stopped.")
-                return
-            while self.pause_event.is_set():
-                time.sleep(0.5)  # Wait while paused
-            movement, motor_duration, led_duration = step
-            self.send_command(movement, motor_duration, led_duration)
-            time.sleep(motor_duration + 0.1)  # Wait for the duration plus a small buffer
-        
-        self.protocol_finished()  # Enable buttons once the protocol is finished
+    def protocol_steps(self, steps, name=None):
+        """Execute a list of protocol steps (runs on a worker thread, so Tk is only touched through self.ui)"""
+        import serial
+        from desicurer.framing import FrameError
+        from desicurer.runner import StepError
+        completed = False
+        try:
+            completed = self.link.run_steps(steps, on_step=self.step_sent, journal=RunJournal())
+        except serial.SerialException as e:
+            self.set_status("Failed to send command.")
+            self.ui.post(messagebox.showerror, "Serial Error", f"Failed to send command.\nError: {e}")
+        except StepError as e:
+            self.set_status("Step not confirmed by device.")
+            self.ui.post(messagebox.showerror, "Device Error", str(e))
+        except (ConnectionError, FrameError) as e:  # Port closed under the run, or a step the binary codec can't carry
+            self.set_status("Failed to send command.")
+            self.ui.post(messagebox.showerror, "Serial Error", f"Failed to send command.\nError: {e}")
+        finally:
+            self.ui.post(self.protocol_ended)  # However the run ended, the buttons come back
+        if completed and name == "step1":
+            self.step2_armed = True
+        if completed:
+            self.set_status("Step Completed")
+        elif self.stop_event.is_set():
+            self.set_status("Protocol stopped.")
+
+    def step_sent(self, index, command):
+        """Report a step the protocol runner has just sent"""
+        self.set_status(f"Command sent: {command}")
+
+    def load_steps(self, name):
+        """Returns the compiled protocol from protocols.json (or the built-in one), or None if it is invalid"""
+        from desicurer.protocols import ProtocolError, get_protocol
+        try:
+            return get_protocol(name)
+        except ProtocolError as e:
+            messagebox.showerror("Protocol Error", f"Could not load protocol '{name}'.\nError: {e}")
+            return None
 
     def start_protocol(self):
         """Start Step 1 protocol"""
-        if not self.is_connected:
-            messagebox.showwarning("Not Connected", "Please connect to a COM port first.")
-            return
-        if self.protocol_thread and self.protocol_thread.is_alive():
-            messagebox.showwarning("Protocol Running", "A protocol is already running.")
-            return
-        self.status.config(text="Starting Step 1 Protocol...")
-        # Define Step 1 steps
-        steps = [
-            ("FORWARD", 30, 0),
-            ("FORWARD", 30, 0),
-            ("FORWARD", 30, 0),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 0, 0)
-        ]
-        self.stop_event.clear()
-        self.pause_event.clear()
-        self.protocol_thread = Thread(target=self.protocol_steps, args=(steps,))
-        self.protocol_thread.start()
-        self.step1_btn.config(state=tk.DISABLED)
-        self.step2_btn.config(state=tk.DISABLED)
-        self.status.config(text="Step 1 Protocol running...")
+        self.run_protocol("step1")
 
     def continue_protocol(self):
         """Start Step 2 protocol"""
+        self.run_protocol("step2")
+
+    def run_protocol(self, name):
+        """Start a named protocol after checking the device is free"""
         if not self.is_connected:
             messagebox.showwarning("Not Connected", "Please connect to a COM port first.")
             return
         if self.protocol_thread and self.protocol_thread.is_alive():
             messagebox.showwarning("Protocol Running", "A protocol is already running.")
             return
-        self.status.config(text="Starting Step 2 Protocol...")
-        # Define Step 2 steps
-        steps = [
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 30),
-            ("FORWARD", 30, 0),
-            ("FORWARD", 30, 0),
-            ("FORWARD", 30, 0),
-            ("FORWARD", 0, 0)
-        ]
-        self.stop_event.clear()
-        self.pause_event.clear()
-        self.protocol_thread = Thread(target=self.protocol_steps, args=(steps,))
-        self.protocol_thread.start()
+        steps = self.load_steps(name)
+        if steps is None:
+            return
+        self.launch(steps, PROTOCOL_LABELS[name], name)
+
+    def launch(self, steps, label, name=None):
+        """Run steps on a worker thread; returns False if one is already running. Safe to call from any thread"""
+        with self.launch_lock:
+            if self.protocol_thread and self.protocol_thread.is_alive():
+                return False
+            self.step2_armed = False  # Only a completed Step 1 arms the button again
+            self.stop_event.clear()
+            self.pause_event.clear()
+            self.protocol_thread = Thread(target=self.protocol_steps, args=(steps, name))
+            self.ui.post(self.protocol_started)  # Before the run can post its own status, which must win
+            self.set_status(f"{label} Protocol running...")
+            self.protocol_thread.start()
+        return True
+
+    def protocol_started(self):
         self.step1_btn.config(state=tk.DISABLED)
         self.step2_btn.config(state=tk.DISABLED)
-        self.status.config(text="Step 2 Protocol running...")
+
+    def button_pressed(self, line):
+        """The hardware button sent CONTINUE; runs on the link's reader, so Step 2 starts without waiting for Tk
+
+        Only after Step 1 has completed, so a stray press or the line bouncing at boot never starts the motor.
+        """
+        if not self.step2_armed:
+            self.set_status("Button ignored: run Step 1 first.")
+            return
+        from desicurer.protocols import ProtocolError, get_protocol
+        try:
+            steps = get_protocol("step2")
+        except ProtocolError as e:
+            self.ui.post(messagebox.showerror, "Protocol Error", f"Could not load protocol 'step2'.\nError: {e}")
+            return
+        if not self.launch(steps, PROTOCOL_LABELS["step2"], "step2"):
+            self.set_status("Button ignored: a protocol is already running.")
 
     def pause_protocol(self):
         """Pause the running protocol"""
         if self.protocol_thread and self.protocol_thread.is_alive():
             self.pause_event.set()
-            self.status.config(text="Protocol paused (allow command to finish)")
+            self.link.pause()
+            self.set_status("Protocol paused.")
         else:
             messagebox.showinfo("No Protocol Running", "There is no protocol running to pause.")
 
@@ -235,13 +390,24 @@ class App:
         """Resume the paused protocol"""
         if self.protocol_thread and self.protocol_thread.is_alive() and self.pause_event.is_set():
             self.pause_event.clear()
-            self.status.config(text="Protocol resumed.")
+            self.link.resume()
+            self.set_status("Protocol resumed.")
         else:
             messagebox.showinfo("No Protocol Paused", "There is no protocol paused to resume.")
 
-    def protocol_finished(self):
-        """Handle the end of the protocol"""
-        self.status.config(text="Step Completed")
+    def stop_protocol(self):
+        """Abort the running protocol and switch the motor and LED off"""
+        if self.protocol_thread and self.protocol_thread.is_alive():
+            self.stop_event.set()
+            self.link.stop()  # Returns within a second, once ABORT is on its way
+            self.set_status("Protocol stopped.")
+            self.step1_btn.config(state=tk.NORMAL)
+            self.step2_btn.config(state=tk.NORMAL)
+        else:
+            messagebox.showinfo("No Protocol Running", "There is no protocol running to stop.")
+
+    def protocol_ended(self):
+        """Handle the end of the protocol, whether it completed, failed or was stopped"""
         self.step1_btn.config(state=tk.NORMAL)  # Re-enable Step 1 button
         self.step2_btn.config(state=tk.NORMAL)  # Re-enable Step 2 button
 
@@ -249,15 +415,30 @@ class App:
         """Handle application closing"""
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
             self.stop_event.set()  # Signal the thread to stop
+            if self.link:
+                self.link.stop()
             if self.protocol_thread and self.protocol_thread.is_alive():
-                self.protocol_thread.join()
-            if self.ser and self.ser.is_open:
-                self.ser.close()  # Close serial connection
+                self.protocol_thread.join(1)  # The run is cancelled already; never hang the UI on it
+            if self.link and self.link.is_open:
+                self.link.close()  # Close serial connection
+            self.watcher.stop()
+            self.ui.stop()
             self.master.destroy()
 
 # Run the application
 if __name__ == "__main__":
+    if "--profile-startup" in sys.argv:
+        os.environ.setdefault("DESICURER_STARTUP_PROFILE", "1")
     root = tk.Tk()
+    PROFILE.mark("tk init")
     app = App(root)
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
+    root.update()  # Draw the first frame before anything slow happens
+    PROFILE.mark("first paint")
+    try:
+        import pyi_splash  # Only present in a PyInstaller build with a splash screen
+        pyi_splash.close()
+    except ImportError:
+        pass
+    app.start_background()
     root.mainloop()
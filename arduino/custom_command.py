@@ -3,6 +3,14 @@ from tkinter import messagebox, ttk
 import serial
 import serial.tools.list_ports
 import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from desicurer.backends import open_port  # Goes through the broker, so this can run beside the GUI
+except ImportError:
+    open_port = serial.Serial
 
 class LEDControlApp:
     def __init__(self, master):
@@ -92,8 +100,9 @@ class LEDControlApp:
             return
 
         try:
-            self.ser = serial.Serial(selected_port, 9600, timeout=1)
-            time.sleep(2)  # Wait for the connection to establish
+            self.ser = open_port(selected_port, 9600, timeout=1)
+            if "://" not in self.ser.port:
+                time.sleep(2)  # Wait for the connection to establish
             self.is_connected = True
             self.status.config(text=f"Connected to {selected_port}.")
             messagebox.showinfo("Connected", f"Successfully connected to {selected_port}.")
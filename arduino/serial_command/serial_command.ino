@@ -1,72 +1,597 @@
 int ledPin = 5; // PWM pin for the LED
 int motorDirectionPin = 12; // Motor direction pin (HIGH for one direction, LOW for reverse)
 int motorSpeedPin = 10; // PWM pin for motor speed control
+int buttonPin = 2; // Operator button to ground, read with the internal pull-up
 
 unsigned long startMillis; // Start time for motor actions
 unsigned long ledStartMillis; // Start time for LED actions
-int duration; // Duration for motor action
-int ledDuration; // Duration for LED action
+unsigned long duration; // Duration for motor action (an int overflows past 32 s)
+unsigned long ledDuration; // Duration for LED action
 bool motorRunning = false; // State of the motor
 bool ledOn = false; // State of the LED
+byte motorPwm = 0; // Last PWM value written to the motor
+byte ledPwm = 0; // Last PWM value written to the LED
+bool buttonDown = false; // Debounced button state
+unsigned long buttonMillis = 0; // When the debounced state last changed
+const unsigned long DEBOUNCE_MS = 30; // Contact bounce after an edge is ignored for this long
+
+// Uploaded protocol: "PLAN <n>" followed by n step lines, then "RUN"
+const int MAX_PLAN_STEPS = 32; // Size of the step table
+struct PlanStep {
+  bool direction;
+  unsigned int motorSeconds;
+  unsigned int ledSeconds;
+};
+PlanStep plan[MAX_PLAN_STEPS];
+int planLength = 0; // Steps stored in the table
+int planLoading = 0; // Step lines still expected after PLAN <n>
+int planStep = -1; // Step being executed, -1 when no plan is running
+
+// PAUSE freezes both timers mid-step; RESUME runs out exactly what was left
+bool paused = false;
+bool motorHeld = false; // Motor was running when paused
+bool ledHeld = false; // LED was on when paused
+unsigned long motorRemaining; // ms of the motor timer left at PAUSE
+unsigned long ledRemaining; // ms of the LED timer left at PAUSE
+
+// Binary framing, entered with "BAUD <rate>" (see desicurer/framing.py): every frame is
+// a fixed-size payload plus CRC-16/CCITT-FALSE, COBS-encoded and ended by a zero byte.
+// Commands are opcode, direction/count, motor seconds, LED seconds (6 bytes);
+// events are event, code, value (4 bytes).
+const byte OP_STEP = 0x01;
+const byte OP_PLAN = 0x02;
+const byte OP_RUN = 0x03;
+const byte OP_PAUSE = 0x04;
+const byte OP_RESUME = 0x05;
+const byte OP_ABORT = 0x06;
+const byte OP_PING = 0x07;
+const byte OP_TELEMETRY = 0x08;
+
+const byte EV_ACK = 0x81;
+const byte EV_DONE = 0x82;
+const byte EV_ERR = 0x83;
+const byte EV_STEP = 0x84;
+const byte EV_PLAN_DONE = 0x85;
+const byte EV_CONTINUE = 0x86;
+const byte EV_PLANNED = 0x87;
+const byte EV_PAUSED = 0x88;
+const byte EV_RESUMED = 0x89;
+const byte EV_ABORTED = 0x8A;
+const byte EV_PONG = 0x8B;
+const byte EV_TELEMETRY = 0x8C;
+
+const byte DONE_MOTOR = 0;
+const byte DONE_LED = 1;
+const byte ERR_NONE = 0;
+const byte ERR_BUSY = 1;
+const byte ERR_PLAN = 2;
+const byte ERR_RUN = 3;
+const byte ERR_CRC = 4;
+const byte ERR_FRAME = 5;
+const char *errorText[] = {"ERR", "ERR BUSY", "ERR PLAN", "ERR RUN", "ERR CRC", "ERR FRAME"};
+
+const byte COMMAND_SIZE = 6;
+const byte EVENT_SIZE = 4;
+const byte PAUSED_SIZE = 10; // PAUSED carries both remaining times as unsigned longs
+const byte TELEMETRY_SIZE = 10;
+
+// Telemetry: "TELEMETRY <ms>" streams a state sample every <ms>, 0 turns it off
+const byte FLAG_MOTOR = 1;
+const byte FLAG_LED = 2;
+const byte FLAG_FORWARD = 4;
+const byte FLAG_PAUSED = 8;
+unsigned int telemetryInterval = 0;
+unsigned long telemetryMillis; // When the last sample was sent
+const byte FRAME_MAX = 16; // Encoded frame buffer; a command frame is 9 bytes
+const long baudRates[] = {115200, 230400, 250000, 500000, 1000000};
+const unsigned long BAUD_TIMEOUT = 1000; // Fall back to 9600 baud text if no PING arrives
+
+bool binaryMode = false; // Speaking frames instead of text lines
+bool baudPending = false; // New baud rate not yet confirmed by a PING
+unsigned long baudMillis; // When the baud rate was switched
+byte frame[FRAME_MAX]; // Frame being received, decoded in place
+byte frameLength = 0;
 
 void setup() {
   pinMode(ledPin, OUTPUT);
   pinMode(motorDirectionPin, OUTPUT);
   pinMode(motorSpeedPin, OUTPUT);
+  pinMode(buttonPin, INPUT_PULLUP);
   Serial.begin(9600);
+  Serial.println("READY"); // Lets the host skip its fixed reset wait
 }
 
 void loop() {
-  if (Serial.available() > 0) {
+  if (binaryMode) {
+    readFrames();
+  } else if (Serial.available() > 0) {
     String command = Serial.readStringUntil('\n');
     command.trim();
+    handleCommand(command);
+  }
 
-    // Handling motor commands
-    if (command.startsWith("FORWARD ")) {
-      int index = command.indexOf(" LED ");
-      duration = command.substring(8, index).toInt() * 1000; // Convert to milliseconds
-      startMotor(HIGH);
-      ledDuration = command.substring(index + 5).toInt() * 1000; // Extract LED duration
-      startLED();
-    } else if (command.startsWith("BACKWARD ")) {
-      int index = command.indexOf(" LED ");
-      duration = command.substring(9, index).toInt() * 1000; // Convert to milliseconds
-      startMotor(LOW);
-      ledDuration = command.substring(index + 5).toInt() * 1000; // Extract LED duration
-      startLED();
-    }
+  // Nobody reached us at the new baud rate: go back to text
+  if (baudPending && millis() - baudMillis > BAUD_TIMEOUT) {
+    Serial.end();
+    Serial.begin(9600);
+    binaryMode = false;
+    baudPending = false;
+  }
+
+  if (telemetryInterval > 0 && millis() - telemetryMillis >= telemetryInterval) {
+    telemetryMillis += telemetryInterval; // Keep the sample clock from drifting
+    reportTelemetry();
   }
 
   // Check to stop motor after duration
   if (motorRunning && millis() - startMillis > duration) {
-    stopMotor();
+    if (planStep >= 0) {
+      startMillis += duration; // Next step starts where this one was due to end
+      nextPlanStep();
+    } else {
+      stopMotor();
+      report(EV_DONE, DONE_MOTOR, 0); // Motor timer expired
+    }
   }
 
   // Check to turn off LED after duration
   if (ledOn && millis() - ledStartMillis > ledDuration) {
     stopLED();
+    report(EV_DONE, DONE_LED, 0); // LED timer expired
+  }
+
+  checkButton();
+}
+
+// Report CONTINUE once per press, on the first edge so the host hears it at once.
+// Unlike a delay() debounce this never holds up the timers, and holding the
+// button down does not repeat it.
+void checkButton() {
+  bool down = digitalRead(buttonPin) == LOW;
+  if (down != buttonDown && millis() - buttonMillis >= DEBOUNCE_MS) {
+    buttonDown = down;
+    buttonMillis = millis();
+    if (down) {
+      report(EV_CONTINUE, 0, 0);
+    }
+  }
+}
+
+void handleCommand(String command) {
+  bool direction;
+  unsigned long motorSeconds;
+  unsigned long ledSeconds;
+
+  if (parseStep(command, direction, motorSeconds, ledSeconds)) {
+    runStep(direction, motorSeconds, ledSeconds);
+  } else if (command.startsWith("PLAN ")) {
+    beginPlan(command.substring(5).toInt());
+  } else if (command == "RUN") {
+    runPlan();
+  } else if (command == "PAUSE") {
+    pauseTimers();
+  } else if (command == "RESUME") {
+    resumeTimers();
+  } else if (command == "ABORT" || command == "STOP") {
+    abortPlan(); // Also the emergency stop: motor and LED off at once
+  } else if (command.startsWith("TELEMETRY ")) {
+    startTelemetry(command.substring(10).toInt());
+  } else if (command == "PING") {
+    report(EV_PONG, 0, 0);
+  } else if (command.startsWith("BAUD ")) {
+    switchBaud(command.substring(5).toInt());
+  } else if (command.length() > 0) {
+    planLoading = 0; // A bad line ends an upload
+    report(EV_ERR, ERR_NONE, 0); // Unknown or malformed command
+  }
+}
+
+// Parse "FORWARD <motor> LED <led>" or "BACKWARD <motor> LED <led>"
+bool parseStep(String command, bool &direction, unsigned long &motorSeconds, unsigned long &ledSeconds) {
+  int index = command.indexOf(" LED ");
+  int start;
+  if (index == -1) {
+    return false;
+  } else if (command.startsWith("FORWARD ")) {
+    direction = HIGH;
+    start = 8;
+  } else if (command.startsWith("BACKWARD ")) {
+    direction = LOW;
+    start = 9;
+  } else {
+    return false;
   }
+  motorSeconds = command.substring(start, index).toInt();
+  ledSeconds = command.substring(index + 5).toInt(); // Extract LED duration
+  return true;
+}
+
+// -- Actions, shared by the text and binary protocols --
+
+void runStep(bool direction, unsigned long motorSeconds, unsigned long ledSeconds) {
+  if (planLoading > 0) {
+    // Store the step instead of running it
+    plan[planLength].direction = direction;
+    plan[planLength].motorSeconds = motorSeconds;
+    plan[planLength].ledSeconds = ledSeconds;
+    planLength++;
+    planLoading--;
+    if (planLoading == 0) {
+      report(EV_PLANNED, 0, planLength);
+    }
+  } else if (planStep >= 0) {
+    report(EV_ERR, ERR_BUSY, 0); // A plan owns the motor
+  } else {
+    duration = motorSeconds * 1000UL; // Convert to milliseconds
+    ledDuration = ledSeconds * 1000UL;
+    paused = false; // A new step replaces whatever was held
+    report(EV_ACK, OP_STEP, 0); // Tell the host the command was accepted
+    startMotor(direction);
+    startLED();
+  }
+}
+
+void beginPlan(int steps) {
+  if (planStep >= 0 || steps < 1 || steps > MAX_PLAN_STEPS) {
+    report(EV_ERR, ERR_PLAN, 0);
+  } else {
+    planLength = 0;
+    planLoading = steps;
+    report(EV_ACK, OP_PLAN, steps);
+  }
+}
+
+void runPlan() {
+  if (planLength == 0 || planLoading > 0 || planStep >= 0) {
+    report(EV_ERR, ERR_RUN, 0);
+  } else {
+    report(EV_ACK, OP_RUN, 0);
+    paused = false;
+    startMillis = millis();
+    nextPlanStep();
+  }
+}
+
+// Freeze the motor and LED where they are and report the time each has left
+void pauseTimers() {
+  if (!paused) {
+    unsigned long now = millis();
+    motorHeld = motorRunning;
+    ledHeld = ledOn;
+    motorRemaining = motorRunning ? remaining(startMillis, duration, now) : 0;
+    ledRemaining = ledOn ? remaining(ledStartMillis, ledDuration, now) : 0;
+    if (motorRunning) {
+      stopMotor();
+    }
+    if (ledOn) {
+      stopLED();
+    }
+    paused = true;
+  }
+  reportPaused(motorRemaining, ledRemaining);
+}
+
+// Restart whatever PAUSE froze, with only the time it had left
+void resumeTimers() {
+  if (paused) {
+    unsigned long now = millis();
+    paused = false;
+    if (motorHeld) {
+      setMotorPwm(255); // Direction pin still holds the step's direction
+      startMillis = now;
+      duration = motorRemaining; // A plan's next step starts where this runs out
+      motorRunning = true;
+    }
+    if (ledHeld) {
+      setLedPwm(255);
+      ledStartMillis = now;
+      ledDuration = ledRemaining;
+      ledOn = true;
+    }
+  }
+  report(EV_RESUMED, 0, 0);
+}
+
+unsigned long remaining(unsigned long start, unsigned long length, unsigned long now) {
+  unsigned long elapsed = now - start;
+  return elapsed < length ? length - elapsed : 0;
+}
+
+void abortPlan() {
+  stopMotor();
+  stopLED();
+  planStep = -1;
+  planLoading = 0;
+  paused = false;
+  report(EV_ABORTED, 0, 0);
+}
+
+void nextPlanStep() {
+  planStep++;
+  if (planStep >= planLength) {
+    stopMotor(); // The last step's LED runs out its own timer, as when steps are streamed
+    planStep = -1;
+    report(EV_PLAN_DONE, 0, 0);
+    return;
+  }
+  duration = plan[planStep].motorSeconds * 1000UL;
+  ledDuration = plan[planStep].ledSeconds * 1000UL;
+  digitalWrite(motorDirectionPin, plan[planStep].direction);
+  setMotorPwm(255);
+  motorRunning = true;
+  setLedPwm(255);
+  ledStartMillis = startMillis; // LED shares the step's start time
+  ledOn = true;
+  report(EV_STEP, 0, planStep);
 }
 
 void startMotor(bool direction) {
   digitalWrite(motorDirectionPin, direction); // Set direction based on HIGH or LOW
-  analogWrite(motorSpeedPin, 255); // Set motor speed to maximum
+  setMotorPwm(255); // Set motor speed to maximum
   startMillis = millis(); // Record start time
   motorRunning = true; // Set motor state to running
 }
 
 void stopMotor() {
-  analogWrite(motorSpeedPin, 0); // Stop the motor
+  setMotorPwm(0); // Stop the motor
   motorRunning = false; // Set motor state to not running
 }
 
 void startLED() {
-  analogWrite(ledPin, 255); // Turn LED on to full brightness
+  setLedPwm(255); // Turn LED on to full brightness
   ledStartMillis = millis(); // Record start time for LED
   ledOn = true; // Set LED state to on
 }
 
 void stopLED() {
-  analogWrite(ledPin, 0); // Turn LED off
+  setLedPwm(0); // Turn LED off
   ledOn = false; // Set LED state to off
 }
+
+void setMotorPwm(byte pwm) {
+  analogWrite(motorSpeedPin, pwm);
+  motorPwm = pwm;
+}
+
+void setLedPwm(byte pwm) {
+  analogWrite(ledPin, pwm);
+  ledPwm = pwm;
+}
+
+void startTelemetry(unsigned int interval) {
+  telemetryInterval = interval;
+  telemetryMillis = millis();
+  report(EV_ACK, OP_TELEMETRY, interval);
+}
+
+// -- Reporting --
+
+// Send one event to the host, as a text line or a binary frame
+void report(byte event, byte code, unsigned int value) {
+  if (binaryMode) {
+    byte payload[EVENT_SIZE + 2] = {event, code, (byte)(value >> 8), (byte)value};
+    unsigned int crc = crc16(payload, EVENT_SIZE);
+    payload[EVENT_SIZE] = crc >> 8;
+    payload[EVENT_SIZE + 1] = crc;
+    writeFrame(payload, EVENT_SIZE + 2);
+    return;
+  }
+  switch (event) {
+    case EV_ACK:
+      if (code == OP_PLAN) {
+        Serial.print("ACK PLAN ");
+        Serial.println(value);
+      } else if (code == OP_TELEMETRY) {
+        Serial.print("ACK TELEMETRY ");
+        Serial.println(value);
+      } else {
+        Serial.println(code == OP_RUN ? "ACK RUN" : "ACK");
+      }
+      break;
+    case EV_DONE:
+      Serial.println(code == DONE_LED ? "DONE LED" : "DONE MOTOR");
+      break;
+    case EV_ERR:
+      Serial.println(errorText[code]);
+      break;
+    case EV_STEP:
+      Serial.print("STEP ");
+      Serial.println(value);
+      break;
+    case EV_PLANNED:
+      Serial.print("PLANNED ");
+      Serial.println(value);
+      break;
+    case EV_PLAN_DONE:
+      Serial.println("PLAN DONE");
+      break;
+    case EV_CONTINUE:
+      Serial.println("CONTINUE");
+      break;
+    case EV_RESUMED:
+      Serial.println("RESUMED");
+      break;
+    case EV_ABORTED:
+      Serial.println("ABORTED");
+      break;
+    case EV_PONG:
+      Serial.println("PONG");
+      break;
+  }
+}
+
+// Report PAUSED <motor ms left> <LED ms left>
+void reportPaused(unsigned long motorLeft, unsigned long ledLeft) {
+  if (binaryMode) {
+    byte payload[PAUSED_SIZE + 2] = {EV_PAUSED, 0,
+                                     (byte)(motorLeft >> 24), (byte)(motorLeft >> 16), (byte)(motorLeft >> 8), (byte)motorLeft,
+                                     (byte)(ledLeft >> 24), (byte)(ledLeft >> 16), (byte)(ledLeft >> 8), (byte)ledLeft};
+    unsigned int crc = crc16(payload, PAUSED_SIZE);
+    payload[PAUSED_SIZE] = crc >> 8;
+    payload[PAUSED_SIZE + 1] = crc;
+    writeFrame(payload, PAUSED_SIZE + 2);
+    return;
+  }
+  Serial.print("PAUSED ");
+  Serial.print(motorLeft);
+  Serial.print(" ");
+  Serial.println(ledLeft);
+}
+
+// Report T <millis> <flags> <motor PWM> <LED PWM> <plan step>
+void reportTelemetry() {
+  unsigned long now = millis();
+  byte flags = (motorRunning ? FLAG_MOTOR : 0) | (ledOn ? FLAG_LED : 0) |
+               (digitalRead(motorDirectionPin) ? FLAG_FORWARD : 0) | (paused ? FLAG_PAUSED : 0);
+  if (binaryMode) {
+    byte payload[TELEMETRY_SIZE + 2] = {EV_TELEMETRY, flags,
+                                        (byte)(now >> 24), (byte)(now >> 16), (byte)(now >> 8), (byte)now,
+                                        motorPwm, ledPwm, (byte)planStep, 0};
+    unsigned int crc = crc16(payload, TELEMETRY_SIZE);
+    payload[TELEMETRY_SIZE] = crc >> 8;
+    payload[TELEMETRY_SIZE + 1] = crc;
+    writeFrame(payload, TELEMETRY_SIZE + 2);
+    return;
+  }
+  Serial.print("T ");
+  Serial.print(now);
+  Serial.print(" ");
+  Serial.print(flags);
+  Serial.print(" ");
+  Serial.print(motorPwm);
+  Serial.print(" ");
+  Serial.print(ledPwm);
+  Serial.print(" ");
+  Serial.println(planStep);
+}
+
+// -- Binary framing --
+
+void switchBaud(long baud) {
+  bool supported = false;
+  for (byte i = 0; i < sizeof(baudRates) / sizeof(baudRates[0]); i++) {
+    supported = supported || baudRates[i] == baud;
+  }
+  if (!supported) {
+    report(EV_ERR, ERR_NONE, 0);
+    return;
+  }
+  Serial.print("ACK BAUD ");
+  Serial.println(baud);
+  Serial.flush(); // Let the ACK leave at the old rate
+  Serial.end();
+  Serial.begin(baud);
+  binaryMode = true;
+  baudPending = true; // Until the host's PING shows it switched too
+  baudMillis = millis();
+  frameLength = 0;
+}
+
+void readFrames() {
+  while (Serial.available() > 0) {
+    byte b = Serial.read();
+    if (b != 0) {
+      if (frameLength < FRAME_MAX) {
+        frame[frameLength] = b;
+      }
+      if (frameLength < 255) {
+        frameLength++; // Keep counting so an oversized frame is rejected whole
+      }
+    } else if (frameLength > 0) {
+      handleFrame();
+      frameLength = 0;
+    }
+  }
+}
+
+void handleFrame() {
+  byte length = frameLength > FRAME_MAX ? 0 : cobsDecode(frame, frameLength);
+  if (length != COMMAND_SIZE + 2 || crc16(frame, COMMAND_SIZE) != (((unsigned int)frame[6] << 8) | frame[7])) {
+    report(EV_ERR, ERR_CRC, 0);
+    return;
+  }
+  unsigned int motorSeconds = ((unsigned int)frame[2] << 8) | frame[3];
+  unsigned int ledSeconds = ((unsigned int)frame[4] << 8) | frame[5];
+  switch (frame[0]) {
+    case OP_STEP:
+      runStep(frame[1] ? HIGH : LOW, motorSeconds, ledSeconds);
+      break;
+    case OP_PLAN:
+      beginPlan(frame[1]);
+      break;
+    case OP_RUN:
+      runPlan();
+      break;
+    case OP_PAUSE:
+      pauseTimers();
+      break;
+    case OP_RESUME:
+      resumeTimers();
+      break;
+    case OP_ABORT:
+      abortPlan();
+      break;
+    case OP_TELEMETRY:
+      startTelemetry(motorSeconds); // The rate travels in the motor field, in ms
+      break;
+    case OP_PING:
+      baudPending = false;
+      report(EV_PONG, 0, 0);
+      break;
+    default:
+      planLoading = 0;
+      report(EV_ERR, ERR_FRAME, 0);
+  }
+}
+
+// Decode a COBS block in place; returns the decoded length, or 0 if it is malformed
+byte cobsDecode(byte *data, byte length) {
+  byte read = 0;
+  byte write = 0;
+  while (read < length) {
+    byte code = data[read];
+    if (code == 0 || read + code > length) {
+      return 0;
+    }
+    read++;
+    for (byte i = 1; i < code; i++) {
+      data[write++] = data[read++];
+    }
+    if (code < 0xFF && read < length) {
+      data[write++] = 0;
+    }
+  }
+  return write;
+}
+
+void writeFrame(const byte *data, byte length) {
+  byte out[FRAME_MAX];
+  byte codeAt = 0;
+  byte code = 1;
+  byte n = 1;
+  for (byte i = 0; i < length; i++) {
+    if (data[i] != 0) {
+      out[n++] = data[i];
+      code++;
+    } else {
+      out[codeAt] = code;
+      codeAt = n++;
+      code = 1;
+    }
+  }
+  out[codeAt] = code;
+  out[n++] = 0; // Frame delimiter
+  Serial.write(out, n);
+}
+
+// CRC-16/CCITT-FALSE, bit by bit to keep the table out of RAM
+unsigned int crc16(const byte *data, byte length) {
+  unsigned int crc = 0xFFFF;
+  for (byte i = 0; i < length; i++) {
+    crc ^= (unsigned int)data[i] << 8;
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
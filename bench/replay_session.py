@@ -0,0 +1,105 @@
+"""Record a half-hour session against a virtual desicurer and replay it as a regression test
+
+The session runs Step 1 uploaded, the CONTINUE button starting Step 2, Step 2
+streamed with a pause in it and telemetry throughout, four times over, on a
+device running --scale times faster than real time. The capture is then
+replayed as fast as possible through the transport, the runner and event
+dispatch. Exits with status 1 if the replay diverges from the capture or takes
+longer than --limit seconds. Pass --capture to replay an existing capture
+instead, such as one recorded in the field with DESICURER_CAPTURE set, and
+--repeat to go round several times, since no two recordings are timed quite
+the same. POSIX only.
+
+    python bench/replay_session.py [--capture FILE] [--limit 1.0] [--repeat N]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from threading import Event, Thread
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from desicurer.capture import CAPTURE_ENV  # noqa: E402
+from desicurer.clock import ScaledClock  # noqa: E402
+from desicurer.link import SerialLink  # noqa: E402
+from desicurer.protocols import get_protocol  # noqa: E402
+from desicurer.replay import replay  # noqa: E402
+from desicurer.simulator import VirtualDesicurer  # noqa: E402
+
+SESSION = 30 * 60  # Seconds of device time to record
+TELEMETRY_INTERVAL = 100  # ms between telemetry samples, as the GUI asks for
+PAUSE = 20  # Seconds Step 2 is held in each cycle
+IDLE = 30  # Seconds between cycles, for the operator to swap samples
+
+
+def record(directory, scale):
+    """Record a session into directory; returns the capture file"""
+    os.environ[CAPTURE_ENV] = directory
+    clock = ScaledClock(scale)
+    step1, step2 = get_protocol("step1"), get_protocol("step2")
+    with VirtualDesicurer(scale) as device:
+        link = SerialLink(device.port, settle_time=0, clock=clock)
+        link.connect()
+        link.start_telemetry(TELEMETRY_INTERVAL)
+        started = clock.monotonic()
+        pressed = Event()
+        second = []
+
+        def continue_pressed(line):  # What the GUI does: start Step 2 from the reader
+            link.transport.uploads = False  # Stream Step 2, to cover both ways of running
+            second.append(Thread(target=link.run_steps, args=(step2,), daemon=True))
+            second[-1].start()
+            pressed.set()
+
+        link.subscribe("CONTINUE", continue_pressed)
+        while clock.monotonic() - started < SESSION:
+            link.transport.uploads = None
+            link.run_steps(step1)
+            pressed.clear()
+            device.press_button()
+            pressed.wait(5)
+            clock.sleep(step2.duration / 3)
+            link.pause()
+            clock.sleep(PAUSE)
+            link.resume()
+            second[-1].join(step2.duration * 2 / scale + 5)
+            clock.sleep(IDLE)
+        link.close()
+    del os.environ[CAPTURE_ENV]
+    (path,) = [os.path.join(directory, name) for name in os.listdir(directory)]
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--capture", help="replay this capture instead of recording one")
+    parser.add_argument("--scale", type=float, default=500, help="device speed-up while recording (default 500)")
+    parser.add_argument("--limit", type=float, default=1.0, help="longest the replay may take, in seconds (default 1)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="record (or replay) this many times; fails if any one does (default 1)")
+    args = parser.parse_args()
+    failed = 0
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            path = args.capture
+            if path is None:
+                started = time.perf_counter()
+                path = record(directory, args.scale)
+                print(f"recorded {os.path.getsize(path)} bytes in {time.perf_counter() - started:.1f} s")
+            report = replay(path)
+        ok = report["ok"] and report["elapsed"] <= args.limit
+        if args.repeat == 1 or not ok:
+            print(json.dumps(report, indent=2))
+        print(f"replayed {report['duration'] / 60:.1f} min in {report['elapsed']:.3f} s: {'ok' if ok else 'FAILED'}")
+        failed += not ok
+    if args.repeat > 1:
+        print(f"{args.repeat - failed} of {args.repeat} ok")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
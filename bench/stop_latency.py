@@ -0,0 +1,64 @@
+"""Emergency stop latency against a virtual desicurer
+
+Runs Step 1 on a simulated device behind a pseudo-terminal, stops it in the
+middle of a step and times stop(), the motor and LED going off, and close().
+Exits with status 1 if any run takes longer than --limit seconds. POSIX only.
+"""
+import argparse
+import os
+import sys
+import time
+from threading import Thread
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from desicurer.link import SerialLink  # noqa: E402
+from desicurer.protocols import STEP1  # noqa: E402
+from desicurer.simulator import VirtualDesicurer  # noqa: E402
+
+
+def measure(uploaded, delay):
+    """Returns (stop, dark, close) seconds for one run stopped after delay seconds"""
+    with VirtualDesicurer() as device:
+        link = SerialLink(device.port, settle_time=0)
+        link.connect()
+        link.transport.uploads = None if uploaded else False  # False forces streaming
+        worker = Thread(target=link.run_steps, args=(STEP1,), daemon=True)
+        worker.start()
+        time.sleep(delay)
+        firmware = device.firmware
+        if not (firmware.motor_running or firmware.led_on):
+            raise RuntimeError("device was not running when stopped")
+        started = time.perf_counter()
+        link.stop()
+        stopped = time.perf_counter()
+        while firmware.motor_running or firmware.led_on:
+            if time.perf_counter() - started > 5:
+                raise RuntimeError("device never stopped")
+            time.sleep(0.0005)
+        dark = time.perf_counter()
+        worker.join(5)
+        link.close()
+        closed = time.perf_counter()
+        return stopped - started, dark - started, closed - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--limit", type=float, default=1.0, help="seconds allowed for the whole stop and close")
+    args = parser.parse_args()
+    worst = 0
+    for uploaded in (True, False):
+        for run in range(args.runs):
+            stop, dark, close = measure(uploaded, 0.3 + 0.1 * run)
+            worst = max(worst, close, dark)
+            mode = "uploaded" if uploaded else "streamed"
+            print(f"{mode:<9} stop {stop * 1000:7.1f} ms  dark {dark * 1000:7.1f} ms  closed {close * 1000:7.1f} ms")
+    print(f"worst {worst * 1000:.1f} ms (limit {args.limit * 1000:.0f} ms)")
+    return 0 if worst <= args.limit else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
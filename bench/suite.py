@@ -0,0 +1,275 @@
+"""Benchmark suite against a virtual desicurer, saved as JSON to compare releases
+
+Measures command latency and throughput, per-step timing error, pause and stop
+latency, Tk event-loop latency while a protocol runs, and startup time. Results
+go to bench/results/<time>.json; pass --compare with an earlier file to flag
+regressions, which also makes the exit status 1. POSIX only.
+
+    python bench/suite.py [--quick] [--only NAME ...] [--compare bench/results/old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from threading import Thread
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from desicurer.clock import ScaledClock  # noqa: E402
+from desicurer.link import SerialLink  # noqa: E402
+from desicurer.protocols import STEP1, STEP2  # noqa: E402
+from desicurer.simulator import VirtualDesicurer  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+TOLERANCE = 0.25  # A metric regresses when it is this much worse than the baseline...
+FLOOR = 0.5  # ...and worse by more than this many ms, so noise on tiny numbers is ignored
+
+
+def summary(samples, scale=1000):
+    """Returns median, p95 and max of samples, times scale (seconds to ms by default)"""
+    ordered = sorted(samples)
+    return {
+        "median_ms": statistics.median(ordered) * scale,
+        "p95_ms": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * scale,
+        "max_ms": ordered[-1] * scale,
+        "n": len(ordered),
+    }
+
+
+def wait_until(condition, timeout=5):
+    """Spin until condition() is true; returns the time it became true"""
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError("timed out waiting for the device")
+        time.sleep(0.0001)
+    return time.perf_counter()
+
+
+def connected(scale=1):
+    device = VirtualDesicurer(scale).start()
+    link = SerialLink(device.port, settle_time=0, clock=ScaledClock(scale) if scale != 1 else None)
+    link.connect()
+    return device, link
+
+
+def bench_command(runs):
+    """Time from send_command() to the motor running, and back-to-back throughput"""
+    device, link = connected()
+    firmware = device.firmware
+    try:
+        latency = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            link.send_command("FORWARD", 60, 0)
+            latency.append(wait_until(lambda: firmware.motor_running) - started)
+            link.send("ABORT")
+            wait_until(lambda: not firmware.motor_running)
+        count = runs * 10
+        started = time.perf_counter()
+        for _ in range(count):
+            link.send_command("FORWARD", 60, 0)
+        elapsed = time.perf_counter() - started
+        link.send("ABORT")
+    finally:
+        link.close()
+        device.stop()
+    result = summary(latency)
+    result["throughput_per_s"] = count / elapsed
+    return result
+
+
+def bench_timing(scale):
+    """Planned vs. actual start of every step of Step 1 and Step 2, uploaded and streamed"""
+    result = {}
+    for upload in (True, False):
+        errors = []
+        for steps in (STEP1, STEP2):
+            device, link = connected(scale)
+            link.transport.uploads = None if upload else False  # False forces streaming
+            try:
+                link.run_steps(steps)
+                records = link.run.records
+            finally:
+                link.close()
+                device.stop()
+            errors.extend(abs(record.actual - record.planned) / scale for record in records)  # Wall seconds
+        mode = "uploaded" if upload else "streamed"
+        result[mode] = summary(errors)
+    return result
+
+
+def bench_pause_stop(runs):
+    """Time from pause() and stop() to the motor and LED going off"""
+    pause, stop = [], []
+    for _ in range(runs):
+        device, link = connected()
+        firmware = device.firmware
+        worker = Thread(target=link.run_steps, args=(STEP2,), daemon=True)
+        worker.start()
+        try:
+            wait_until(lambda: link.run is not None and link.run.uploaded and firmware.led_on)
+            started = time.perf_counter()
+            link.pause()
+            pause.append(wait_until(lambda: not (firmware.motor_running or firmware.led_on)) - started)
+            link.resume()
+            wait_until(lambda: firmware.motor_running)
+            started = time.perf_counter()
+            link.stop()
+            stop.append(wait_until(lambda: not (firmware.motor_running or firmware.led_on)) - started)
+            worker.join(5)
+        finally:
+            link.close()
+            device.stop()
+    return {"pause": summary(pause), "stop": summary(stop)}
+
+
+def bench_ui(seconds):
+    """Lateness of a 10 ms Tk timer while a protocol streams step updates through the dispatcher"""
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+    except Exception as e:  # No display
+        return {"skipped": str(e).splitlines()[0]}
+    from desicurer.dispatch import UiDispatcher
+    scale = 100
+    device, link = connected(scale)
+    ui = UiDispatcher(root)
+    ui.start()
+    label = tk.Label(root)
+    label.pack()
+    lateness = []
+    interval = 0.01
+    expected = [time.perf_counter() + interval]
+
+    def tick():
+        now = time.perf_counter()
+        lateness.append(max(now - expected[0], 0))
+        expected[0] = now + interval
+        root.after(int(interval * 1000), tick)
+
+    def on_step(index, command):
+        ui.post(label.config, text=command, key="status")
+
+    worker = Thread(target=link.run_steps, args=(STEP1 * 10, on_step), daemon=True)
+    root.after(int(interval * 1000), tick)
+    worker.start()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        root.update()
+        time.sleep(0.001)
+    link.close()
+    device.stop()
+    ui.stop()
+    root.destroy()
+    return summary(lateness)
+
+
+def bench_startup(runs):
+    """Wall time to start Python and import the CLI, the headless engine and the GUI module"""
+    commands = {
+        "interpreter": "pass",
+        "cli": "import desicurer.cli",
+        "engine": "import desicurer.engine",
+        "gui_module": "import SD_gui_V2",
+    }
+    result = {}
+    for name, code in commands.items():
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            done = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True)
+            samples.append(time.perf_counter() - started)
+            if done.returncode:
+                break
+        result[name] = summary(samples) if not done.returncode else {"skipped": done.stderr.decode().splitlines()[-1]}
+    return result
+
+
+def flatten(results, prefix=""):
+    """Returns {"a.b.c": number} for every number in nested results"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and key != "n":
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline):
+    """Returns a line for every metric that got worse than the baseline"""
+    old = flatten(baseline["results"])
+    regressions = []
+    for name, value in flatten(results).items():
+        if name not in old:
+            continue
+        before = old[name]
+        if name.endswith("_per_s"):  # Higher is better
+            worse = value < before * (1 - TOLERANCE)
+        else:
+            worse = value > before * (1 + TOLERANCE) and value - before > FLOOR
+        if worse:
+            regressions.append(f"{name}: {before:.2f} -> {value:.2f}")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="fewer runs, for a smoke test")
+    parser.add_argument("--only", nargs="+", help="run only these benchmarks")
+    parser.add_argument("--output", help="where to save the results (default bench/results/<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to check for regressions")
+    args = parser.parse_args()
+    runs = 5 if args.quick else 30
+    benchmarks = {
+        "command": lambda: bench_command(runs),
+        "timing": lambda: bench_timing(200 if args.quick else 50),
+        "pause_stop": lambda: bench_pause_stop(3 if args.quick else 10),
+        "ui": lambda: bench_ui(2 if args.quick else 10),
+        "startup": lambda: bench_startup(3 if args.quick else 10),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        started = time.perf_counter()
+        results[name] = benchmark()
+        print(f"{name:<12}{time.perf_counter() - started:6.1f} s  {json.dumps(results[name])}")
+    record = {
+        "time": time.time(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": results,
+    }
+    path = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+    print(f"saved {path}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
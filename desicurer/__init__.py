@@ -0,0 +1 @@
+"""Host-side control library for the spinning desicurer"""
@@ -0,0 +1,71 @@
+import os
+import socket
+import stat
+
+# Device backends. Every port the package opens is a pyserial port object, found by name:
+#   COM3, /dev/ttyACM0       the local serial port, through the broker when one is running
+#   socket://host:port       a raw TCP serial server (pyserial)
+#   rfc2217://host:port      a Telnet RFC 2217 serial server (pyserial)
+#   broker://COM3            always through the broker, failing if none is running
+# More schemes plug in the pyserial way, as a protocol_<scheme> module in a package
+# added to serial.protocol_handler_packages.
+
+BROKER_SCHEME = "broker://"
+BROKER_ENV = "DESICURER_BROKER"  # Broker address: a Unix socket path, or host:port
+BROKER_HOST = "127.0.0.1"  # Where there are no Unix sockets (Windows) the broker listens on TCP
+BROKER_PORT = 8766
+ATTACH_TIMEOUT = 10  # Seconds the broker may take to open a device for its first client
+
+
+def parse_address(text):
+    """Returns a Unix socket path, or (host, port) for text like localhost:8766"""
+    host, _, port = text.rpartition(":")
+    if host and port.isdigit() and os.sep not in text:
+        return host, int(port)
+    return text
+
+
+def broker_address():
+    """Returns where the broker listens, from $DESICURER_BROKER or the default for this platform"""
+    text = os.environ.get(BROKER_ENV)
+    if text:
+        return parse_address(text)
+    if hasattr(socket, "AF_UNIX"):
+        import tempfile  # Deferred: only needed to find the default path
+        return os.path.join(tempfile.gettempdir(), f"desicurer-broker-{os.getuid()}.sock")
+    return BROKER_HOST, BROKER_PORT
+
+
+def broker_running():
+    """True if plain port names should go through the broker
+
+    A default TCP address is never probed, since a refused connection can take a
+    second on Windows; set $DESICURER_BROKER there to use the broker.
+    """
+    address = broker_address()
+    if not isinstance(address, str):
+        return BROKER_ENV in os.environ
+    try:
+        return stat.S_ISSOCK(os.stat(address).st_mode)
+    except OSError:
+        return False
+
+
+def open_port(port, baudrate=9600, broker=True, **options):
+    """Returns an open pyserial port for a device name or URL; options go to pyserial
+
+    A plain name goes through a running broker unless broker is false, which the
+    broker itself uses to reach the hardware.
+    """
+    import serial  # Deferred so the package can be imported without pyserial
+    if __package__ not in serial.protocol_handler_packages:
+        serial.protocol_handler_packages.append(__package__)  # For broker://
+    if "://" in port:
+        return serial.serial_for_url(port, baudrate, **options)
+    if broker and broker_running():
+        from .protocol_broker import BrokerUnavailable
+        try:
+            return serial.serial_for_url(BROKER_SCHEME + port, baudrate, **options)
+        except BrokerUnavailable:
+            pass  # A socket left behind by a broker that is gone
+    return serial.Serial(port, baudrate, **options)
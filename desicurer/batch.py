@@ -0,0 +1,165 @@
+import itertools
+from collections import namedtuple
+
+from .clock import REAL_CLOCK
+
+# Operator actions
+LOAD = "load"  # Put a fresh sample in and start Step 1
+ROTATE = "rotate"  # Turn the sample over and start Step 2
+UNLOAD = "unload"  # Take the cured sample out
+KINDS = (LOAD, ROTATE, UNLOAD)
+
+# Station phases
+EMPTY = "empty"
+STEP1 = "step1"  # Running Step 1, then waiting for a rotation
+STEP2 = "step2"  # Running Step 2, then waiting to be unloaded
+
+NEXT_ACTION = {EMPTY: LOAD, STEP1: ROTATE, STEP2: UNLOAD}
+
+# One planned operator action, in seconds from the start of the batch
+Action = namedtuple("Action", "start end station sample kind")
+
+
+class Station:
+    __slots__ = ("name", "phase", "sample", "ready")
+
+    def __init__(self, name, phase=EMPTY, sample=None, ready=0.0):
+        self.name = name
+        self.phase = phase
+        self.sample = sample  # Number of the sample in the station, from 1
+        self.ready = ready  # When the station next needs the operator
+
+    def copy(self):
+        return Station(self.name, self.phase, self.sample, self.ready)
+
+
+class BatchScheduler:
+    """Plans when one operator loads, rotates and unloads samples on several stations
+
+    Every sample runs Step 1, waits for the operator to rotate it, runs Step 2
+    and waits to be unloaded. The operator can only do one thing at a time, so
+    the plan is the order of their actions; rotations never overlap because the
+    operator is never planned for two actions at once. The plan is the shortest
+    of a few dispatch rules simulated from the current state, and is simulated
+    again whenever done() or step_finished() reports what actually happened.
+    """
+
+    def __init__(self, samples, stations, step1, step2, load=30, rotate=20, unload=20, clock=None):
+        self.samples = samples
+        self.durations = {STEP1: step1, STEP2: step2}  # Seconds each protocol runs for
+        self.handling = {LOAD: load, ROTATE: rotate, UNLOAD: unload}  # Seconds of operator work per action
+        self.clock = clock or REAL_CLOCK
+        self.origin = self.clock.monotonic()
+        self.stations = [Station(name) for name in stations]
+        self.loaded = 0  # Samples put into a station so far
+        self.operator_free = 0.0
+        self.actions = []  # The current plan
+        self.makespan = 0.0  # When the last sample comes out, in the current plan
+        self.idle = 0.0  # Station time spent waiting for the operator, in the current plan
+        self.plan(0.0)
+
+    def now(self):
+        return self.clock.monotonic() - self.origin
+
+    def station(self, name):
+        for station in self.stations:
+            if station.name == name:
+                return station
+        raise KeyError(name)
+
+    def plan(self, now=None):
+        """Simulate the rest of the batch from now; returns the planned actions"""
+        now = self.now() if now is None else now
+        best = None
+        for order in itertools.permutations(KINDS):
+            for patient in (False, True):
+                actions, makespan, idle = self._simulate(now, order, patient)
+                if best is None or (makespan, idle) < best[1:]:
+                    best = (actions, makespan, idle)
+        self.actions, self.makespan, self.idle = best
+        return self.actions
+
+    def upcoming(self, count=None):
+        """Returns the next planned actions, soonest first"""
+        return self.actions[:count]
+
+    def done(self, name, kind, at=None):
+        """The operator finished an action on a station at time at; replans"""
+        at = self.now() if at is None else at
+        station = self.station(name)
+        if NEXT_ACTION[station.phase] != kind:
+            raise ValueError(f"{name} needs {NEXT_ACTION[station.phase]}, not {kind}")
+        if kind == LOAD:
+            if self.loaded >= self.samples:
+                raise ValueError("Every sample has been loaded")
+            self.loaded += 1
+            station.phase, station.sample = STEP1, self.loaded
+        elif kind == ROTATE:
+            station.phase = STEP2
+        else:
+            station.phase, station.sample = EMPTY, None
+        station.ready = at + self.durations.get(station.phase, 0)
+        self.operator_free = max(self.operator_free, at)
+        return self.plan(at)
+
+    def step_finished(self, name, at=None):
+        """A station's protocol ended at time at, earlier or later than planned; replans"""
+        at = self.now() if at is None else at
+        self.station(name).ready = at
+        return self.plan(at)
+
+    def snapshot(self, now=None):
+        """Returns the plan as a plain dict, with how long until each action is due"""
+        now = self.now() if now is None else now
+        return {
+            "now": now,
+            "makespan": self.makespan,
+            "idle": self.idle,
+            "loaded": self.loaded,
+            "samples": self.samples,
+            "actions": [dict(action._asdict(), due_in=max(action.start - now, 0)) for action in self.actions],
+        }
+
+    def _simulate(self, now, order, patient):
+        """Returns (actions, makespan, idle) for one dispatch rule
+
+        order ranks the kinds of action; a patient operator waits for a
+        better-ranked action that becomes ready before the current one would end.
+        """
+        stations = [station.copy() for station in self.stations]
+        loaded = self.loaded
+        operator = max(self.operator_free, now)
+        rank = {kind: order.index(kind) for kind in KINDS}
+        actions = []
+        idle = 0.0
+        while True:
+            candidates = []
+            for station in stations:
+                kind = NEXT_ACTION[station.phase]
+                if kind == LOAD and loaded >= self.samples:
+                    continue
+                ready = max(station.ready, now)
+                candidates.append((max(ready, operator), rank[kind], ready, station, kind))
+            if not candidates:
+                break
+            start, _, ready, station, kind = min(candidates, key=lambda c: c[:2])
+            if patient:
+                end = start + self.handling[kind]
+                better = [c for c in candidates if c[1] < rank[kind] and c[0] < end]
+                if better:
+                    start, _, ready, station, kind = min(better, key=lambda c: c[:2])
+            end = start + self.handling[kind]
+            if kind != LOAD:
+                idle += start - ready
+            if kind == LOAD:
+                loaded += 1
+                station.phase, station.sample = STEP1, loaded
+            actions.append(Action(start, end, station.name, station.sample, kind))
+            if kind == ROTATE:
+                station.phase = STEP2
+            elif kind == UNLOAD:
+                station.phase, station.sample = EMPTY, None
+            station.ready = end + self.durations.get(station.phase, 0)
+            operator = end
+        makespan = actions[-1].end if actions else now
+        return actions, makespan, idle
@@ -0,0 +1,311 @@
+import asyncio
+import os
+import socket
+from collections import deque
+
+from .backends import broker_address
+from .loop import LoopThread
+from .transport import SerialTransport
+
+CLIENT_BACKLOG = 64 * 1024  # Bytes queued for one client before it is dropped as too slow
+HELLO_TIMEOUT = 5  # Seconds a new client gets to name its device
+URGENT = ("ABORT", "STOP")  # Sent ahead of anything still waiting to go out, and taken from any client
+SHARED = ("TELEMETRY",)  # Also taken from any client while another one drives the device
+MOTION = ("FORWARD", "BACKWARD", "PLAN", "RUN", "PAUSE", "RESUME")  # Make the client that sends them the owner
+STEPS = ("FORWARD", "BACKWARD")
+REPLIES = ("ACK", "ERR", "PLANNED", "PAUSED", "RESUMED", "ABORTED")  # One for each command the device is sent
+BUSY = "ERR BUSY"  # As the sketch answers a step while a plan owns the motor
+ERRORS = {BUSY: STEPS, "ERR PLAN": ("PLAN",), "ERR RUN": ("RUN",)}  # The commands each names; plain ERR answers any
+
+
+class SharedDevice:
+    """One physical port held by the broker, and the clients attached to it
+
+    Every command written for a client queues it in pending, and the device's
+    replies, which come one per command and in order, are handed back that way.
+    DONE goes to the owner, the client whose step or plan is running; anything
+    else the device says (CONTINUE, STEP, telemetry) goes to every client, as
+    does an ERR that cannot answer the oldest command, such as ERR CRC.
+    """
+
+    __slots__ = ("name", "transport", "clients", "watcher", "pending", "owner", "loading", "running", "busy")
+
+    def __init__(self, name, transport):
+        self.name = name
+        self.transport = transport
+        self.clients = set()  # StreamWriters
+        self.watcher = None
+        self.pending = deque()  # (StreamWriter or None, first word) of each command still to be answered
+        self.owner = None  # StreamWriter driving the motor, until its step or plan is over
+        self.loading = 0  # Upload steps the device has yet to store; only the last is answered
+        self.running = False  # An uploaded plan is running
+        self.busy = set()  # "MOTOR" and "LED" while a single step has them on
+
+    def refuse(self, writer, word):
+        """Returns the reply for a command writer may not send now, or None if it may"""
+        if self.owner is None or self.owner is writer or word in URGENT or word in SHARED:
+            return None
+        return BUSY  # Another client's run; its replies and DONEs must not be muddled
+
+    def sent(self, writer, word):
+        """Note a command written to the device for writer"""
+        if word in MOTION and self.owner is None:
+            self.owner = writer
+        if word in STEPS and self.loading and writer is self.owner:
+            self.loading -= 1  # Stored, not run
+            if self.loading:
+                return
+        elif word not in URGENT:
+            self.loading = 0  # Any other line ends an upload on the device too
+        self.pending.append((writer, word))
+
+    def detach(self, writer):
+        self.clients.discard(writer)
+        if self.owner is writer:
+            self.owner = None  # The device carries on; any client may stop it
+        if any(waiting is writer for waiting, _ in self.pending):
+            self.pending = deque((None if waiting is writer else waiting, word) for waiting, word in self.pending)
+
+    def dispatch(self, line):
+        """Transport listener: pass a line from the device to the client or clients it is for"""
+        word, _, rest = line.partition(" ")
+        if word in REPLIES and self._answers(line):
+            self._reply(word, line)
+        elif word == "DONE":
+            self.busy.discard(rest)
+            self._write(self.owner, line)
+        else:
+            if line == "PLAN DONE":
+                self.running = False
+            for writer in tuple(self.clients):
+                self._write(writer, line)
+        owner = self.owner
+        if owner is not None and not (self.running or self.loading or self.busy
+                                      or any(waiting is owner for waiting, _ in self.pending)):
+            self.owner = None
+        return True  # Nothing is left for the broker's own readline()
+
+    def _answers(self, line):
+        """False for an ERR naming a command other than the oldest one waiting, e.g. ERR CRC from line noise"""
+        if not line.startswith("ERR "):
+            return True
+        return bool(self.pending) and self.pending[0][1] in ERRORS.get(line, ())
+
+    def _reply(self, word, line):
+        if word == "ABORTED":
+            self.running = False
+            self.loading = 0
+            self.busy.clear()
+            while self.pending:
+                writer, sent = self.pending.popleft()
+                if sent in URGENT:
+                    self._write(writer, line)
+                    return
+                self._write(writer, "ERR")  # Thrown away from the output buffer by the ABORT
+            return
+        if not self.pending:
+            return  # Answers nobody, e.g. a line cut off by an ABORT
+        writer, sent = self.pending.popleft()
+        if line.startswith("ACK PLAN "):
+            self.loading = int(line[9:])
+        elif line == "ACK RUN":
+            self.running = True
+        elif line == "ACK" and sent in STEPS:
+            self.busy = {"MOTOR", "LED"}  # Replacing any step still running
+        self._write(writer, line)
+
+    def _write(self, writer, line):
+        if writer is None or writer not in self.clients:
+            return
+        if writer.transport.get_write_buffer_size() > CLIENT_BACKLOG:
+            self.detach(writer)  # A stalled client must not hold up the device or the others
+            writer.close()
+        else:
+            writer.write((line + "\n").encode())
+
+
+class SerialBroker:
+    """Owns each physical port once and shares it between local clients
+
+    Clients connect to one socket, send "ATTACH <port>", and then speak the text
+    protocol as if they held the port. Each command line is written whole, never
+    interleaved with another client's, and its reply goes back only to the
+    client that sent it; CONTINUE, STEP and telemetry go to every client. While
+    one client is driving the motor, the others' motion and unknown commands are
+    answered ERR BUSY. ABORT and STOP are taken from any client and skip ahead
+    of anything still in the output buffer. A device stays open while the broker runs, so attaching neither
+    resets the Arduino nor sends it anything; the broker answers READY, PING and
+    BAUD itself and keeps its own codec with the device, so clients always get text.
+
+    Runs on its own event loop thread. Open connections with open_port() or a
+    SerialTransport, which attach automatically while the broker is running.
+    """
+
+    def __init__(self, ports=(), baudrate=9600, settle_time=2, binary_baud=None, address=None):
+        self.ports = list(ports)  # Opened at start; others are opened when a client first asks
+        self.baudrate = baudrate
+        self.settle_time = settle_time
+        self.binary_baud = binary_baud
+        self.address = address or broker_address()
+        self.errors = {}  # port -> why it could not be opened at start
+        self._devices = {}  # port -> Task opening or holding its SharedDevice
+        self._writers = set()
+        self._thread = None
+        self._server = None
+
+    def start(self):
+        """Listen and open the ports given; returns once the socket is bound"""
+        self._thread = LoopThread("desicurer-broker")
+        try:
+            self._thread.run(self._listen())
+        except BaseException:
+            self._thread.stop()
+            raise
+        for port in self.ports:
+            try:
+                self._thread.run(self._device(port))
+            except OSError as e:
+                self.errors[port] = str(e)
+        return self
+
+    def stop(self):
+        """Close every client and release every port"""
+        if self._thread is not None:
+            self._thread.run(self._shutdown())
+            self._thread.stop()
+            self._thread = None
+
+    def devices(self):
+        """Returns {port: number of clients attached} for the open devices"""
+        return {name: len(task.result().clients) for name, task in list(self._devices.items())
+                if task.done() and not task.cancelled() and task.exception() is None}
+
+    async def _listen(self):
+        if isinstance(self.address, str):
+            if _listening(self.address):
+                raise OSError(f"A broker is already running at {self.address}")
+            self._server = await asyncio.start_unix_server(self._client, self.address)
+        else:
+            self._server = await asyncio.start_server(self._client, *self.address)
+
+    async def _shutdown(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        for task in list(self._devices.values()):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await self._release(task.result())
+        self._devices = {}
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    # -- Devices --
+
+    async def _device(self, name):
+        task = self._devices.get(name)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = self._devices[name] = asyncio.ensure_future(self._open(name))
+        return await asyncio.shield(task)
+
+    async def _open(self, name):
+        transport = SerialTransport(name, self.baudrate, self.settle_time, binary_baud=self.binary_baud,
+                                    brokered=False)
+        await transport.connect()
+        device = SharedDevice(name, transport)
+        transport.add_listener(device.dispatch)
+        device.watcher = asyncio.ensure_future(self._watch(device))
+        return device
+
+    async def _watch(self, device):
+        """Release the device once its port fails, e.g. when it is unplugged"""
+        try:
+            await device.transport.readline()  # Every line goes to dispatch, so this only returns on failure
+        except OSError as e:
+            for writer in tuple(device.clients):
+                device._write(writer, f"ERR {e}")
+        if self._devices.get(device.name) is not None:
+            del self._devices[device.name]
+        await self._release(device)
+
+    async def _release(self, device):
+        for writer in tuple(device.clients):
+            writer.close()
+        device.clients.clear()
+        if device.watcher is not None and device.watcher is not asyncio.current_task():
+            device.watcher.cancel()
+        await device.transport.close()
+
+    # -- Clients --
+
+    async def _client(self, reader, writer):
+        self._writers.add(writer)
+        device = None
+        try:
+            try:
+                hello = await asyncio.wait_for(reader.readline(), HELLO_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            word, _, name = hello.decode("utf-8", "replace").strip().partition(" ")
+            if word != "ATTACH" or not name:
+                writer.write(b"ERR expected ATTACH <port>\n")
+                return
+            try:
+                device = await self._device(name)
+            except OSError as e:
+                writer.write(f"ERR {e}\n".encode())
+                return
+            writer.write(b"ATTACHED\nREADY\n")  # READY as the sketch prints it, so clients need not wait out a reset
+            device.clients.add(writer)
+            while True:
+                data = await reader.readline()
+                if not data:
+                    return
+                line = data.decode("utf-8", "replace").strip()
+                if line:
+                    await self._command(device, writer, line)
+        except (ConnectionError, ValueError):
+            pass  # Gone, or sent a line longer than any command
+        finally:
+            if device is not None:
+                device.detach(writer)
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _command(self, device, writer, line):
+        word = line.partition(" ")[0]
+        if word == "PING":
+            writer.write(b"PONG\n")
+            return
+        if word == "BAUD":
+            writer.write(b"ERR\n")  # The link to the device is the broker's; clients stay on text
+            return
+        refused = device.refuse(writer, word)
+        if refused:
+            writer.write(f"{refused}\n".encode())
+            return
+        try:
+            if word in URGENT:
+                await device.transport.abort()
+            else:
+                await device.transport.send(line)
+        except (OSError, ValueError) as e:  # Port gone, or no binary form for the command
+            writer.write(f"ERR {e}\n".encode())
+        else:
+            device.sent(writer, word)  # send() does not yield once written, so no reply can come first
+
+
+def _listening(path):
+    """True if something accepts connections on the Unix socket at path"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
@@ -0,0 +1,136 @@
+import json
+import os
+import re
+import struct
+import time
+from collections import namedtuple
+from threading import Condition, Thread
+
+CAPTURE_ENV = "DESICURER_CAPTURE"  # Directory to record every connection's traffic into
+FLUSH_INTERVAL = 1.0  # Seconds between writes of the queued records to the file
+MAGIC = b"DSCAP\x01"
+
+# File layout: MAGIC, HEADER with the length of a JSON metadata object, the metadata,
+# then records: RECORD followed by that many bytes of data
+HEADER = struct.Struct("<I")
+RECORD = struct.Struct("<BIH")  # kind, microseconds since the previous record, data length
+MAX_DELTA = 0xFFFFFFFF
+MAX_DATA = 0xFFFF
+
+# Record kinds
+SENT = 0  # Bytes written to the port
+RECEIVED = 1  # Bytes read from the port
+NOTE = 2  # JSON object from the host side, e.g. a run starting or the user pausing it
+GAP = 3  # No data; carries time past MAX_DELTA
+
+# One record of a capture; time is in seconds from the start of the capture
+Record = namedtuple("Record", "kind time data")
+Capture = namedtuple("Capture", "path meta records duration")
+
+
+class TrafficRecorder:
+    """Compact binary record of every byte a connection sends and receives
+
+    Records are appended to an in-memory buffer on the event loop and written by
+    a background thread every FLUSH_INTERVAL, so recording never waits on the
+    disk. Times come from the transport's clock, in microseconds.
+    """
+
+    def __init__(self, path, clock, **meta):
+        self.path = path
+        self.clock = clock
+        self._last = round(clock.monotonic() * 1e6)
+        self._pending = bytearray()
+        self._closed = False
+        self._condition = Condition()
+        meta.update(version=1, started=time.time())
+        if clock.scale != float("inf"):
+            meta["scale"] = clock.scale  # So a replay gives the host the same allowances in clock time
+        header = json.dumps(meta).encode()
+        self._pending += MAGIC + HEADER.pack(len(header)) + header
+        self._thread = Thread(target=self._write_loop, name="capture", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def create(cls, directory, port, clock, **meta):
+        """Start a capture file for port in directory"""
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", port).strip("_") or "port"
+        path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.dscap")
+        return cls(path, clock, port=port, **meta)
+
+    def sent(self, data):
+        self._record(SENT, data)
+
+    def received(self, data):
+        self._record(RECEIVED, data)
+
+    def note(self, event, **fields):
+        """Record something the host did, such as starting a run, so a replay can do it too"""
+        fields["event"] = event
+        self._record(NOTE, json.dumps(fields).encode())
+
+    def close(self):
+        """Write out everything queued and stop the writer thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(2)
+
+    def _record(self, kind, data):
+        now = round(self.clock.monotonic() * 1e6)
+        delta, self._last = max(now - self._last, 0), now
+        with self._condition:
+            pending = self._pending
+            while delta > MAX_DELTA:
+                pending += RECORD.pack(GAP, MAX_DELTA, 0)
+                delta -= MAX_DELTA
+            for start in range(0, max(len(data), 1), MAX_DATA):
+                chunk = data[start:start + MAX_DATA]
+                pending += RECORD.pack(kind, delta, len(chunk))
+                pending += chunk
+                delta = 0
+
+    def _write_loop(self):
+        with open(self.path, "wb") as f:
+            while True:
+                with self._condition:
+                    if not self._closed:
+                        self._condition.wait(FLUSH_INTERVAL)
+                    data, self._pending = self._pending, bytearray()
+                    closed = self._closed
+                if data:
+                    f.write(data)
+                    f.flush()  # Into the OS, which keeps it if the application dies
+                if closed:
+                    return
+
+
+def read_capture(path):
+    """Returns a Capture, ignoring a record torn off by a crash"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path}: not a capture file")
+    offset = len(MAGIC)
+    (length,) = HEADER.unpack_from(data, offset)
+    offset += HEADER.size
+    meta = json.loads(data[offset:offset + length])
+    offset += length
+    records = []
+    micros = 0
+    while offset + RECORD.size <= len(data):
+        kind, delta, length = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        if start + length > len(data):
+            break
+        micros += delta
+        if kind != GAP:
+            records.append(Record(kind, micros / 1e6, data[start:start + length]))
+        offset = start + length
+    return Capture(path, meta, records, micros / 1e6)
+
+
+def notes(capture):
+    """Returns (time, fields) for every note in a capture"""
+    return [(record.time, json.loads(record.data)) for record in capture.records if record.kind == NOTE]
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import sys
+import time
+from threading import Lock
+
+# Exit codes
+OK = 0
+FAILED = 1  # A device could not be reached or its protocol did not complete
+USAGE = 2
+INTERRUPTED = 130
+
+METRICS_INTERVAL = 10  # Seconds between rewrites of the --metrics file during a run
+
+_print_lock = Lock()
+
+
+def emit(event, **fields):
+    """Print one JSON record on its own line; safe to call from any thread"""
+    record = {"event": event, "time": round(time.time(), 3)}
+    record.update(fields)
+    with _print_lock:
+        print(json.dumps(record), flush=True)
+
+
+def save_metrics(args):
+    if args.metrics:
+        from .metrics import METRICS
+        try:
+            METRICS.save(args.metrics)
+        except OSError as e:
+            print(f"{args.metrics}: {e}", file=sys.stderr)
+
+
+def list_ports(args):
+    from .ports import fingerprint, get_port_infos
+    for port in get_port_infos():
+        emit("port", fingerprint=fingerprint(port), **port._asdict())
+    return OK
+
+
+def list_protocols(args):
+    from .protocols import ProtocolError, get_plans
+    try:
+        plans = get_plans()
+    except (ProtocolError, OSError) as e:
+        print(e, file=sys.stderr)
+        return USAGE
+    for name, plan in plans.items():
+        emit("protocol", name=name, steps=[list(step) for step in plan.steps], duration=plan.duration)
+    return OK
+
+
+def optimize_protocols(args):
+    from .optimize import optimize_steps
+    from .plans import fits_step_table
+    from .protocols import ProtocolError, get_plans
+    try:
+        plans = get_plans(optimize=False)
+    except (ProtocolError, OSError) as e:
+        print(e, file=sys.stderr)
+        return USAGE
+    for name in args.protocol or plans:
+        if name not in plans:
+            print(f"Unknown protocol: {name}", file=sys.stderr)
+            return USAGE
+        result = optimize_steps(plans[name].steps, round_trip=args.round_trip)
+        emit("optimized", name=name, steps=[list(step) for step in result.steps],
+             commands=len(result.original), commands_saved=result.commands_saved,
+             bytes_saved=result.bytes_saved, seconds_saved=round(result.seconds_saved, 3),
+             uploadable=result.uploadable, was_uploadable=fits_step_table(result.original))
+    return OK
+
+
+def run_protocol(args):
+    from .engine import IDLE, Engine
+    from .ports import get_serial_ports
+    from .protocols import get_protocol
+    try:
+        plan = get_protocol(args.protocol)
+    except (ValueError, OSError) as e:
+        print(e, file=sys.stderr)
+        return USAGE
+    ports = args.port or get_serial_ports()
+    if not ports:
+        print("No serial ports found", file=sys.stderr)
+        return FAILED
+    engine = Engine(args.baud, args.settle, binary_baud=args.binary_baud,
+                    on_update=lambda device: emit("device", **device))
+    emit("start", protocol=args.protocol, ports=ports, steps=len(plan.steps), duration=plan.duration)
+    try:
+        engine.open_all(ports)
+        ready = [port for port, device in engine.status().items() if device["state"] == IDLE]
+        if ready:
+            engine.start(args.protocol, ready)
+            while not engine.wait(METRICS_INTERVAL):
+                save_metrics(args)
+    except KeyboardInterrupt:
+        engine.close()
+        save_metrics(args)
+        emit("end", ok=False, interrupted=True)
+        return INTERRUPTED
+    status = engine.status()
+    engine.close()
+    save_metrics(args)
+    completed = [port for port in ready if status[port]["state"] == IDLE and status[port]["step"] == status[port]["steps"]]
+    ok = len(completed) == len(ports)
+    emit("end", ok=ok, completed=completed, failed=[port for port in ports if port not in completed])
+    return OK if ok else FAILED
+
+
+def send_command(args):
+    import serial  # Deferred with the rest of the serial stack
+    from .link import SerialLink
+    link = SerialLink(args.port, args.baud, args.settle)
+    try:
+        link.connect()
+        command = link.send_command(args.movement, args.motor, args.led)
+        emit("sent", port=args.port, command=command)
+        save_metrics(args)
+    except (serial.SerialException, OSError) as e:
+        print(f"{args.port}: {e}", file=sys.stderr)
+        return FAILED
+    finally:
+        link.close()
+    return OK
+
+
+def serve(args):
+    from .engine import Engine
+    from .server import ControlServer
+    server = ControlServer(Engine(args.baud, args.settle, binary_baud=args.binary_baud),
+                           args.host, args.listen, args.socket).start()
+    emit("serving", address=server.address)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    server.engine.close()
+    return OK
+
+
+def run_broker(args):
+    from .backends import BROKER_HOST, broker_address
+    from .broker import SerialBroker
+    address = args.socket or ((BROKER_HOST, args.listen) if args.listen else broker_address())
+    try:
+        broker = SerialBroker(args.port or (), args.baud, args.settle, args.binary_baud, address).start()
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return FAILED
+    emit("broker", address=address, devices=broker.devices(), errors=broker.errors)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    broker.stop()
+    return OK
+
+
+def plan_batch(args):
+    from .batch import BatchScheduler
+    from .protocols import get_protocol
+    try:
+        step1, step2 = get_protocol(args.step1), get_protocol(args.step2)
+    except (ValueError, OSError) as e:
+        print(e, file=sys.stderr)
+        return USAGE
+    stations = args.port or [str(number) for number in range(1, args.stations + 1)]
+    batch = BatchScheduler(args.samples, stations, step1.duration, step2.duration, args.load, args.rotate, args.unload)
+    for action in batch.actions:
+        emit("action", **action._asdict())
+    emit("plan", makespan=batch.makespan, idle=batch.idle, samples=args.samples, stations=stations)
+    return OK
+
+
+def replay_capture(args):
+    from .replay import replay
+    try:
+        report = replay(args.file, args.speed)
+    except (ValueError, OSError) as e:
+        print(f"{args.file}: {e}", file=sys.stderr)
+        return USAGE
+    emit("replay", **report)
+    return OK if report["ok"] else FAILED
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m desicurer",
+                                     description="Drive spinning desicurers without the GUI. "
+                                                 "Progress is printed as one JSON object per line.")
+    parser.add_argument("--baud", type=int, default=9600, help="serial baud rate (default 9600)")
+    parser.add_argument("--settle", type=float, default=2, help="seconds to wait for the Arduino to reset (default 2)")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="record command latencies and save them here, as JSON if PATH ends in .json "
+                             "and as Prometheus text otherwise")
+    parser.add_argument("--capture", metavar="DIR",
+                        help="record every byte sent and received into a capture file in DIR")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ports = commands.add_parser("ports", help="list serial ports")
+    ports.set_defaults(func=list_ports)
+
+    protocols = commands.add_parser("protocols", help="list available protocols")
+    protocols.set_defaults(func=list_protocols)
+
+    optimize = commands.add_parser("optimize", help="show what merging redundant steps saves for each protocol")
+    optimize.add_argument("protocol", nargs="*", help="protocols to check (default: all)")
+    optimize.add_argument("--round-trip", type=float, default=0.1,
+                          help="seconds each streamed step costs in round trips (default 0.1)")
+    optimize.set_defaults(func=optimize_protocols)
+
+    run = commands.add_parser("run", help="run a protocol on one or more devices")
+    run.add_argument("protocol", help="protocol name, e.g. step1")
+    run.add_argument("-p", "--port", action="append", help="port to run on; repeat for more (default: every port)")
+    run.add_argument("--binary-baud", type=int, help="switch to binary frames at this baud rate if the firmware can")
+    run.set_defaults(func=run_protocol)
+
+    server = commands.add_parser("serve", help="run the control API for dashboards and scripts")
+    server.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default 127.0.0.1; the API has no authentication)")
+    server.add_argument("--listen", type=int, default=8765, help="TCP port (default 8765)")
+    server.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    server.add_argument("--binary-baud", type=int, help="switch to binary frames at this baud rate if the firmware can")
+    server.set_defaults(func=serve)
+
+    broker = commands.add_parser("broker", help="share serial ports between the GUI, scripts and diagnostic tools")
+    broker.add_argument("-p", "--port", action="append", help="port to open now; others open when first asked for")
+    broker.add_argument("--socket", help="Unix socket to listen on (default: $DESICURER_BROKER or a per-user path)")
+    broker.add_argument("--listen", type=int, help="listen on this TCP port on 127.0.0.1 instead")
+    broker.add_argument("--binary-baud", type=int, help="switch to binary frames at this baud rate if the firmware can")
+    broker.set_defaults(func=run_broker)
+
+    batch = commands.add_parser("batch", help="plan when one operator loads, rotates and unloads a batch")
+    batch.add_argument("samples", type=int, help="number of samples")
+    batch.add_argument("--stations", type=int, default=1, help="number of stations (default 1)")
+    batch.add_argument("-p", "--port", action="append", help="name the stations by port instead of number")
+    batch.add_argument("--step1", default="step1", help="protocol run before the rotation (default step1)")
+    batch.add_argument("--step2", default="step2", help="protocol run after the rotation (default step2)")
+    batch.add_argument("--load", type=float, default=30, help="seconds to load a sample (default 30)")
+    batch.add_argument("--rotate", type=float, default=20, help="seconds to rotate a sample (default 20)")
+    batch.add_argument("--unload", type=float, default=20, help="seconds to unload a sample (default 20)")
+    batch.set_defaults(func=plan_batch)
+
+    replay = commands.add_parser("replay", help="feed a capture file back through the protocol runner")
+    replay.add_argument("file")
+    replay.add_argument("--speed", type=float,
+                        help="play at this multiple of the recorded pace (default: as fast as possible)")
+    replay.set_defaults(func=replay_capture)
+
+    send = commands.add_parser("send", help="send a single step")
+    send.add_argument("-p", "--port", required=True)
+    send.add_argument("movement", choices=("FORWARD", "BACKWARD"))
+    send.add_argument("motor", type=int, help="motor duration in seconds")
+    send.add_argument("led", type=int, help="LED duration in seconds")
+    send.set_defaults(func=send_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.capture:
+        from .capture import CAPTURE_ENV
+        os.environ[CAPTURE_ENV] = args.capture  # Read by every transport as it connects
+    if args.metrics:
+        from .metrics import METRICS
+        METRICS.enable()
+    return args.func(args)
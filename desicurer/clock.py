@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import itertools
+import time
+import weakref
+
+
+class RealClock:
+    """Wall-clock time; what the devices actually run on"""
+
+    scale = 1
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """Blocking sleep for threaded callers"""
+        time.sleep(seconds)
+
+    async def asleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def wait_for(self, awaitable, timeout):
+        """Await with a timeout measured on this clock; raises asyncio.TimeoutError"""
+        return await asyncio.wait_for(awaitable, timeout)
+
+    def call_at(self, when, callback):
+        """Run callback on the event loop once monotonic() reaches when"""
+        loop = asyncio.get_running_loop()
+        return loop.call_later(max(when - self.monotonic(), 0), callback)
+
+    def from_real(self, seconds):
+        """Converts a wall-time allowance, such as a serial round trip, to this clock's time"""
+        return seconds * self.scale
+
+
+class ScaledClock(RealClock):
+    """Runs scale times faster than wall time, e.g. against a VirtualDesicurer at the same scale"""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self._t0 = time.monotonic()
+
+    def monotonic(self):
+        return self._t0 + (time.monotonic() - self._t0) * self.scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+    async def asleep(self, seconds):
+        await asyncio.sleep(seconds / self.scale)
+
+    async def wait_for(self, awaitable, timeout):
+        return await asyncio.wait_for(awaitable, None if timeout is None else timeout / self.scale)
+
+    def call_at(self, when, callback):
+        loop = asyncio.get_running_loop()
+        return loop.call_later(max(when - self.monotonic(), 0) / self.scale, callback)
+
+
+class VirtualClock:
+    """Simulated time that jumps straight to the next thing that can happen
+
+    Sleeps and waits register their deadlines with the clock, and a driver task
+    fires due timers and deadlines one at a time, in order, whenever nothing else
+    on the event loop is ready to run. Every task waiting on the clock therefore
+    sees the same timeline: a timer due at a deadline fires before that wait
+    times out, and no wait is passed over by another's. Give each simulated run
+    its own VirtualClock; runs on separate clocks can share one event loop.
+    """
+
+    scale = float("inf")
+
+    def __init__(self, start=0.0, allowance=1):
+        self.now = start
+        self.allowance = allowance  # Clock seconds per wall second from_real allows, e.g. a replayed capture's scale
+        self._timers = []
+        self._counter = itertools.count()  # Keeps timers due at the same time in order
+        self._waiting = {}  # Future waking each wait_for in progress -> the task it waits on
+        self._changes = 0  # Waits started or ended, so the driver knows its waiters are still busy
+        self._driver = None
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self._advance(self.now + seconds)
+
+    async def asleep(self, seconds):
+        try:
+            await self.wait_for(asyncio.get_running_loop().create_future(), max(seconds, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def wait_for(self, awaitable, timeout):
+        """Wait while the driver moves time on, until awaitable finishes or the timeout passes"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(awaitable)
+        wake = loop.create_future()
+        expiry = None if timeout is None else self._call_at(self.now + timeout, lambda: _wake(wake), last=True)
+        self._waiting[wake] = task
+        self._changes += 1
+        if self._driver is None or self._driver.done():
+            self._driver = loop.create_task(self._drive())
+        try:
+            await asyncio.wait((task, wake), return_when=asyncio.FIRST_COMPLETED)
+            if task.done():
+                return task.result()
+            wake.result()  # Raises if no timer is left to end the wait
+            raise asyncio.TimeoutError
+        finally:
+            del self._waiting[wake]
+            self._changes += 1
+            if expiry is not None:
+                expiry.cancel()
+            if not task.done():
+                task.cancel()
+
+    def from_real(self, seconds):
+        return seconds * self.allowance  # Virtual links have no latency; keep the allowance as given
+
+    def call_at(self, when, callback):
+        return self._call_at(when, callback)
+
+    def _call_at(self, when, callback, last=False):
+        entry = [when, last, next(self._counter), callback]  # Deadlines after the timers due with them
+        heapq.heappush(self._timers, entry)
+        return _VirtualHandle(entry)
+
+    async def _drive(self):
+        loop = asyncio.get_running_loop()
+        counts = _DRIVERS.setdefault(loop, [0, 0])
+        counts[0] += 1
+        try:
+            while self._waiting:
+                changes = self._changes
+                await _idle(loop)
+                if changes != self._changes or any(wake.done() or task.done() for wake, task in self._waiting.items()):
+                    continue  # A wait has its answer, or a new one has yet to look; time must not move on yet
+                while self._timers and self._timers[0][3] is None:
+                    heapq.heappop(self._timers)  # Cancelled; does not move time on
+                if not self._waiting:
+                    return
+                if self._timers:
+                    self._fire_next()
+                    continue
+                for wake in self._waiting:
+                    if not wake.done():
+                        wake.set_exception(RuntimeError("virtual wait can never finish: no timers pending"))
+        finally:
+            counts[0] -= 1
+
+    def _advance(self, target):
+        while self._timers and self._timers[0][0] <= target:
+            self._fire_next()
+        self.now = max(self.now, target)
+
+    def _fire_next(self):
+        when, _, _, callback = heapq.heappop(self._timers)
+        if callback is not None:
+            self.now = max(self.now, when)
+            callback()
+
+
+class _VirtualHandle:
+    """Returned by VirtualClock.call_at so the timer can be cancelled like an asyncio handle"""
+
+    __slots__ = ("_entry",)
+
+    def __init__(self, entry):
+        self._entry = entry
+
+    def cancel(self):
+        self._entry[3] = None
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_DRIVERS = weakref.WeakKeyDictionary()  # Event loop -> [VirtualClock drivers on it, how many are in _idle]
+IDLE_ROUNDS = 1000  # Most loop iterations a lone driver waits for the loop to settle
+SHARED_ROUNDS = 3  # The same with other clocks' drivers on the loop
+
+
+async def _idle(loop):
+    """Yield until nothing but other clocks' drivers is ready to run on the loop
+
+    Other clocks' runs keep the loop busy in a way that can't be told apart from
+    this clock's, so while clocks share a loop a driver waits a few turns at most.
+    """
+    ready = getattr(loop, "_ready", None)  # asyncio's own loop exposes its run queue
+    counts = _DRIVERS[loop]
+    rounds = IDLE_ROUNDS if ready is not None and counts[0] == 1 else SHARED_ROUNDS
+    counts[1] += 1
+    try:
+        for _ in range(rounds):
+            await asyncio.sleep(0)
+            if ready is not None and len(ready) < counts[1]:
+                return  # Each other driver waiting here has one turn queued, and nothing else is
+    finally:
+        counts[1] -= 1
+
+
+REAL_CLOCK = RealClock()
+
+
+def get_clock(name=None, scale=1):
+    """Returns a clock by name: 'real', 'scaled' or 'virtual'"""
+    if name in (None, "real"):
+        return REAL_CLOCK
+    if name == "scaled":
+        return ScaledClock(scale)
+    if name == "virtual":
+        return VirtualClock()
+    raise ValueError(f"Unknown clock: {name}")
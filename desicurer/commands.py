@@ -0,0 +1,11 @@
+# Text command encoding for the Arduino firmware
+
+
+def format_command(movement, motor_duration, led_duration):
+    """Returns the command line understood by the firmware, without the newline"""
+    return f"{movement} {motor_duration} LED {led_duration}"
+
+
+def encode_command(movement, motor_duration, led_duration):
+    """Returns the bytes written to the serial port for one step"""
+    return (format_command(movement, motor_duration, led_duration) + '\n').encode()
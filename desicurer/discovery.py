@@ -0,0 +1,143 @@
+import json
+import os
+import time
+from threading import Event, Lock, Thread
+
+from .ports import fingerprint, get_port_infos
+
+DEVICE_CACHE_ENV = "DESICURER_DEVICE_CACHE"  # Path of the device cache, overriding the default
+SCAN_INTERVAL = 1.0  # Seconds between port scans when hot-plug events are not available
+
+
+def default_cache_path():
+    path = os.environ.get(DEVICE_CACHE_ENV)
+    if path:
+        return path
+    return os.path.join(os.path.expanduser("~"), ".desicurer", "devices.json")
+
+
+class DeviceCache:
+    """Remembers which USB serial adapter is which desicurer, across restarts
+
+    Entries are keyed by ports.fingerprint() and hold the device's name and the
+    port and time it was last connected on.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        self._lock = Lock()
+        self._entries = None  # Loaded on first use
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}  # Missing or damaged cache: start over
+        return self._entries
+
+    def lookup(self, port):
+        """Returns the cache entry for a PortInfo, or None if it has never been connected"""
+        with self._lock:
+            return self._load().get(fingerprint(port))
+
+    def remember(self, port, name=None):
+        """Record a successful connection to a PortInfo"""
+        with self._lock:
+            entries = self._load()
+            entry = entries.setdefault(fingerprint(port), {})
+            entry["name"] = name or entry.get("name") or port.device
+            entry["port"] = port.device
+            entry["connected"] = time.time()
+            self._save(entries)
+
+    def known(self, ports):
+        """Returns the PortInfos that have connected before, most recently used first"""
+        with self._lock:
+            entries = self._load()
+            known = [port for port in ports if fingerprint(port) in entries]
+            return sorted(known, key=lambda port: -entries[fingerprint(port)].get("connected", 0))
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.path)
+        temporary = self.path + ".tmp"
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temporary, "w") as f:
+                json.dump(entries, f, indent=2)
+            os.replace(temporary, self.path)  # Never leave a half-written cache behind
+        except OSError:
+            pass  # Read-only home: remembering is a nicety, not a requirement
+
+
+class PortWatcher:
+    """Keeps the list of serial ports current on a background thread
+
+    on_change(ports, added, removed) is called from the watcher thread with lists
+    of PortInfo whenever a port appears or disappears, and once after the first
+    scan. On Linux with pyudev installed the scan runs as soon as the kernel
+    reports a tty being added or removed; otherwise ports are polled every interval.
+    """
+
+    def __init__(self, on_change, interval=SCAN_INTERVAL):
+        self.on_change = on_change
+        self.interval = interval
+        self.ports = []  # PortInfo list from the latest scan
+        self._report = True  # Call on_change after the next scan even if nothing changed
+        self._wake = Event()
+        self._stopped = Event()
+        self._thread = None
+        self._observer = None
+
+    def start(self):
+        """Start watching; returns at once, the first scan runs in the background"""
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name="port-watcher", daemon=True)
+        self._thread.start()
+        self._observer = self._start_hotplug()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join(1)
+            self._thread = None
+
+    def rescan(self):
+        """Scan now instead of at the next interval, and report the result either way"""
+        self._report = True
+        self._wake.set()
+
+    def _start_hotplug(self):
+        try:
+            import pyudev  # Optional: without it the watcher polls
+        except ImportError:
+            return None
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by("tty")
+        observer = pyudev.MonitorObserver(monitor, callback=lambda device: self._wake.set(), daemon=True)
+        observer.start()
+        return observer
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                ports = get_port_infos()
+            except Exception:
+                ports = self.ports  # A failed scan must not report every port as gone
+            old = {port.device: port for port in self.ports}
+            new = {port.device: port for port in ports}
+            added = [port for device, port in new.items() if old.get(device) != port]
+            removed = [port for device, port in old.items() if new.get(device) != port]
+            self.ports = ports
+            if self._report or added or removed:
+                self._report = False
+                self.on_change(ports, added, removed)
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,71 @@
+import sys
+import time
+from threading import Lock
+
+
+class UiDispatcher:
+    """Runs callbacks posted from any thread on the Tk main loop
+
+    Worker threads must not touch Tk widgets, so they post() here instead and the
+    main loop drains the queue every interval ms. Posts that share a key replace
+    each other, so a burst of status updates from many devices draws only the
+    latest one per key. Each drain stops after budget seconds and leaves the rest
+    for the next tick, so touch input is handled in between.
+    """
+
+    def __init__(self, master, interval=50, budget=0.01):
+        self.master = master  # The Tk root
+        self.interval = interval
+        self.budget = budget
+        self._pending = {}  # key -> (callback, args, kwargs), in posting order
+        self._lock = Lock()
+        self._count = 0  # Source of keys for posts that must not be merged
+        self._after_id = None
+
+    def post(self, callback, *args, key=None, **kwargs):
+        """Queue callback(*args, **kwargs) for the main loop; safe to call from any thread"""
+        with self._lock:
+            if key is None:
+                self._count += 1
+                key = self._count
+            else:
+                self._pending.pop(key, None)  # The newer update moves to the back
+            self._pending[key] = (callback, args, kwargs)
+
+    def start(self):
+        """Begin draining the queue; call from the main thread"""
+        if self._after_id is None:
+            self._after_id = self.master.after(self.interval, self._drain)
+
+    def stop(self):
+        """Stop draining; anything still queued is dropped"""
+        if self._after_id is not None:
+            self.master.after_cancel(self._after_id)
+            self._after_id = None
+        with self._lock:
+            self._pending = {}
+
+    def _drain(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        items = list(batch.items())
+        deadline = time.perf_counter() + self.budget
+        for index, (key, (callback, args, kwargs)) in enumerate(items):
+            if index and time.perf_counter() > deadline:  # Always make some progress
+                self._requeue(items[index:])
+                self._after_id = self.master.after(1, self._drain)  # Let input events in first
+                return
+            try:
+                callback(*args, **kwargs)
+            except Exception:
+                self.master.report_callback_exception(*sys.exc_info())
+        self._after_id = self.master.after(self.interval, self._drain)
+
+    def _requeue(self, items):
+        """Put undrawn items back ahead of anything posted meanwhile, unless a newer post replaced them"""
+        with self._lock:
+            pending = dict(items)
+            for key, value in self._pending.items():
+                pending.pop(key, None)
+                pending[key] = value
+            self._pending = pending
@@ -0,0 +1,256 @@
+import asyncio
+import time
+from threading import Lock
+
+from .loop import get_loop_thread
+from .ports import get_serial_ports
+from .protocols import get_protocol
+from .runner import ProtocolRun, StepError
+from .transport import SerialTransport
+
+# Device states
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+IDLE = "idle"
+RUNNING = "running"
+PAUSED = "paused"
+ERROR = "error"
+
+# Allowed state changes for a device
+TRANSITIONS = {
+    DISCONNECTED: {CONNECTING},
+    CONNECTING: {IDLE, ERROR, DISCONNECTED},
+    IDLE: {RUNNING, DISCONNECTED, ERROR},
+    RUNNING: {PAUSED, IDLE, ERROR, DISCONNECTED},
+    PAUSED: {RUNNING, IDLE, ERROR, DISCONNECTED},
+    ERROR: {CONNECTING, DISCONNECTED},
+}
+
+
+class InvalidTransition(Exception):
+    """Raised when a device is asked to do something its current state does not allow"""
+
+
+class Device:
+    """State of one desicurer attached to the engine"""
+
+    __slots__ = ("port", "state", "protocol", "step", "steps", "message",
+                 "transport", "run", "task", "updated", "on_update")
+
+    def __init__(self, port):
+        self.port = port
+        self.state = DISCONNECTED
+        self.protocol = None  # Name of the running protocol
+        self.step = 0  # Index of the current step
+        self.steps = 0  # Number of steps in the running protocol
+        self.message = ""
+        self.transport = None
+        self.run = None  # ProtocolRun in progress
+        self.task = None
+        self.updated = time.time()
+        self.on_update = None  # Called with the device after every change
+
+    def touch(self, message=None):
+        """Note a change other than of state, such as a new step"""
+        if message is not None:
+            self.message = message
+        self.updated = time.time()
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def set_state(self, state, message=""):
+        """Move to a new state, refusing changes the state machine does not allow"""
+        if state != self.state and state not in TRANSITIONS[self.state]:
+            raise InvalidTransition(f"{self.port}: cannot go from {self.state} to {state}")
+        self.state = state
+        self.touch(message)
+
+    def snapshot(self):
+        """Returns a plain dict describing the device"""
+        return {
+            "port": self.port,
+            "state": self.state,
+            "protocol": self.protocol,
+            "step": self.step,
+            "steps": self.steps,
+            "message": self.message,
+            "lateness": self.lateness(),
+            "updated": self.updated,
+        }
+
+    def lateness(self):
+        """Returns how late the most recent step started, in seconds"""
+        if self.run is None or not self.run.records:
+            return None
+        record = self.run.records[-1]
+        return record.actual - record.planned
+
+
+class Engine:
+    """Drives many desicurers from one process on a single shared event loop"""
+
+    def __init__(self, baudrate=9600, settle_time=2, clock=None, binary_baud=None, on_update=None):
+        self.baudrate = baudrate
+        self.binary_baud = binary_baud  # Ask each device for binary frames at this rate
+        self.clock = clock  # Shared by every device; None for real time
+        self.settle_time = settle_time  # Time the Arduino needs to reset after the port opens
+        self.on_update = on_update  # Called on the loop thread with a snapshot whenever a device changes
+        self.devices = {}
+        self._lock = Lock()
+        self._loop = get_loop_thread()
+
+    # -- Public API, safe to call from any thread --
+
+    def open_all(self, ports=None):
+        """Open every attached port (or the given ones) and wait for them to settle"""
+        if ports is None:
+            ports = get_serial_ports()
+        devices = [self._device(port) for port in ports]
+        futures = [self._loop.submit(self._connect(device)) for device in devices
+                   if device.state in (DISCONNECTED, ERROR)]
+        for future in futures:
+            future.result()
+        return self.status()
+
+    def start(self, protocol, ports=None):
+        """Start a named protocol on the given ports, or on every idle device"""
+        plan = get_protocol(protocol)
+        with self._lock:
+            targets = [self.devices[p] for p in ports] if ports else \
+                [d for d in self.devices.values() if d.state == IDLE]
+        for device in targets:
+            self._loop.run(self._start(device, protocol, plan))
+        return [device.port for device in targets]
+
+    def pause(self, port):
+        """Pause a device mid-step where the firmware can freeze it, otherwise before its next step"""
+        self._loop.run(self._pause(self.devices[port]))
+
+    def resume(self, port):
+        """Resume a paused device"""
+        self._loop.run(self._resume(self.devices[port]))
+
+    def stop(self, port):
+        """Abandon the protocol running on a device"""
+        self._loop.run(self._stop(self.devices[port]))
+
+    def status(self):
+        """Returns a snapshot of every device keyed by port"""
+        with self._lock:
+            return {port: device.snapshot() for port, device in self.devices.items()}
+
+    def wait(self, timeout=None):
+        """Block until no device is running a protocol"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while any(d["state"] in (RUNNING, PAUSED) for d in self.status().values()):
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def close(self):
+        """Stop every protocol and close every port"""
+        with self._lock:
+            devices = list(self.devices.values())
+        for device in devices:
+            self._loop.run(self._disconnect(device))
+
+    # -- Loop side --
+
+    def _device(self, port):
+        with self._lock:
+            if port not in self.devices:
+                device = self.devices[port] = Device(port)
+                device.on_update = self._updated
+            return self.devices[port]
+
+    def _updated(self, device):
+        if self.on_update is not None:
+            self.on_update(device.snapshot())
+
+    async def _connect(self, device):
+        device.set_state(CONNECTING, "Opening port")
+        if device.transport is not None:
+            await device.transport.close()  # The failed attempt's port and capture, when reconnecting from ERROR
+        device.transport = SerialTransport(device.port, self.baudrate, self.settle_time, clock=self.clock,
+                                           binary_baud=self.binary_baud)
+        try:
+            await device.transport.connect()
+        except Exception as e:  # SerialException/OSError mostly, but never leave it CONNECTING
+            await device.transport.close()
+            device.set_state(ERROR, str(e) or type(e).__name__)
+            return
+        device.set_state(IDLE, "Connected")
+
+    async def _start(self, device, protocol, plan):
+        if device.task and not device.task.done():
+            raise InvalidTransition(f"{device.port}: a protocol is already running")
+        if RUNNING not in TRANSITIONS[device.state]:
+            raise InvalidTransition(f"{device.port}: cannot start a protocol while {device.state}")
+        device.protocol = protocol
+        device.step = 0
+        device.steps = len(plan.steps)
+        device.set_state(RUNNING, f"Starting {protocol}")
+
+        def on_step(index, command):
+            device.step = index
+            device.touch(f"Command sent: {command}")
+
+        device.run = ProtocolRun(device.transport, plan, on_step, clock=self.clock)
+        device.task = asyncio.get_running_loop().create_task(self._run(device))
+
+    async def _run(self, device):
+        import serial
+        try:
+            await device.run.run()
+            device.step = device.steps
+            device.set_state(IDLE, "Step Completed")
+        except (serial.SerialException, OSError) as e:
+            device.set_state(ERROR, f"Failed to send command: {e}")
+        except StepError as e:
+            device.set_state(ERROR, str(e))
+        except Exception as e:  # E.g. FrameError for a step too long for a binary frame; never leave it RUNNING
+            device.set_state(ERROR, f"{type(e).__name__}: {e}")
+
+    async def _pause(self, device):
+        if device.state != RUNNING:
+            raise InvalidTransition(f"{device.port}: no protocol running to pause")
+        device.run.pause()
+        device.set_state(PAUSED, "Protocol paused.")
+
+    async def _resume(self, device):
+        if device.state != PAUSED:
+            raise InvalidTransition(f"{device.port}: no protocol paused to resume")
+        device.set_state(RUNNING, "Protocol resumed.")
+        device.run.resume()
+
+    async def _stop(self, device):
+        if device.task and not device.task.done():
+            device.run.stop()
+            try:
+                await device.task
+            except asyncio.CancelledError:
+                pass
+        if device.state in (RUNNING, PAUSED):
+            device.set_state(IDLE, "Protocol stopped.")
+
+    async def _disconnect(self, device):
+        await self._stop(device)
+        if device.transport is not None:
+            await device.transport.close()
+        device.transport = None
+        if device.state != DISCONNECTED:
+            device.set_state(DISCONNECTED)
+
+
+if __name__ == "__main__":
+    import sys
+    engine = Engine()
+    print(engine.open_all())
+    engine.start(sys.argv[1] if len(sys.argv) > 1 else "step1")
+    try:
+        while not engine.wait(timeout=5):
+            for port, device in engine.status().items():
+                print(f"{port}: {device['state']} step {device['step']}/{device['steps']} {device['message']}")
+    finally:
+        engine.close()
@@ -0,0 +1,337 @@
+# Binary framing for the Arduino link
+#
+# Every frame is a fixed-size payload followed by a CRC-16/CCITT-FALSE (big-endian),
+# COBS-encoded and terminated by a zero byte. Commands carry 6 payload bytes:
+#
+#     opcode, direction/count, motor seconds (u16), LED seconds (u16)
+#
+# and events 4 bytes:
+#
+#     event, code, value (u16)
+#
+# except PAUSED, which carries the motor and LED time left in 10 bytes:
+#
+#     event, 0, motor ms (u32), LED ms (u32)
+#
+# and telemetry samples (T lines), also 10 bytes:
+#
+#     event, flags, millis (u32), motor PWM, LED PWM, plan step (i8), 0
+#
+# Fixed sizes let the firmware decode in place, in constant time, without a heap.
+# Both directions map one-to-one onto the text protocol, so everything above the
+# transport keeps speaking text lines.
+import struct
+
+# Host -> device opcodes
+OP_STEP = 0x01
+OP_PLAN = 0x02
+OP_RUN = 0x03
+OP_PAUSE = 0x04
+OP_RESUME = 0x05
+OP_ABORT = 0x06
+OP_PING = 0x07
+OP_TELEMETRY = 0x08
+
+# Device -> host events
+EV_ACK = 0x81
+EV_DONE = 0x82
+EV_ERR = 0x83
+EV_STEP = 0x84
+EV_PLAN_DONE = 0x85
+EV_CONTINUE = 0x86
+EV_PLANNED = 0x87
+EV_PAUSED = 0x88
+EV_RESUMED = 0x89
+EV_ABORTED = 0x8A
+EV_PONG = 0x8B
+EV_TELEMETRY = 0x8C
+
+COMMAND_SIZE = 6
+EVENT_SIZE = 4
+PAUSED_SIZE = 10
+TELEMETRY_SIZE = 10
+MAX_VALUE = 0xFFFF
+
+_COMMAND = struct.Struct(">BBHH")
+_EVENT = struct.Struct(">BBH")
+_PAUSED = struct.Struct(">BBII")
+_TELEMETRY = struct.Struct(">BBIBBbx")
+_CRC = struct.Struct(">H")
+
+# Opcodes that take no arguments, by their text form
+_CONTROLS = {"RUN": OP_RUN, "PAUSE": OP_PAUSE, "RESUME": OP_RESUME, "ABORT": OP_ABORT, "PING": OP_PING}
+_CONTROL_NAMES = {op: name for name, op in _CONTROLS.items()}
+_MOVEMENTS = {"FORWARD": 1, "BACKWARD": 0}
+_MOVEMENT_NAMES = {code: name for name, code in _MOVEMENTS.items()}
+_CHANNELS = {"MOTOR": 0, "LED": 1}
+_CHANNEL_NAMES = {code: name for name, code in _CHANNELS.items()}
+_ERRORS = {"": 0, "BUSY": 1, "PLAN": 2, "RUN": 3, "CRC": 4, "FRAME": 5}
+_ERROR_NAMES = {code: name for name, code in _ERRORS.items()}
+# Events without arguments, by their text form
+_SIMPLE_EVENTS = {"PLAN DONE": EV_PLAN_DONE, "CONTINUE": EV_CONTINUE, "PAUSED": EV_PAUSED,
+                  "RESUMED": EV_RESUMED, "ABORTED": EV_ABORTED, "PONG": EV_PONG}
+_SIMPLE_EVENT_NAMES = {code: name for name, code in _SIMPLE_EVENTS.items()}
+
+
+class FrameError(ValueError):
+    """Raised for a frame that is corrupt or does not map onto the protocol"""
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE of data"""
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def cobs_encode(data):
+    """COBS-encode data so it contains no zero bytes"""
+    out = bytearray(b"\x00")
+    code_at = 0
+    code = 1
+    for byte in data:
+        if byte:
+            out.append(byte)
+            code += 1
+        if not byte or code == 0xFF:
+            out[code_at] = code
+            code_at = len(out)
+            out.append(0)
+            code = 1
+    out[code_at] = code
+    return bytes(out)
+
+
+def cobs_decode(data):
+    """Reverse cobs_encode; raises FrameError on malformed input"""
+    out = bytearray()
+    index = 0
+    while index < len(data):
+        code = data[index]
+        if code == 0 or index + code > len(data):
+            raise FrameError("bad COBS block")
+        out += data[index + 1:index + code]
+        index += code
+        if code < 0xFF and index < len(data):
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(payload):
+    """Returns the bytes on the wire for one payload, delimiter included"""
+    return cobs_encode(payload + _CRC.pack(crc16(payload))) + b"\x00"
+
+
+def decode_frame(frame):
+    """Returns the payload of one frame (without its delimiter); raises FrameError"""
+    data = cobs_decode(frame)
+    if len(data) < 3:
+        raise FrameError("frame too short")
+    payload, crc = data[:-2], _CRC.unpack(data[-2:])[0]
+    if crc16(payload) != crc:
+        raise FrameError("CRC mismatch")
+    return payload
+
+
+# -- Text <-> binary mapping --
+
+def command_payload(line):
+    """Returns the binary payload for a text command line"""
+    words = line.split()
+    if len(words) == 4 and words[0] in _MOVEMENTS and words[2] == "LED":
+        motor, led = int(words[1]), int(words[3])
+        if not (0 <= motor <= MAX_VALUE and 0 <= led <= MAX_VALUE):
+            raise FrameError(f"durations over {MAX_VALUE} s do not fit a binary frame: {line}")
+        return _COMMAND.pack(OP_STEP, _MOVEMENTS[words[0]], motor, led)
+    if len(words) == 2 and words[0] == "PLAN":
+        return _COMMAND.pack(OP_PLAN, int(words[1]), 0, 0)
+    if len(words) == 2 and words[0] == "TELEMETRY":
+        return _COMMAND.pack(OP_TELEMETRY, 0, int(words[1]), 0)
+    if len(words) == 1 and words[0] in _CONTROLS:
+        return _COMMAND.pack(_CONTROLS[words[0]], 0, 0, 0)
+    raise FrameError(f"no binary form for command: {line}")
+
+
+def command_text(payload):
+    """Returns the text command line for a binary command payload"""
+    if len(payload) != COMMAND_SIZE:
+        raise FrameError("wrong command size")
+    op, arg, motor, led = _COMMAND.unpack(payload)
+    if op == OP_STEP:
+        return f"{_MOVEMENT_NAMES.get(arg, 'FORWARD')} {motor} LED {led}"
+    if op == OP_PLAN:
+        return f"PLAN {arg}"
+    if op == OP_TELEMETRY:
+        return f"TELEMETRY {motor}"
+    if op in _CONTROL_NAMES:
+        return _CONTROL_NAMES[op]
+    raise FrameError(f"unknown opcode {op:#x}")
+
+
+def event_payload(line):
+    """Returns the binary payload for a text event line"""
+    words = line.split()
+    if words[0] == "PAUSED" and len(words) == 3:
+        return _PAUSED.pack(EV_PAUSED, 0, int(words[1]), int(words[2]))
+    if words[0] == "T":
+        millis, flags, motor, led, step = (int(word) for word in words[1:6])
+        return _TELEMETRY.pack(EV_TELEMETRY, flags, millis, motor, led, step)
+    if line in _SIMPLE_EVENTS:
+        return _EVENT.pack(_SIMPLE_EVENTS[line], 0, 0)
+    if words[0] == "ACK":
+        if len(words) == 1:
+            return _EVENT.pack(EV_ACK, OP_STEP, 0)
+        if words[1] == "PLAN":
+            return _EVENT.pack(EV_ACK, OP_PLAN, int(words[2]))
+        if words[1] == "TELEMETRY":
+            return _EVENT.pack(EV_ACK, OP_TELEMETRY, int(words[2]))
+        return _EVENT.pack(EV_ACK, _CONTROLS[words[1]], 0)
+    if words[0] == "DONE":
+        return _EVENT.pack(EV_DONE, _CHANNELS[words[1]], 0)
+    if words[0] == "ERR":
+        return _EVENT.pack(EV_ERR, _ERRORS.get(" ".join(words[1:]), 0), 0)
+    if words[0] == "STEP":
+        return _EVENT.pack(EV_STEP, 0, int(words[1]))
+    if words[0] == "PLANNED":
+        return _EVENT.pack(EV_PLANNED, 0, int(words[1]))
+    raise FrameError(f"no binary form for event: {line}")
+
+
+def event_text(payload):
+    """Returns the text event line for a binary event payload"""
+    if len(payload) == PAUSED_SIZE and payload[0] == EV_PAUSED:
+        _, _, motor, led = _PAUSED.unpack(payload)
+        return f"PAUSED {motor} {led}"
+    if len(payload) == TELEMETRY_SIZE and payload[0] == EV_TELEMETRY:
+        _, flags, millis, motor, led, step = _TELEMETRY.unpack(payload)
+        return f"T {millis} {flags} {motor} {led} {step}"
+    if len(payload) != EVENT_SIZE:
+        raise FrameError("wrong event size")
+    event, code, value = _EVENT.unpack(payload)
+    if event in _SIMPLE_EVENT_NAMES:
+        return _SIMPLE_EVENT_NAMES[event]
+    if event == EV_ACK:
+        if code == OP_STEP:
+            return "ACK"
+        if code == OP_PLAN:
+            return f"ACK PLAN {value}"
+        if code == OP_TELEMETRY:
+            return f"ACK TELEMETRY {value}"
+        return f"ACK {_CONTROL_NAMES.get(code, code)}"
+    if event == EV_DONE:
+        return f"DONE {_CHANNEL_NAMES.get(code, code)}"
+    if event == EV_ERR:
+        name = _ERROR_NAMES.get(code, str(code))
+        return f"ERR {name}" if name else "ERR"
+    if event == EV_STEP:
+        return f"STEP {value}"
+    if event == EV_PLANNED:
+        return f"PLANNED {value}"
+    raise FrameError(f"unknown event {event:#x}")
+
+
+# -- Codecs used by the transport --
+
+class TextCodec:
+    """The original newline-terminated ASCII protocol"""
+
+    name = "text"
+    delimiter = b"\n"  # Ends every line, so it also ends whatever partial line came before it
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def encode(self, line):
+        return (line + "\n").encode()
+
+    def frames(self, plan):
+        return plan.frames
+
+    def upload(self, plan):
+        return plan.upload
+
+    def feed(self, data):
+        """Returns the complete lines in data, keeping any partial line for next time"""
+        self._buffer += data
+        lines, consumed = self.split(self._buffer, len(self._buffer))
+        del self._buffer[:consumed]
+        return lines
+
+    def split(self, buffer, length):
+        """Returns (lines, bytes consumed) for the complete lines in buffer[:length]
+
+        Each line is decoded straight out of buffer, without an intermediate copy.
+        """
+        lines = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(self.delimiter, start, length)
+                if end < 0:
+                    return lines, start
+                line = str(view[start:end], "utf-8", "replace").strip()
+                start = end + 1
+                if line:
+                    lines.append(line)
+
+
+class BinaryCodec:
+    """COBS/CRC16 frames; decodes device events back into their text lines"""
+
+    name = "binary"
+    delimiter = b"\x00"  # Ends every frame, so it also ends whatever partial frame came before it
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.errors = 0  # Corrupt frames dropped
+
+    def encode(self, line):
+        return encode_frame(command_payload(line))
+
+    def frames(self, plan):
+        if plan.binary_frames is None:
+            raise FrameError(f"protocol {plan.name} has steps too long for binary frames")
+        return plan.binary_frames
+
+    def upload(self, plan):
+        if plan.binary_upload is None:
+            raise FrameError(f"protocol {plan.name} has steps too long for binary frames")
+        return plan.binary_upload
+
+    def feed(self, data):
+        """Returns the events completed by data as text lines, dropping corrupt frames"""
+        self._buffer += data
+        lines, consumed = self.split(self._buffer, len(self._buffer))
+        del self._buffer[:consumed]
+        return lines
+
+    def split(self, buffer, length):
+        """Returns (lines, bytes consumed) for the complete frames in buffer[:length], decoded in place"""
+        lines = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(self.delimiter, start, length)
+                if end < 0:
+                    return lines, start
+                frame = view[start:end]
+                start = end + 1
+                if not frame:
+                    continue
+                try:
+                    lines.append(event_text(decode_frame(frame)))
+                except FrameError:
+                    self.errors += 1
@@ -0,0 +1,203 @@
+import json
+import math
+import os
+import time
+from collections import namedtuple
+from threading import Condition, Thread
+
+JOURNAL_DIR_ENV = "DESICURER_JOURNAL_DIR"  # Where run journals are kept, overriding the default
+PROGRESS_INTERVAL = 2.0  # Seconds between progress records while a step runs
+KEEP_FINISHED = 50  # Finished journals kept for reference; older ones are deleted
+
+# A run that was interrupted before it ended
+#   path       its journal file
+#   protocol   protocol name
+#   steps      the full step list
+#   index      step that was running when the journal stops
+#   elapsed    seconds that step had run for, pauses excluded
+UnfinishedRun = namedtuple("UnfinishedRun", "path protocol steps index elapsed")
+
+
+def default_journal_dir():
+    return os.environ.get(JOURNAL_DIR_ENV) or os.path.join(os.path.expanduser("~"), ".desicurer", "journal")
+
+
+class RunJournal:
+    """Append-only JSON-lines record of one protocol run
+
+    Records are queued in memory and written by a background thread, so the
+    run itself only appends to a list. The file is fsynced at every step
+    boundary, where one step's completion and the next one's dispatch are
+    recorded, and at the end; between boundaries progress records are written
+    but not synced, which survives an application crash, and a power cut loses
+    at most the progress since the last step started.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_journal_dir()
+        self.path = None
+        self._pending = []
+        self._sync = False
+        self._running = False  # A step is in progress, so progress records are due
+        self._closed = False
+        self._condition = Condition()
+        self._thread = None
+
+    def begin(self, protocol, steps, port=None):
+        """Start a new journal file for a run"""
+        os.makedirs(self.directory, exist_ok=True)
+        prune(self.directory)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(self.directory, f"run-{stamp}-{os.getpid()}.jsonl")
+        self._thread = Thread(target=self._write_loop, name="journal", daemon=True)
+        self._thread.start()
+        self._record("begin", sync=True, protocol=protocol, port=port, steps=[list(step) for step in steps])
+
+    def step(self, index):
+        """A step was dispatched"""
+        self._running = True
+        self._record("step", sync=True, index=index)
+
+    def complete(self, index):
+        """A step ran its full time; a resumed run starts after it"""
+        self._running = False
+        self._record("done", sync=True, index=index)
+
+    def pause(self):
+        self._running = False
+        self._record("pause", sync=True)
+
+    def resume(self):
+        self._running = True
+        self._record("resume", sync=True)
+
+    def end(self, status):
+        """Close the journal; status is 'completed' or 'stopped'. Runs that fail are left open to be resumed"""
+        self._running = False
+        self._record("end", sync=True, status=status)
+        self.close()
+
+    def close(self):
+        """Write out everything queued and stop the writer thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(2)
+            self._thread = None
+
+    def _record(self, event, sync=False, **fields):
+        fields["event"] = event
+        fields["t"] = time.time()  # Wall time, to carry elapsed time across a reboot
+        fields["mono"] = time.monotonic()
+        with self._condition:
+            self._pending.append(fields)
+            self._sync = self._sync or sync
+            self._condition.notify()
+
+    def _write_loop(self):
+        with open(self.path, "a") as f:
+            while True:
+                with self._condition:
+                    if not (self._pending or self._closed):
+                        self._condition.wait(PROGRESS_INTERVAL)
+                    if not self._pending and self._running and not self._closed:
+                        self._pending.append({"event": "progress", "t": time.time(), "mono": time.monotonic()})
+                    records, self._pending = self._pending, []
+                    sync, self._sync = self._sync, False
+                    closed = self._closed
+                if records:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+                    f.flush()  # Into the OS, which keeps it if the application dies
+                    if sync or closed:
+                        os.fsync(f.fileno())  # Onto the disk, which keeps it if the PC dies
+                if closed and not self._pending:
+                    return
+
+
+def read_journal(path):
+    """Returns the records of a journal, ignoring a torn last line"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # Written when the power went; nothing after it is trustworthy
+    return records
+
+
+def summarize(records):
+    """Returns (index, elapsed) for the last step of a journal's records"""
+    index, started, paused_at, held, last = None, None, None, 0.0, None
+    for record in records:
+        event = record["event"]
+        if event == "step":
+            index, started, paused_at, held = record["index"], record["t"], None, 0.0
+        elif event == "done":
+            index, started, paused_at, held = record["index"] + 1, None, None, 0.0
+        elif event == "pause" and paused_at is None:
+            paused_at = record["t"]
+        elif event == "resume" and paused_at is not None:
+            held += record["t"] - paused_at
+            paused_at = None
+        last = record["t"]
+    if started is None:
+        return index or 0, 0.0  # Nothing started, or between steps
+    end = paused_at if paused_at is not None else last
+    return index, max(end - started - held, 0.0)
+
+
+def find_unfinished(directory=None):
+    """Returns the most recent UnfinishedRun, or None if every journal ended"""
+    directory = directory or default_journal_dir()
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".jsonl"))
+    except OSError:
+        return None
+    for name in reversed(names):
+        path = os.path.join(directory, name)
+        records = read_journal(path)
+        if not records or records[0]["event"] != "begin":
+            continue
+        if records[-1]["event"] == "end":
+            return None  # The latest run finished; anything older was dealt with before it
+        index, elapsed = summarize(records)
+        steps = tuple(tuple(step) for step in records[0]["steps"])
+        if index >= len(steps):
+            return None  # Every step ran; only the end record was lost
+        return UnfinishedRun(path, records[0]["protocol"], steps, index, elapsed)
+    return None
+
+
+def resume_steps(run):
+    """Returns the steps left in an UnfinishedRun, the interrupted one shortened by the time it already ran
+
+    Durations are rounded up to whole seconds, since that is all the firmware takes;
+    the sample may get up to a second extra but never less than planned.
+    """
+    movement, motor, led = run.steps[run.index]
+    elapsed = math.floor(run.elapsed)
+    current = (movement, max(motor - elapsed, 0), max(led - elapsed, 0))
+    return (current,) + run.steps[run.index + 1:]
+
+
+def abandon(run):
+    """Mark an UnfinishedRun as dealt with, so it is not offered again"""
+    with open(run.path, "a") as f:
+        f.write(json.dumps({"event": "end", "status": "abandoned", "t": time.time(), "mono": time.monotonic()}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def prune(directory, keep=KEEP_FINISHED):
+    """Delete the oldest journals beyond keep"""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".jsonl"))
+    except OSError:
+        return
+    for name in names[:-keep] if len(names) > keep else ():
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
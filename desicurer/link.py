@@ -0,0 +1,95 @@
+import concurrent.futures
+
+from .commands import format_command
+from .loop import get_loop_thread
+from .runner import STOP_TIMEOUT, ProtocolRun
+from .transport import SerialTransport
+
+
+class SerialLink:
+    """Blocking wrapper around SerialTransport for threaded callers such as the Tk GUI
+
+    Every call is forwarded to the shared event loop, so any number of links share
+    one loop thread.
+    """
+
+    def __init__(self, port, baudrate=9600, settle_time=2, clock=None, binary_baud=None):
+        self.port = port
+        self.clock = clock
+        self.transport = SerialTransport(port, baudrate, settle_time, clock=clock, binary_baud=binary_baud)
+        self.run = None
+        self.telemetry = None  # TelemetryStream while the device is streaming samples
+        self._loop = get_loop_thread()
+
+    @property
+    def is_open(self):
+        return self.transport.is_open
+
+    def connect(self):
+        """Open the port and wait for the Arduino to come out of reset"""
+        self._loop.run(self.transport.connect())
+
+    def send(self, command):
+        """Write one command line to the device"""
+        self._loop.run(self.transport.send(command))
+
+    def send_command(self, movement, motor_duration, led_duration):
+        """Send one step to the device and return the command text"""
+        command = format_command(movement, motor_duration, led_duration)
+        self.send(command)
+        return command
+
+    def start_telemetry(self, interval=100, buffer=None):
+        """Stream a state sample every interval ms into a TelemetryBuffer; returns it, or None if unsupported"""
+        from .telemetry import TelemetryStream  # Deferred: pulls in NumPy
+        stream = TelemetryStream(self.transport, buffer)
+        if not self._loop.run(stream.start(interval)):
+            return None
+        self.telemetry = stream
+        return stream.buffer
+
+    def stop_telemetry(self):
+        if self.telemetry is not None:
+            self._loop.run(self.telemetry.stop())
+            self.telemetry = None
+
+    def subscribe(self, event, callback):
+        """Call callback(line) on the link's reader for every line whose first word is event, such as CONTINUE"""
+        self.transport.subscribe(event, callback)
+
+    def readline(self, timeout=None):
+        """Returns the next line from the device, or None on timeout"""
+        return self._loop.run(self.transport.readline(timeout))
+
+    def run_steps(self, steps, on_step=None, journal=None):
+        """Run a step list to the end; returns False if it was stopped"""
+        self.run = ProtocolRun(self.transport, steps, on_step, clock=self.clock, journal=journal)
+        try:
+            self._loop.run(self.run.run())
+        except concurrent.futures.CancelledError:
+            return False
+        return True
+
+    def pause(self):
+        if self.run is not None:
+            self._loop.call(self.run.pause)
+
+    def resume(self):
+        if self.run is not None:
+            self._loop.call(self.run.resume)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Abort the running protocol; returns once the device has been told, or after timeout"""
+        if self.run is not None:
+            try:
+                self._loop.run(self.run.abort(), timeout)
+            except concurrent.futures.TimeoutError:
+                pass
+
+    def close(self, timeout=STOP_TIMEOUT):
+        """Stop any running protocol and close the port, taking at most about twice timeout"""
+        self.stop(timeout)
+        try:
+            self._loop.run(self.transport.close(), timeout)
+        except concurrent.futures.TimeoutError:
+            pass
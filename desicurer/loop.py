@@ -0,0 +1,45 @@
+import asyncio
+from threading import Thread, Lock
+
+_shared = None
+_shared_lock = Lock()
+
+
+class LoopThread:
+    """One asyncio event loop running on a daemon thread, shared by all devices"""
+
+    def __init__(self, name="desicurer-loop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, callback, *args):
+        """Run a plain callback on the loop thread"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and block until it returns"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self, timeout=1):
+        """Stop the loop and wait for the thread to exit"""
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+def get_loop_thread():
+    """Returns the process-wide loop thread, starting it on first use"""
+    global _shared
+    with _shared_lock:
+        if _shared is None or not _shared.thread.is_alive():
+            _shared = LoopThread()
+        return _shared
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+from bisect import bisect_left
+
+METRICS_ENV = "DESICURER_METRICS"  # Set to 1 to record command metrics from start-up
+
+# Histogram bucket upper bounds in seconds, 10 us to 100 s in 1-2-5 steps
+BOUNDS = tuple(mantissa * 10.0 ** exponent for exponent in range(-5, 2) for mantissa in (1, 2, 5)) + (100.0,)
+
+# Stages of a command, each timed from the previous one except where noted
+#   encode     command text to bytes
+#   write      bytes handed to the serial port
+#   ack        written to the device's ACK
+#   complete   written to the device's DONE for the whole step
+#   late       how late the step started against the protocol's timeline
+STAGES = ("encode", "write", "ack", "complete", "late")
+
+
+class Histogram:
+    """Counts of observations in fixed buckets, allocated once"""
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)  # The last bucket is everything above BOUNDS[-1]
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile"""
+        if not self.count:
+            return None
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(BOUNDS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "counts": list(self.counts),
+        }
+
+
+class Metrics:
+    """Latency histograms per device, command and stage
+
+    Off by default; while disabled every hook is a single attribute check, and
+    while enabled an observation is a dict lookup and a bisect. Observations are
+    made on the event loop thread, so snapshots taken from other threads may be
+    a command behind but are never torn in a way that matters.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.time()
+        self._histograms = {}  # (port, command, stage) -> Histogram
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        self._histograms = {}
+        self.started = time.time()
+
+    def observe(self, port, command, stage, seconds):
+        key = (port, command, stage)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def sent(self, port, command, created, encoded):
+        """Record encoding and writing of a command; returns when it was written"""
+        written = time.perf_counter()
+        self.observe(port, command, "encode", encoded - created)
+        self.observe(port, command, "write", written - encoded)
+        return written
+
+    def snapshot(self):
+        """Returns {port: {command: {stage: histogram}}} as plain data"""
+        devices = {}
+        for (port, command, stage), histogram in list(self._histograms.items()):
+            devices.setdefault(port, {}).setdefault(command, {})[stage] = histogram.snapshot()
+        return {"started": self.started, "time": time.time(), "enabled": self.enabled,
+                "bounds": list(BOUNDS), "devices": devices}
+
+    def prometheus(self):
+        """Returns the histograms in the Prometheus text exposition format"""
+        lines = ["# HELP desicurer_command_seconds Time spent in each stage of a device command",
+                 "# TYPE desicurer_command_seconds histogram"]
+        for (port, command, stage), histogram in sorted(list(self._histograms.items())):
+            labels = f'port="{_escape(port)}",command="{_escape(command)}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(BOUNDS, histogram.counts):
+                cumulative += count
+                lines.append(f'desicurer_command_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+            lines.append(f'desicurer_command_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"desicurer_command_seconds_sum{{{labels}}} {histogram.sum:.9g}")
+            lines.append(f"desicurer_command_seconds_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """Write a snapshot to path, as JSON if it ends in .json and Prometheus text otherwise"""
+        text = json.dumps(self.snapshot(), indent=2) if path.endswith(".json") else self.prometheus()
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(text)
+        os.replace(temporary, path)  # A scraper never reads a half-written file
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Metrics(enabled=bool(os.environ.get(METRICS_ENV)))  # Shared by every transport and run
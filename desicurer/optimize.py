@@ -0,0 +1,106 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from .plans import PLAN_MAX_SECONDS, compile_steps, fits_step_table
+
+ROUND_TRIP = 0.1  # Typical wall seconds a streamed step boundary costs: DONE, the next write and its ACK
+
+# What optimize_steps() did to a step list
+#   steps           the optimized steps
+#   original        the steps as written
+#   commands_saved  step commands no longer sent
+#   bytes_saved     bytes no longer sent in a plan upload
+#   seconds_saved   estimated wall time saved when the steps are streamed
+#   uploadable      whether the optimized steps fit the firmware's step table
+Optimization = namedtuple("Optimization", "steps original commands_saved bytes_saved seconds_saved uploadable")
+
+
+def timeline(steps):
+    """Returns when the motor and the LED are on, as (motor, led) interval lists
+
+    motor holds (start, end, movement) and led holds (start, end), in seconds from
+    protocol start, with touching intervals joined. Every step restarts the LED,
+    so an LED timer longer than its step only runs past the end of the last step.
+    """
+    motor, led = [], []
+    start = 0
+    last = len(steps) - 1
+    for index, (movement, motor_duration, led_duration) in enumerate(steps):
+        end = start + motor_duration
+        if index < last:
+            led_duration = min(led_duration, motor_duration)
+        _extend(motor, (start, end, movement))
+        _extend(led, (start, start + led_duration))
+        start = end
+    return motor, led
+
+
+def _extend(intervals, interval):
+    start, end = interval[:2]
+    if end <= start:
+        return
+    if intervals and intervals[-1][1] == start and intervals[-1][2:] == interval[2:]:
+        intervals[-1] = (intervals[-1][0], end) + interval[2:]
+    else:
+        intervals.append(interval)
+
+
+def equivalent(steps, other):
+    """True if two step lists switch the motor and LED at the same times and last as long"""
+    return (timeline(steps) == timeline(other)
+            and sum(step[1] for step in steps) == sum(step[1] for step in other))
+
+
+def optimize_steps(steps, max_seconds=PLAN_MAX_SECONDS, round_trip=ROUND_TRIP):
+    """Returns an Optimization with adjacent steps merged and no-op steps dropped
+
+    A step joins the one before it when they turn the same way and the LED
+    either stays on across the boundary or stays off after it. Steps that run
+    neither the motor nor the LED are dropped. Merged durations never pass
+    max_seconds, so a plan the firmware could hold still fits its step table.
+    """
+    return _optimize(tuple(tuple(step) for step in steps), max_seconds, round_trip)
+
+
+@lru_cache(maxsize=64)
+def _optimize(steps, max_seconds, round_trip):
+    last = len(steps) - 1
+    optimized = []
+    for index, (movement, motor, led) in enumerate(steps):
+        if index < last:
+            led = min(led, motor)  # The next step restarts the LED anyway
+        if not (motor or led):
+            continue
+        step = (movement, motor, led)
+        merged = optimized and _merge(optimized[-1], step, max_seconds)
+        if merged:
+            optimized[-1] = merged
+        else:
+            optimized.append(step)
+    optimized = tuple(optimized) or ((steps[0][0], 0, 0),)  # A plan needs at least one step
+    if not equivalent(steps, optimized):
+        raise ValueError(f"optimizing changed the timeline of {steps}")
+    saved = len(steps) - len(optimized)
+    return Optimization(
+        optimized,
+        steps,
+        saved,
+        len(compile_steps(steps).upload) - len(compile_steps(optimized).upload),
+        saved * round_trip,
+        fits_step_table(optimized),
+    )
+
+
+def _merge(step, following, max_seconds):
+    """Returns step and the one after it as a single step, or None if they can't be joined"""
+    movement, motor, led = step
+    if following[0] != movement and following[1]:
+        return None  # An LED-only step has no direction to match
+    if led == motor:
+        led += following[2]  # The LED is on to the end of step, so it just runs on
+    elif following[2]:
+        return None  # The LED goes off inside step and comes back on at the boundary
+    motor += following[1]
+    if motor > max_seconds or led > max_seconds:
+        return None
+    return (movement, motor, led)
@@ -0,0 +1,58 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from .commands import encode_command, format_command
+from .framing import FrameError, command_payload, encode_frame
+from .schedule import step_offsets
+
+PLAN_MAX_STEPS = 32  # Size of the firmware's step table
+PLAN_MAX_SECONDS = 65535  # The step table stores durations as unsigned int seconds
+
+# A protocol compiled once for execution. Every field is a tuple, so a Plan can be
+# cached and shared between runs and threads.
+#   steps    (movement, motor duration, LED duration) per step
+#   commands command text per step, for status display
+#   frames   the exact bytes written to the port per step
+#   offsets  planned start of each step in seconds from protocol start
+#   duration planned length of the whole protocol in seconds
+#   upload   the step table and RUN, sent in one write once the firmware accepts PLAN <n>
+#   binary_frames, binary_upload
+#            the same in binary framing, or None if a step is too long for a frame
+Plan = namedtuple("Plan", "name steps commands frames offsets duration upload binary_frames binary_upload")
+
+
+@lru_cache(maxsize=64)
+def _compile(name, steps):
+    offsets, duration = step_offsets(steps)
+    frames = tuple(encode_command(*step) for step in steps)
+    commands = tuple(format_command(*step) for step in steps)
+    try:
+        binary_frames = tuple(encode_frame(command_payload(command)) for command in commands)
+        binary_upload = b"".join(binary_frames) + encode_frame(command_payload("RUN"))
+    except FrameError:
+        binary_frames = binary_upload = None
+    return Plan(
+        name,
+        steps,
+        commands,
+        frames,
+        tuple(offsets),
+        duration,
+        b"".join(frames) + b"RUN\n",
+        binary_frames,
+        binary_upload,
+    )
+
+
+def fits_step_table(steps):
+    """True if the firmware can hold the whole step list and run it on its own"""
+    if len(steps) > PLAN_MAX_STEPS:
+        return False
+    return all(motor <= PLAN_MAX_SECONDS and led <= PLAN_MAX_SECONDS for _, motor, led in steps)
+
+
+def compile_steps(steps, name=None):
+    """Returns the Plan for a step list; identical step lists share one Plan"""
+    if isinstance(steps, Plan):
+        return steps
+    return _compile(name, tuple(tuple(step) for step in steps))
@@ -0,0 +1,38 @@
+import os
+from collections import namedtuple
+
+EXTRA_PORTS_ENV = "DESICURER_PORTS"  # Extra ports to offer, e.g. a simulator's pseudo-terminal
+
+# What the OS knows about one serial port; vid/pid/serial_number/location are None
+# for ports that are not USB adapters
+PortInfo = namedtuple("PortInfo", "device vid pid serial_number location description")
+
+
+def get_port_infos():
+    """Returns a PortInfo for every available serial port"""
+    import serial.tools.list_ports  # Deferred so importing the package stays cheap
+    ports = [PortInfo(port.device, port.vid, port.pid, port.serial_number, port.location, port.description)
+             for port in serial.tools.list_ports.comports()]
+    devices = {port.device for port in ports}
+    for device in os.environ.get(EXTRA_PORTS_ENV, "").split(os.pathsep):
+        if device and device not in devices:
+            ports.append(PortInfo(device, None, None, None, None, "extra port"))
+    return ports
+
+
+def get_serial_ports():
+    """Returns a list of available serial ports"""
+    return [port.device for port in get_port_infos()]
+
+
+def fingerprint(port):
+    """Returns a key that identifies the adapter behind a PortInfo across reboots
+
+    USB adapters are known by VID:PID and serial number; clones without a serial
+    number fall back to the USB socket they are plugged into, anything else to
+    its device path.
+    """
+    if port.vid is None:
+        return port.device
+    ident = port.serial_number or f"@{port.location or port.device}"
+    return f"{port.vid:04x}:{port.pid:04x}:{ident}"
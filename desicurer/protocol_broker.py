@@ -0,0 +1,73 @@
+"""pyserial URL handler for broker://<port>, a device shared through a running SerialBroker
+
+desicurer.backends.open_port() registers it, after which serial.serial_for_url("broker://COM3")
+returns a port that receives every line the device sends and writes whole command lines.
+"""
+import socket
+
+from serial import SerialException
+from serial.urlhandler import protocol_socket
+
+from .backends import ATTACH_TIMEOUT, BROKER_SCHEME, broker_address
+
+
+class BrokerUnavailable(SerialException):
+    """Raised when no broker is listening"""
+
+
+class Serial(protocol_socket.Serial):
+    """A client connection to the broker, attached to one device"""
+
+    @property
+    def device(self):
+        return self.portstr[len(BROKER_SCHEME):]
+
+    def open(self):
+        self.logger = None
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        address = broker_address()
+        try:
+            if isinstance(address, str):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(ATTACH_TIMEOUT)
+                sock.connect(address)
+            else:
+                sock = socket.create_connection(address, timeout=ATTACH_TIMEOUT)
+        except OSError as e:
+            raise BrokerUnavailable(f"No broker at {address}: {e}") from None
+        try:
+            sock.sendall(f"ATTACH {self.device}\n".encode())
+            reply = _read_line(sock)
+        except OSError as e:
+            sock.close()
+            raise SerialException(f"{self.portstr}: {e}") from None
+        if reply != "ATTACHED":
+            sock.close()
+            raise SerialException(f"{self.portstr}: {reply or 'the broker closed the connection'}")
+        sock.setblocking(False)
+        self._socket = sock
+        self.is_open = True
+
+    def close(self):
+        """Close without the pause protocol_socket takes for servers that reconnect slowly"""
+        if self.is_open:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+            self.is_open = False
+
+
+def _read_line(sock):
+    """Returns the broker's reply, one byte at a time so nothing after it is consumed"""
+    data = bytearray()
+    while True:
+        byte = sock.recv(1)
+        if not byte or byte == b"\n":
+            return data.decode("utf-8", "replace").strip()
+        data += byte
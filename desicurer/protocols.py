@@ -0,0 +1,170 @@
+import json
+import os
+import sys
+
+from .optimize import optimize_steps
+from .plans import compile_steps
+
+# Protocol step lists: (movement, motor duration in seconds, LED duration in seconds)
+
+# Step 1: spin dark, then spin with the LED on
+STEP1 = (
+    ("FORWARD", 30, 0),
+    ("FORWARD", 30, 0),
+    ("FORWARD", 30, 0),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 0, 0)
+)
+
+# Step 2: run after the sample has been rotated by hand
+STEP2 = (
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 30),
+    ("FORWARD", 30, 0),
+    ("FORWARD", 30, 0),
+    ("FORWARD", 30, 0),
+    ("FORWARD", 0, 0)
+)
+
+# Built-in protocols, used when no protocol file is found
+PROTOCOLS = {
+    "step1": STEP1,
+    "step2": STEP2,
+}
+
+PROTOCOL_FILE_ENV = "DESICURER_PROTOCOLS"  # Path to a protocol file, overriding the search
+OPTIMIZE_ENV = "DESICURER_OPTIMIZE"  # Set to 0 to send every protocol exactly as written
+PROTOCOL_FILE_NAMES = ("protocols.json", "protocols.toml")
+MOVEMENTS = ("FORWARD", "BACKWARD")
+PROTOCOL_KEYS = {"title", "steps", "optimize"}
+STEP_KEYS = {"movement", "motor", "led", "repeat"}
+MAX_DURATION = 4294967  # Seconds; the firmware counts milliseconds in an unsigned long
+
+_cache = {}  # (path, optimize) -> (mtime_ns, size, {name: Plan})
+
+
+class ProtocolError(ValueError):
+    """Raised when a protocol file or step list is not valid"""
+
+
+def find_protocol_file():
+    """Returns the protocol file to use, or None to use the built-in protocols
+
+    Looked for in $DESICURER_PROTOCOLS, then next to the executable (or the script
+    when not frozen), then in the working directory, so recipes can be swapped
+    without rebuilding the exe.
+    """
+    path = os.environ.get(PROTOCOL_FILE_ENV)
+    if path:
+        return path
+    if getattr(sys, "frozen", False):
+        base = os.path.dirname(sys.executable)
+    else:
+        base = os.path.dirname(os.path.abspath(sys.argv[0] or "."))
+    for directory in (base, os.getcwd()):
+        for name in PROTOCOL_FILE_NAMES:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def validate_steps(steps, where="protocol"):
+    """Returns steps as a tuple of (movement, motor, led) tuples, expanding repeats"""
+    if not isinstance(steps, (list, tuple)) or not steps:
+        raise ProtocolError(f"{where}: steps must be a non-empty list")
+    result = []
+    for number, step in enumerate(steps, 1):
+        at = f"{where}, step {number}"
+        repeat = 1
+        if isinstance(step, dict):
+            unknown = set(step) - STEP_KEYS
+            if unknown:
+                raise ProtocolError(f"{at}: unknown keys {sorted(unknown)}")
+            repeat = step.get("repeat", 1)
+            step = (step.get("movement", "FORWARD"), step.get("motor"), step.get("led", 0))
+        if not isinstance(step, (list, tuple)) or len(step) != 3:
+            raise ProtocolError(f"{at}: expected [movement, motor, led]")
+        movement, motor, led = step
+        if movement not in MOVEMENTS:
+            raise ProtocolError(f"{at}: movement must be one of {', '.join(MOVEMENTS)}")
+        for label, value in (("motor", motor), ("led", led)):
+            # The firmware parses whole seconds only
+            if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= MAX_DURATION:
+                raise ProtocolError(f"{at}: {label} must be a whole number of seconds from 0 to {MAX_DURATION}")
+        if not isinstance(repeat, int) or isinstance(repeat, bool) or repeat < 1:
+            raise ProtocolError(f"{at}: repeat must be a positive whole number")
+        result.extend([(movement, motor, led)] * repeat)
+    return tuple(result)
+
+
+def prepare(steps, name=None, optimize=True):
+    """Returns the Plan for a valid step list, with redundant steps merged away unless optimize is false"""
+    if optimize and os.environ.get(OPTIMIZE_ENV, "1") != "0":
+        steps = optimize_steps(steps).steps
+    return compile_steps(steps, name)
+
+
+def parse_protocols(data, where="protocols", optimize=True):
+    """Returns {name: Plan} from the decoded contents of a protocol file
+
+    A protocol with "optimize": false keeps its steps exactly as written.
+    """
+    protocols = data.get("protocols") if isinstance(data, dict) else None
+    if not isinstance(protocols, dict) or not protocols:
+        raise ProtocolError(f"{where}: expected a 'protocols' table")
+    plans = {}
+    for name, body in protocols.items():
+        if isinstance(body, dict):
+            unknown = set(body) - PROTOCOL_KEYS
+            if unknown:
+                raise ProtocolError(f"{where}: {name}: unknown keys {sorted(unknown)}")
+        steps = body.get("steps") if isinstance(body, dict) else body
+        merge = body.get("optimize", True) if isinstance(body, dict) else True
+        if not isinstance(merge, bool):
+            raise ProtocolError(f"{where}: {name}: optimize must be true or false")
+        plans[name] = prepare(validate_steps(steps, f"{where}: {name}"), name, optimize and merge)
+    return plans
+
+
+def load_protocols(path, optimize=True):
+    """Returns {name: Plan} from a JSON or TOML file, reusing the last result until the file changes"""
+    stat = os.stat(path)
+    cached = _cache.get((path, optimize))
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        if path.endswith(".toml"):
+            import tomllib  # Python 3.11+
+            data = tomllib.loads(raw.decode("utf-8"))
+        else:
+            data = json.loads(raw)
+    except ValueError as e:
+        raise ProtocolError(f"{path}: {e}") from None
+    plans = parse_protocols(data, path, optimize)
+    _cache[(path, optimize)] = (stat.st_mtime_ns, stat.st_size, plans)
+    return plans
+
+
+def get_plans(optimize=True):
+    """Returns every available protocol as {name: Plan}; pass optimize=False for the steps as written"""
+    plans = {name: prepare(steps, name, optimize) for name, steps in PROTOCOLS.items()}
+    path = find_protocol_file()
+    if path:
+        plans.update(load_protocols(path, optimize))
+    return plans
+
+
+def get_protocol(name):
+    """Returns the compiled Plan for a named protocol"""
+    try:
+        return get_plans()[name]
+    except KeyError:
+        raise ValueError(f"Unknown protocol: {name}") from None
@@ -0,0 +1,313 @@
+import asyncio
+import json
+import time
+from collections import deque
+from itertools import islice
+
+from .capture import NOTE, RECEIVED, SENT, Capture, read_capture
+from .clock import ScaledClock, VirtualClock
+from .framing import FrameError, command_text, decode_frame
+from .runner import ProtocolRun
+from .transport import SerialTransport
+
+MATCH_WINDOW = 8  # Recorded writes looked through for one that comes out of order
+END_ALLOWANCE = 10  # Clock seconds a run may go on past the end of the capture before it is stopped
+REPLY_WAIT = 2  # Clock seconds a reply is held back for a write recorded before it that is not made
+RUN_WORDS = frozenset(("FORWARD", "BACKWARD", "PLAN", "RUN", "PAUSE", "RESUME", "ABORT"))  # Written by a run
+CONNECT_WORDS = frozenset(("BAUD", "PING"))  # Written by connect()
+REPORT_LIMIT = 20  # Mismatched writes listed in a report
+
+
+class ReplayPort:
+    """Stands in for the serial port; every write is checked against the capture"""
+
+    out_waiting = 0
+
+    def __init__(self, replay, baudrate):
+        self.replay = replay
+        self.baudrate = baudrate
+        self.is_open = True
+
+    def write(self, data):
+        self.replay.written(bytes(data))
+        return len(data)
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class ReplayTransport(SerialTransport):
+    """A SerialTransport whose device is a capture: recorded bytes arrive when they would have
+
+    Reads are timed on the replay's clock from when it made the write recorded
+    before them, not from the start of the capture, so a reply comes as soon
+    after its command as it did when recorded, whether the replay runs ahead of
+    the capture or behind it, and within the runner's deadline as it was then.
+    One whose write is never made arrives REPLY_WAIT after it was due.
+    """
+
+    def __init__(self, replay, capture, clock):
+        meta = capture.meta
+        super().__init__(meta.get("port", "replay"), meta.get("baudrate", 9600), meta.get("settle_time", 2),
+                         clock=clock, binary_baud=meta.get("binary_baud"))
+        self.replay = replay
+        self.origin = None  # Clock time of the start of the capture
+        self._incoming = []  # (record, number of writes recorded before it)
+        writes = 0
+        for record in capture.records:
+            if record.kind == SENT:
+                writes += 1
+            elif record.kind == RECEIVED:
+                self._incoming.append((record, writes))
+        self._next = 0
+        self._timer = None
+
+    async def _open_port(self):
+        self.origin = self.clock.monotonic()
+        return ReplayPort(self.replay, self.baudrate)
+
+    def _start_capture(self):
+        pass  # A replay is not recorded again
+
+    def _start_reader(self):
+        self._schedule()
+
+    def _stop_reader(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def wrote(self):
+        """The replay made or passed over a recorded write, which moves when the next read is due"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._schedule()
+
+    def _schedule(self):
+        if self._next < len(self._incoming):
+            record, writes = self._incoming[self._next]
+            shifts = self.replay.shifts
+            if writes > len(shifts):
+                when = record.time + (shifts[-1] if shifts else 0) + REPLY_WAIT  # wrote() brings it forward
+            else:
+                when = record.time + (shifts[writes - 1] if writes else 0)
+            self._timer = self.clock.call_at(self.origin + when, self._deliver)
+
+    def _deliver(self):
+        when = self._incoming[self._next][0].time
+        while self._next < len(self._incoming) and self._incoming[self._next][0].time == when:
+            self._feed(self._incoming[self._next][0].data)  # Everything read at once arrives at once
+            self._next += 1
+        self._schedule()
+
+
+class Replay:
+    """Feeds a capture back through the transport, the protocol runner and event dispatch
+
+    Bytes from the device arrive when they were recorded. Runs start, pause,
+    resume and stop when the capture's notes say the host did so, and other host
+    commands (telemetry, single steps) are sent again at their recorded times.
+    Every write is checked against the recorded one, and each run's outcome
+    against the recorded outcome. With speed None the replay runs on a
+    VirtualClock, as fast as possible; otherwise at speed times the original pace.
+    """
+
+    def __init__(self, capture, speed=None):
+        self.capture = capture if isinstance(capture, Capture) else read_capture(capture)
+        scale = self.capture.meta.get("scale", 1)  # Of the clock it was recorded on; field captures have none
+        self.clock = VirtualClock(allowance=scale) if speed is None else ScaledClock(speed)
+        self.transport = None
+        self.expected = deque(record for record in self.capture.records if record.kind == SENT)
+        self.matched = 0
+        self.offsets = []  # Replayed minus recorded time of every matched write
+        self.shifts = []  # The same for every recorded write made or passed over, in order
+        self.missing = []  # Recorded writes that were never made
+        self.unexpected = []  # Writes that were never recorded
+        self.runs = []  # Per run: protocol, steps, recorded and replayed outcome
+        self.presses = 0  # CONTINUE button events dispatched
+        self.steps = 0  # Steps started, as the GUI would show them
+        self.run = None
+        self.telemetry = None
+        self._task = None
+
+    def written(self, data):
+        """Match a write against the next recorded writes; ReplayPort calls this"""
+        now = self.clock.monotonic() - self.transport.origin
+        for index, record in enumerate(islice(self.expected, MATCH_WINDOW)):
+            if record.data == data:
+                for _ in range(index):
+                    self.missing.append(self.expected.popleft())  # Recorded before this one but never made
+                    self.shifts.append(self.shifts[-1] if self.shifts else 0.0)
+                self.expected.popleft()
+                self.matched += 1
+                self.offsets.append(now - record.time)
+                self.shifts.append(now - record.time)
+                self.transport.wrote()
+                return
+        self.unexpected.append((now, data))
+
+    async def replay(self):
+        """Run the whole capture; returns a report"""
+        clock = self.clock
+        self.transport = transport = ReplayTransport(self, self.capture, clock)
+        transport.subscribe("CONTINUE", self._pressed)
+        await transport.connect()
+        for when, action, value in self._actions():
+            await self._until(transport.origin + when)
+            await self._act(action, value)
+        await self._until(transport.origin + self.capture.duration)
+        if self._task is not None and not self._task.done():
+            await self._until(clock.monotonic() + END_ALLOWANCE)
+            if not self._task.done():
+                self.run.stop()
+                await asyncio.wait([self._task])
+        await transport.close()
+        self.missing.extend(self.expected)
+        self.expected.clear()
+        return self.report()
+
+    def report(self):
+        offsets = sorted(abs(offset) for offset in self.offsets)
+        return {
+            "capture": self.capture.path,
+            "port": self.capture.meta.get("port"),
+            "duration": self.capture.duration,
+            "records": len(self.capture.records),
+            "writes": self.matched + len(self.missing),
+            "matched": self.matched,
+            "missing": _listed([(record.time, record.data) for record in self.missing]),
+            "unexpected": _listed(self.unexpected),
+            "timing_ms": {
+                "median": offsets[len(offsets) // 2] * 1000 if offsets else None,
+                "max": offsets[-1] * 1000 if offsets else None,
+            },
+            "runs": self.runs,
+            "steps": self.steps,
+            "presses": self.presses,
+            "telemetry": len(self.telemetry.buffer) if self.telemetry is not None else 0,
+            "frame_errors": getattr(self.transport.codec, "errors", 0),
+            "overflows": self.transport.overflows,
+            "ok": not (self.missing or self.unexpected)
+                  and all(run["recorded"] in (None, run["replayed"]) for run in self.runs),
+        }
+
+    # -- Timeline --
+
+    def _actions(self):
+        """Returns (time, action, value) for everything the host did, in order"""
+        actions = []
+        binary = running = False
+        for record in self.capture.records:
+            if record.kind == NOTE:
+                note = json.loads(record.data)
+                event = note.get("event")
+                if event == "codec":
+                    binary = note.get("codec") == "binary"
+                elif event in ("run", "pause", "resume", "stop", "end"):
+                    running = event != "end" and (running or event == "run")
+                    actions.append((record.time, event, note))
+            elif record.kind == SENT:
+                command = _first_command(record.data, binary)
+                word = command.partition(" ")[0]
+                if word in CONNECT_WORDS or (running and word in RUN_WORDS):
+                    continue  # Made again by connect() or the run itself
+                if word == "TELEMETRY":
+                    actions.append((record.time, "telemetry", int(command.split()[1])))
+                else:
+                    actions.append((record.time, "send", record.data))
+        return actions
+
+    async def _until(self, when):
+        """Let the capture play up to clock time when, or until the current run ends"""
+        while True:
+            remaining = when - self.clock.monotonic()
+            if remaining <= 0:
+                return
+            task = self._task if self._task is not None and not self._task.done() else None
+            waiting = asyncio.shield(task) if task is not None else asyncio.get_running_loop().create_future()
+            try:
+                await self.clock.wait_for(waiting, remaining)
+            except asyncio.TimeoutError:
+                return
+            except (asyncio.CancelledError, Exception):
+                if task is None or not task.done():
+                    raise  # Not the run ending
+            if task is None:
+                return
+
+    async def _act(self, action, value):
+        if action == "run":
+            self.transport.uploads = value.get("uploads")  # What the transport had learned, or been told
+            self.run = ProtocolRun(self.transport, value["steps"], self._on_step, value.get("handshake"),
+                                   self.clock, value.get("upload"))
+            entry = {"protocol": value.get("protocol"), "steps": len(value["steps"]),
+                     "recorded": None, "replayed": None}
+            self.runs.append(entry)
+            self._task = asyncio.ensure_future(self.run.run())
+            self._task.add_done_callback(lambda task: entry.update(replayed=_outcome(task)))
+            await asyncio.sleep(0)  # Let it make its first write now, as it did when recorded
+        elif action == "end":
+            if self.runs:
+                self.runs[-1]["recorded"] = value.get("status")
+        elif action in ("pause", "resume", "stop"):
+            if self.run is not None:
+                getattr(self.run, action)()
+        elif action == "telemetry":
+            await self._telemetry(value)
+        else:
+            await self.transport.send(value)
+
+    async def _telemetry(self, interval):
+        try:
+            from .telemetry import TelemetryStream  # Pulls in NumPy
+        except ImportError:
+            await self.transport.send(f"TELEMETRY {interval}")
+            return
+        if self.telemetry is not None:
+            await self.telemetry.stop()
+            self.telemetry = None
+        if interval:
+            stream = TelemetryStream(self.transport)
+            if await stream.start(interval):
+                self.telemetry = stream
+
+    # -- What the GUI would see --
+
+    def _pressed(self, line):
+        self.presses += 1
+
+    def _on_step(self, index, command):
+        self.steps += 1
+
+
+def replay(path, speed=None):
+    """Replay a capture file on a fresh event loop; returns the report with the wall time it took"""
+    started = time.perf_counter()
+    report = asyncio.run(Replay(path, speed).replay())
+    report["elapsed"] = time.perf_counter() - started
+    return report
+
+
+def _first_command(data, binary=None):
+    """Returns the first command in a write as text, whichever codec it was in"""
+    if binary is None:
+        binary = b"\x00" in data
+    if binary:
+        try:
+            return command_text(decode_frame(data.lstrip(b"\x00").split(b"\x00", 1)[0]))
+        except FrameError:
+            return ""
+    return data.lstrip(b"\n").split(b"\n", 1)[0].decode("utf-8", "replace").strip()
+
+
+def _outcome(task):
+    if task.cancelled():
+        return "stopped"
+    return "failed" if task.exception() is not None else "completed"
+
+
+def _listed(writes):
+    return [[round(when, 6), _first_command(data)] for when, data in writes[:REPORT_LIMIT]]
@@ -0,0 +1,362 @@
+import asyncio
+import time
+
+from .clock import REAL_CLOCK
+from .metrics import METRICS
+from .plans import compile_steps, fits_step_table
+from .schedule import DeadlineScheduler
+
+ACK_TIMEOUT = 1.0  # Wall time the firmware gets to acknowledge a command
+DONE_MARGIN = 2.0  # Wall time allowed past a step's duration before DONE is overdue
+STOP_TIMEOUT = 1.0  # Wall time allowed for stopping a run and telling the device
+
+# First words of the lines the runner consumes; anything else (e.g. CONTINUE) is left for other readers
+EVENTS = ("ACK", "DONE", "ERR", "PLAN", "PLANNED", "STEP", "PAUSED", "RESUMED", "ABORTED")
+
+
+class StepError(Exception):
+    """Raised when the device rejects a step or fails to confirm it in time"""
+
+
+class ProtocolRun:
+    """One execution of a step list on a transport
+
+    If the firmware accepts an upload, the whole plan is sent in one transfer and
+    runs on the device's own millis() timing; the host only follows STEP events
+    and sends PAUSE/RESUME/ABORT. Otherwise steps are streamed: firmware that
+    answers ACK and DONE drives the run, each step being sent as soon as the
+    previous one reports DONE, and firmware that stays silent is detected on the
+    first step and the run falls back to monotonic deadlines.
+
+    Firmware that answers commands freezes the motor and LED as soon as it gets
+    PAUSE and finishes the interrupted step on RESUME; silent firmware can only
+    be held before its next step.
+
+    Must be driven from the event loop; use SerialLink for threaded callers.
+    """
+
+    def __init__(self, transport, steps, on_step=None, handshake=None, clock=None, upload=None, journal=None):
+        self.transport = transport
+        self.plan = compile_steps(steps)  # Accepts a Plan or a plain step list
+        self.steps = self.plan.steps
+        self.on_step = on_step  # Called with (index, command) after each step is sent
+        self.handshake = handshake  # True/False to force a mode, None to detect it
+        self.upload = upload  # False to always stream, None to upload when the firmware can
+        self.uploaded = False  # True once the device is running the plan itself
+        self.journal = journal  # Optional RunJournal recording progress for crash recovery
+        self.step = 0
+        self.clock = clock or REAL_CLOCK
+        self.offsets, self.duration = self.plan.offsets, self.plan.duration
+        self.scheduler = DeadlineScheduler(self.clock)
+        if handshake is None and transport.acked:
+            self.handshake = True  # This device has answered before, so silence means a dropped command
+        self.paused_time = 0.0  # Total time spent paused, in clock seconds
+        self.remaining = None  # (motor, LED) seconds the device had left at the last PAUSE
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._paused_at = None
+        self._frozen = False  # The device itself is paused, not just the host
+        self._pausing = False  # PAUSE sent and not yet answered
+        self._events = asyncio.Queue()
+        self._task = None
+        self._written = None  # When the last step or plan went out, while metrics are enabled
+
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+
+    @property
+    def records(self):
+        """Planned vs. actual start of every step sent so far"""
+        return self.scheduler.records
+
+    async def run(self):
+        """Run every step, uploaded to the device when possible, streamed otherwise"""
+        self._task = asyncio.current_task()
+        for event in EVENTS:
+            self.transport.subscribe(event, self._on_line)
+        journal = self.journal
+        if journal:
+            await self._journal(journal.begin, self.plan.name, self.steps, self.transport.port)
+        self._note("run", protocol=self.plan.name, steps=[list(step) for step in self.steps],
+                   upload=self.upload, handshake=self.handshake, uploads=getattr(self.transport, "uploads", None))
+        try:
+            if self.upload is not False and await self._upload():
+                await self._run_uploaded()
+            else:
+                await self._run_streamed()
+        except asyncio.CancelledError:
+            await self._abort()  # Don't leave the device spinning
+            self._note("end", status="stopped")
+            if journal:
+                await self._journal(journal.end, "stopped")
+            raise
+        except BaseException as e:
+            await self._abort()  # A failed run must not leave the motor and LED on either
+            self._note("end", status="failed", error=str(e))
+            if journal:
+                await self._journal(journal.close)  # Left unfinished, so the run can be resumed
+            raise
+        finally:
+            for event in EVENTS:
+                self.transport.unsubscribe(event, self._on_line)
+        self.step = len(self.steps)
+        self._note("end", status="completed")
+        if journal:
+            await self._journal(journal.end, "completed")
+
+    def pause(self):
+        """Freeze the run where it is, or hold it before the next step on silent firmware"""
+        if not self._resume.is_set():
+            return
+        self._paused_at = self.clock.monotonic()
+        self._resume.clear()
+        self._note("pause")
+        if (self.uploaded or self.handshake) and getattr(self.transport, "pauses", None) is not False:
+            self._frozen = self._pausing = True
+            self._send_control("PAUSE")
+            if self.journal:
+                self.journal.pause()
+
+    def resume(self):
+        """Let a paused run continue from exactly where it stopped"""
+        if self._resume.is_set():
+            return
+        self._note("resume")
+        self._pausing = False
+        if self._frozen:
+            self._frozen = False
+            self._send_control("RESUME")
+            self._held(self.clock.monotonic() - self._paused_at)  # The whole step was frozen
+            if self.journal:
+                self.journal.resume()
+        self._resume.set()
+
+    def _held(self, seconds):
+        self.scheduler.shift(seconds)  # Later steps keep their spacing
+        self.paused_time += seconds
+
+    def stop(self):
+        """Cancel the run; run() sends ABORT and raises CancelledError"""
+        if self._task is not None and not self._task.done():
+            self._note("stop")
+            self._task.cancel()
+
+    async def abort(self):
+        """Cancel the run and wait until the device has been told to stop"""
+        task = self._task
+        self.stop()
+        if task is not None and not task.done():
+            await asyncio.wait([task])
+
+    async def _abort(self):
+        if not getattr(self.transport, "is_open", True):
+            return  # The port is gone, and the device with it
+        try:
+            await self.transport.send("ABORT")  # Stops the motor and LED at once
+        except (OSError, ValueError):
+            pass  # Nothing more can be done from here
+
+    # -- Streaming --
+
+    async def _run_streamed(self):
+        scheduler = self.scheduler
+        commands, frames = self.plan.commands, self.transport.codec.frames(self.plan)
+        scheduler.begin()
+        for index, step in enumerate(self.steps):
+            if not self.handshake:
+                await scheduler.wait_until(self.offsets[index])
+                self._completed(index - 1)
+            if not self._resume.is_set():
+                await self._wait_paused()
+            self.step = index
+            command = commands[index]
+            self._drain_events()
+            await self._send(frames[index], step[0])
+            self._started(index)
+            await self._confirm(frames[index], command)
+            if self.handshake:
+                await self._wait_done(step)
+                self._measure("complete", step[0])
+                self._completed(index)
+        if not self.handshake:
+            await scheduler.wait_until(self.duration)
+            self._completed(len(self.steps) - 1)
+
+    async def _wait_paused(self):
+        frozen = self._frozen  # resume() accounts for a frozen device itself
+        held_from = self.clock.monotonic()
+        await self._resume.wait()
+        if not frozen or getattr(self.transport, "pauses", None) is False:  # Or it refused PAUSE while we waited
+            self._held(self.clock.monotonic() - held_from)  # Only the time spent waiting here
+
+    # -- Upload --
+
+    def _can_upload(self):
+        return self.transport.uploads is not False and fits_step_table(self.steps)
+
+    async def _upload(self):
+        """Offer the plan to the firmware; returns False if it must be streamed instead"""
+        if not self._can_upload():
+            return False
+        self._drain_events()
+        await self._send(f"PLAN {len(self.steps)}", "PLAN")
+        try:
+            await self._wait_event(("ACK PLAN",), self.clock.monotonic() + self.clock.from_real(ACK_TIMEOUT))
+            self._measure("ack", "PLAN")
+        except asyncio.TimeoutError:
+            self.transport.uploads = False  # Firmware without a step table; don't ask again
+            return False
+        except StepError:
+            self.transport.uploads = False
+            self.transport.acked = True  # It rejected PLAN, so it does answer commands
+            return False
+        self.transport.uploads = self.transport.acked = True
+        upload = self.transport.codec.upload(self.plan)
+        transfer = len(upload) * 10 / getattr(self.transport, "baudrate", 9600)  # 10 bits per byte on the wire
+        await self._send(upload, "UPLOAD")
+        await self._wait_event(("ACK RUN",), self.clock.monotonic() + self.clock.from_real(ACK_TIMEOUT + transfer))
+        self._measure("ack", "UPLOAD")
+        self.uploaded = True
+        return True
+
+    async def _run_uploaded(self):
+        """Follow the device through the plan it is running on its own"""
+        scheduler = self.scheduler
+        scheduler.begin()
+        self.step = -1
+        while True:
+            event = await self._wait_uploaded_event()
+            self._completed(self.step)  # STEP n and PLAN DONE both end the step before
+            if event == "PLAN DONE":
+                return
+            index = int(event.split()[1])
+            self.step = index
+            self._started(index)
+
+    async def _wait_uploaded_event(self):
+        while True:
+            deadline = self.scheduler.deadline(self._next_offset()) + self.clock.from_real(DONE_MARGIN)
+            try:
+                return await self._wait_event(("STEP ", "PLAN DONE"), deadline)
+            except asyncio.TimeoutError:
+                if not self._resume.is_set():
+                    await self._resume.wait()  # The device is holding; no deadline while paused
+                    continue
+                raise StepError(f"{self.transport.port}: no progress from the device after step {self.step + 1}") from None
+
+    def _started(self, index):
+        """Account for a step the device has just started"""
+        command = self.plan.commands[index]
+        record = self.scheduler.record(index, command, self.offsets[index])
+        if METRICS.enabled:
+            late = (record.actual - record.planned) / getattr(self.clock, "scale", 1)  # In wall seconds, like the rest
+            METRICS.observe(self.transport.port, self.steps[index][0], "late", late)
+        if self.journal:
+            self.journal.step(index)
+        if self.on_step:
+            self.on_step(index, command)
+
+    def _completed(self, index):
+        """Account for a step that has run its full time"""
+        if self.journal and index >= 0:
+            self.journal.complete(index)
+
+    async def _journal(self, call, *args):
+        """Call journal.begin, end or close off the event loop; they touch the disk or wait for an fsync"""
+        await asyncio.get_running_loop().run_in_executor(None, call, *args)
+
+    def _note(self, event, **fields):
+        """Mark what the host did in the connection's capture, if it is being recorded"""
+        recorder = getattr(self.transport, "recorder", None)  # The loopback transport is never captured
+        if recorder is not None:
+            recorder.note(event, **fields)
+
+    async def _send(self, command, kind):
+        await self.transport.send(command, kind)
+        self._written = getattr(self.transport, "written", None)  # Later PAUSE/RESUME writes don't move it
+
+    def _measure(self, stage, kind):
+        """Record the time since the last step or plan was written as a stage of the command kind"""
+        if METRICS.enabled and self._written:
+            METRICS.observe(self.transport.port, kind, stage, time.perf_counter() - self._written)
+
+    def _next_offset(self):
+        """Returns when the step after the current one is due to start"""
+        following = self.step + 1
+        return self.offsets[following] if following < len(self.offsets) else self.duration
+
+    def _send_control(self, command):
+        asyncio.get_running_loop().create_task(self.transport.send(command))
+
+    # -- Handshake --
+
+    def _on_line(self, line):
+        if line.startswith("PAUSED "):
+            motor, led = line.split()[1:3]
+            self.remaining = (int(motor) / 1000, int(led) / 1000)
+            self.transport.pauses = True
+            self._pausing = False
+            return
+        if self._pausing and line.startswith("ERR"):
+            self._unfreeze()  # Firmware without PAUSE, e.g. the old button sketch
+            return
+        self._events.put_nowait(line)
+
+    def _unfreeze(self):
+        """The device refused PAUSE: hold the run before its next step instead"""
+        self.transport.pauses = False  # Don't ask again
+        self._pausing = self._frozen = False
+        if self.journal:
+            self.journal.resume()  # The step carries on, so the journal must not count it as held
+
+    def _drain_events(self):
+        while not self._events.empty():
+            self._events.get_nowait()
+
+    async def _wait_event(self, wanted, deadline):
+        """Returns the first event starting with one of wanted, skipping others; raises TimeoutError at deadline"""
+        while True:
+            event = await self.clock.wait_for(self._events.get(), max(deadline - self.clock.monotonic(), 0))
+            task = asyncio.current_task()
+            if getattr(task, "cancelling", None) and task.cancelling():
+                raise asyncio.CancelledError  # wait_for before 3.12 drops a cancel that lands as an event arrives
+            if event.startswith("ERR"):
+                raise StepError(f"{self.transport.port}: device rejected step {self.step + 1} ({event})")
+            if event.startswith(wanted):
+                return event
+
+    async def _confirm(self, frame, command):
+        """Wait for the ACK, resending once if a handshaking device missed the command"""
+        if self.handshake is False:
+            return
+        try:
+            await self._wait_event(("ACK",), self.clock.monotonic() + self.clock.from_real(ACK_TIMEOUT))
+            self.handshake = self.transport.acked = True
+            self._measure("ack", self.steps[self.step][0])
+            return
+        except asyncio.TimeoutError:
+            if self.handshake is None:
+                self.handshake = False  # Legacy firmware: fall back to timed steps
+                return
+        await self._send(frame, self.steps[self.step][0])
+        try:
+            await self._wait_event(("ACK",), self.clock.monotonic() + self.clock.from_real(ACK_TIMEOUT))
+        except asyncio.TimeoutError:
+            raise StepError(f"{self.transport.port}: no ACK for '{command}'") from None
+
+    async def _wait_done(self, step):
+        """Wait for every channel that ends within this step to report DONE"""
+        movement, motor_duration, led_duration = step
+        pending = {"DONE MOTOR"}
+        if led_duration <= motor_duration:
+            pending.add("DONE LED")
+        deadline = self.clock.monotonic() + motor_duration + self.clock.from_real(DONE_MARGIN) - self.paused_time
+        while pending:
+            try:
+                pending.discard(await self._wait_event(tuple(pending), deadline + self.paused_time))
+            except asyncio.TimeoutError:
+                if not self._resume.is_set():
+                    await self._resume.wait()  # The device is frozen; no deadline while paused
+                elif self.clock.monotonic() >= deadline + self.paused_time:
+                    raise StepError(f"{self.transport.port}: step {self.step + 1} did not finish in time") from None
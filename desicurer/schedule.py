@@ -0,0 +1,68 @@
+from collections import namedtuple
+
+from .clock import REAL_CLOCK
+
+# Planned and actual start of one step, in seconds from the start of the protocol
+StepRecord = namedtuple("StepRecord", "index command planned actual")
+
+MAX_LEAD = 0.05  # Never wake more than this early to make up for timer lateness
+
+
+def step_offsets(steps):
+    """Returns the planned start of every step and the planned end, in seconds from protocol start"""
+    offsets = []
+    elapsed = 0
+    for movement, motor_duration, led_duration in steps:
+        offsets.append(elapsed)
+        elapsed += motor_duration
+    return offsets, elapsed
+
+
+class DeadlineScheduler:
+    """Wakes a protocol at absolute monotonic deadlines fixed when the protocol starts
+
+    Each wait targets start + offset, so send latency and timer lateness of one step
+    never push back the steps after it. Lateness seen on earlier wake-ups is learned
+    and the next wake-up is brought forward by that much.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or REAL_CLOCK
+        self.start = None
+        self.shifted = 0  # Time spent paused, added to every deadline
+        self.lead = 0  # Learned wake-up lateness
+        self.records = []
+
+    def begin(self):
+        """Fix the protocol start; all deadlines are measured from here"""
+        self.start = self.clock.monotonic()
+        self.shifted = 0
+        self.records = []
+
+    def deadline(self, offset):
+        """Returns the monotonic time a step planned at offset should start"""
+        return self.start + self.shifted + offset
+
+    def shift(self, seconds):
+        """Push every later deadline back, e.g. by the time spent paused"""
+        self.shifted += seconds
+
+    def elapsed(self):
+        """Returns seconds since the protocol start, not counting time spent paused"""
+        return self.clock.monotonic() - self.start - self.shifted
+
+    async def wait_until(self, offset):
+        """Sleep until the deadline for offset, allowing for learned lateness"""
+        deadline = self.deadline(offset)
+        delay = deadline - self.clock.monotonic() - self.lead
+        if delay > 0:
+            await self.clock.asleep(delay)
+        late = self.clock.monotonic() - deadline
+        if delay > 0:
+            self.lead = min(max(self.lead + 0.5 * late, 0), MAX_LEAD)  # Smoothed so one stall does not overcorrect
+
+    def record(self, index, command, offset):
+        """Note that a step planned at offset has just started"""
+        record = StepRecord(index, command, offset, self.elapsed())
+        self.records.append(record)
+        return record
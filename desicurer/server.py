@@ -0,0 +1,437 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+
+from .engine import DISCONNECTED, ERROR, IDLE, PAUSED, RUNNING, Engine, InvalidTransition
+from .loop import LoopThread
+from .metrics import METRICS
+from .protocols import get_protocol
+
+DEFAULT_PORT = 8765
+EVENT_BACKLOG = 1000  # Events queued for one /events client before it is dropped as too slow
+KEEPALIVE = 15  # Seconds between comments on an idle /events stream, so proxies keep it open
+MAX_BODY = 64 * 1024
+
+# Job states
+QUEUED = "queued"
+STARTING = "starting"  # Waiting for the port to open
+ACTIVE = "running"
+COMPLETED = "completed"
+ABORTED = "aborted"
+FAILED = "failed"
+CANCELLED = "cancelled"  # Removed from the queue before it started
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    """One protocol queued or run on one device"""
+
+    __slots__ = ("id", "port", "protocol", "state", "message", "submitted", "started", "finished")
+
+    def __init__(self, id, port, protocol):
+        self.id = id
+        self.port = port
+        self.protocol = protocol
+        self.state = QUEUED
+        self.message = ""
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ControlServer:
+    """Local HTTP API for starting and watching protocols from another machine or a dashboard
+
+    Runs on its own event loop thread, so parsing requests and streaming events
+    never delays the loop that times the protocols; the only thing it takes from
+    the engine is a status snapshot. Each device has a queue of jobs that start
+    one after another. Pass path to listen on a Unix socket instead of TCP.
+
+        GET    /status               devices and jobs
+        GET    /jobs, /jobs/<id>
+        POST   /jobs                 {"port": ..., "protocol": ...}
+        DELETE /jobs/<id>            cancel a queued job, or abort it if it is running
+        POST   /pause, /resume       {"port": ...}
+        POST   /abort                {"port": ...}; also cancels the jobs queued behind it
+        GET    /events               Server-Sent Events: "device", "job" and "batch" updates
+        GET    /metrics              command latency histograms, Prometheus text; /metrics.json as JSON
+        POST   /metrics              {"enabled": true | false, "reset": true | false}
+        POST   /batch                {"samples": n, "ports": [...]}, optional "step1", "step2" and
+                                     handling seconds "load", "rotate", "unload"
+        GET    /batch                the operator's upcoming actions
+        POST   /batch/done           {"port": ..., "action": "load" | "rotate" | "unload"}; starts
+                                     the protocol that follows a load or rotation
+    """
+
+    def __init__(self, engine=None, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+        self.engine = engine or Engine()
+        self.engine.on_update = self._engine_updated  # The server takes over the engine's update hook
+        self.host = host
+        self.port = port
+        self.path = path
+        self.address = None  # Where the server listens, once started
+        self.jobs = {}  # id -> Job
+        self._queues = {}  # port -> deque of queued Jobs
+        self._active = {}  # port -> Job starting or running
+        self._states = {}  # port -> last device state seen
+        self.batch = None  # BatchScheduler for the batch in progress
+        self._batch_protocols = {}  # Action kind -> protocol it starts
+        self._ids = itertools.count(1)
+        self._subscribers = set()
+        self._writers = set()
+        self._status_body = None  # Cached /status response, dropped on every change
+        self._thread = None
+        self._server = None
+
+    @property
+    def loop(self):
+        return self._thread.loop
+
+    def start(self):
+        """Start listening; returns once the socket is bound"""
+        self._thread = LoopThread("desicurer-api")
+        self._thread.run(self._listen())
+        return self
+
+    def stop(self):
+        """Stop listening and close every client; protocols keep running"""
+        if self._thread is not None:
+            self._thread.run(self._shutdown())
+            self._thread.stop()
+            self._thread = None
+
+    async def _listen(self):
+        if self.path:
+            self._server = await asyncio.start_unix_server(self._client, self.path)
+            self.address = self.path
+        else:
+            self._server = await asyncio.start_server(self._client, self.host, self.port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+
+    async def _shutdown(self):
+        self._server.close()
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+        for writer in list(self._writers):
+            writer.close()
+        try:
+            await asyncio.wait_for(self._server.wait_closed(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+    # -- Jobs, on the API loop only --
+
+    def submit(self, port, protocol):
+        get_protocol(protocol)  # Refuse unknown protocols now rather than when the job comes up
+        job = Job(next(self._ids), port, protocol)
+        self.jobs[job.id] = job
+        self._queues.setdefault(port, deque()).append(job)
+        self._publish("job", job.snapshot())
+        self._pump(port)
+        return job
+
+    async def cancel(self, job):
+        if job.state == QUEUED:
+            self._queues[job.port].remove(job)
+            self._finish(job, CANCELLED, "Removed from the queue")
+        elif job.state == STARTING:
+            self._finish(job, CANCELLED, "Cancelled while connecting", release=False)  # _launch frees the port
+        elif job.state == ACTIVE:
+            await self._call(self.engine.stop, job.port)  # _engine_updated finishes the job
+
+    async def abort(self, port):
+        for job in list(self._queues.get(port, ())):
+            await self.cancel(job)
+        await self._call(self.engine.stop, port)
+
+    def plan_batch(self, samples, ports, step1="step1", step2="step2", **handling):
+        from .batch import LOAD, ROTATE, BatchScheduler
+        self.batch = BatchScheduler(samples, ports, get_protocol(step1).duration, get_protocol(step2).duration,
+                                    **handling)
+        self._batch_protocols = {LOAD: step1, ROTATE: step2}
+        self._publish("batch", self.batch.snapshot())
+        return self.batch
+
+    def batch_done(self, port, kind):
+        """The operator did kind on a station: replan and start the protocol that follows it"""
+        self.batch.done(port, kind)
+        if kind in self._batch_protocols:
+            self.submit(port, self._batch_protocols[kind])
+        self._publish("batch", self.batch.snapshot())
+
+    def _pump(self, port):
+        queue = self._queues.get(port)
+        if queue and port not in self._active:
+            job = queue.popleft()
+            self._active[port] = job
+            job.state = STARTING
+            self._publish("job", job.snapshot())
+            self.loop.create_task(self._launch(job))
+
+    async def _launch(self, job):
+        try:
+            device = self.engine.status().get(job.port)
+            if device is None or device["state"] in (DISCONNECTED, ERROR):
+                device = (await self._call(self.engine.open_all, [job.port]))[job.port]
+                if device["state"] != IDLE and job.state == STARTING:
+                    self._finish(job, FAILED, device["message"])
+                    return
+            if job.state != STARTING:
+                self._release(job)  # Cancelled while the port was opening; the next job may have it now
+                return
+            job.state = ACTIVE
+            job.started = time.time()
+            self._publish("job", job.snapshot())
+            await self._call(self.engine.start, job.protocol, [job.port])
+        except (InvalidTransition, ValueError, OSError) as e:
+            self._finish(job, FAILED, str(e))
+
+    def _finish(self, job, state, message="", release=True):
+        job.state = state
+        job.message = message
+        job.finished = time.time()
+        self._publish("job", job.snapshot())
+        if release:
+            self._release(job)
+
+    def _release(self, job):
+        """Let the next job queued for the port start"""
+        if self._active.get(job.port) is job:
+            del self._active[job.port]
+        self._pump(job.port)
+
+    def _engine_updated(self, device):
+        """Called on the engine's loop; hands the update to the API loop"""
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self._device_updated, device)
+
+    def _device_updated(self, device):
+        port = device["port"]
+        previous = self._states.get(port)
+        self._states[port] = device["state"]
+        self._publish("device", device)
+        job = self._active.get(port)
+        if job is None or previous not in (RUNNING, PAUSED) or device["state"] in (RUNNING, PAUSED):
+            return
+        if device["state"] == ERROR:
+            self._finish(job, FAILED, device["message"])
+        elif device["state"] == IDLE and device["step"] == device["steps"]:
+            self._finish(job, COMPLETED, device["message"])
+            if self.batch is not None and port in (station.name for station in self.batch.stations):
+                self.batch.step_finished(port)
+                self._publish("batch", self.batch.snapshot())
+        else:
+            self._finish(job, ABORTED, device["message"] or "Stopped")
+
+    async def _call(self, function, *args):
+        """Run a blocking engine call without holding up the API loop"""
+        return await self.loop.run_in_executor(None, function, *args)
+
+    # -- Events --
+
+    def _publish(self, kind, data):
+        self._status_body = None
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait((kind, data))
+            except asyncio.QueueFull:
+                self._subscribers.discard(queue)  # Too slow to keep up; it can reconnect
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _status(self):
+        if self._status_body is None:
+            self._status_body = json.dumps({"devices": self.engine.status(),
+                                            "jobs": [job.snapshot() for job in self.jobs.values()]}).encode()
+        return self._status_body
+
+    async def _stream(self, writer):
+        queue = asyncio.Queue(EVENT_BACKLOG)
+        self._subscribers.add(queue)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\nevent: status\ndata: " + self._status() + b"\n\n")
+        try:
+            while True:
+                await writer.drain()
+                try:
+                    item = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                    continue
+                if item is None:
+                    return
+                kind, data = item
+                writer.write(f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode())
+        finally:
+            self._subscribers.discard(queue)
+
+    # -- HTTP --
+
+    async def _client(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HttpError as e:
+                    self._respond(writer, e.status, {"error": str(e)}, False)
+                    break
+                if request is None:
+                    break
+                method, path, body, keep = request
+                if method == "GET" and path == "/events":
+                    await self._stream(writer)
+                    break
+                try:
+                    status, payload = await self._route(method, path, body)
+                except HttpError as e:
+                    status, payload = e.status, {"error": str(e)}
+                self._respond(writer, status, payload, keep)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Returns (method, path, body, keep_alive), or None when the client has gone"""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            raise HttpError(400, "Malformed request line") from None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HttpError(400, "Malformed Content-Length") from None
+        if length < 0:
+            raise HttpError(400, "Malformed Content-Length")
+        if length > MAX_BODY:
+            raise HttpError(413, "Request body too large")
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                raise HttpError(400, "Body is not valid JSON") from None
+            if not isinstance(body, dict):
+                raise HttpError(400, "Body must be a JSON object")
+        keep = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        return method, target.split("?", 1)[0], body, keep
+
+    async def _route(self, method, path, body):
+        if path == "/status":
+            self._allow(method, "GET")
+            return 200, self._status()
+        if path == "/jobs":
+            if method == "GET":
+                return 200, [job.snapshot() for job in self.jobs.values()]
+            self._allow(method, "POST")
+            try:
+                job = self.submit(self._port(body), body.get("protocol"))
+            except ValueError as e:
+                raise HttpError(400, str(e)) from None
+            return 201, job.snapshot()
+        if path.startswith("/jobs/"):
+            job = self.jobs.get(int(path[6:])) if path[6:].isdigit() else None
+            if job is None:
+                raise HttpError(404, "No such job")
+            if method == "DELETE":
+                await self.cancel(job)
+            else:
+                self._allow(method, "GET")
+            return 200, job.snapshot()
+        if path in ("/metrics", "/metrics.json"):
+            if method == "POST":
+                if "enabled" in body:
+                    METRICS.enable(bool(body["enabled"]))
+                if body.get("reset"):
+                    METRICS.reset()
+                return 200, {"enabled": METRICS.enabled}
+            self._allow(method, "GET")
+            return 200, METRICS.snapshot() if path.endswith(".json") else METRICS.prometheus()
+        if path == "/batch":
+            if method == "GET":
+                if self.batch is None:
+                    raise HttpError(404, "No batch planned")
+                return 200, self.batch.snapshot()
+            self._allow(method, "POST")
+            options = {key: body[key] for key in ("step1", "step2", "load", "rotate", "unload") if key in body}
+            ports = body.get("ports")
+            if not isinstance(body.get("samples"), int) or not isinstance(ports, list) or not ports:
+                raise HttpError(400, "samples and a list of ports are required")
+            try:
+                return 201, self.plan_batch(body["samples"], ports, **options).snapshot()
+            except (ValueError, TypeError) as e:
+                raise HttpError(400, str(e)) from None
+        if path == "/batch/done":
+            self._allow(method, "POST")
+            if self.batch is None:
+                raise HttpError(404, "No batch planned")
+            try:
+                self.batch_done(self._port(body), body.get("action"))
+            except (KeyError, ValueError) as e:
+                raise HttpError(409, f"Not a station of this batch: {e}" if isinstance(e, KeyError) else str(e)) from None
+            return 200, self.batch.snapshot()
+        actions = {"/pause": self.engine.pause, "/resume": self.engine.resume}
+        if path in actions or path == "/abort":
+            self._allow(method, "POST")
+            port = self._port(body)
+            if port not in self.engine.devices:
+                raise HttpError(404, f"{port} is not connected")
+            try:
+                if path == "/abort":
+                    await self.abort(port)
+                else:
+                    await self._call(actions[path], port)
+            except InvalidTransition as e:
+                raise HttpError(409, str(e)) from None
+            return 200, self.engine.status()[port]
+        raise HttpError(404, "No such endpoint")
+
+    @staticmethod
+    def _allow(method, allowed):
+        if method != allowed:
+            raise HttpError(405, f"Use {allowed}")
+
+    @staticmethod
+    def _port(body):
+        port = body.get("port") if isinstance(body, dict) else None
+        if not isinstance(port, str) or not port:
+            raise HttpError(400, "A port is required")
+        return port
+
+    @staticmethod
+    def _respond(writer, status, payload, keep):
+        content_type = "application/json"
+        if isinstance(payload, str):
+            payload, content_type = payload.encode(), "text/plain; version=0.0.4"  # Prometheus text
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep else 'close'}\r\n\r\n"
+                     .encode() + body)
@@ -0,0 +1,477 @@
+import asyncio
+import os
+import re
+import select
+import time
+from collections import deque
+from threading import Thread, Lock
+
+from .clock import VirtualClock
+from .framing import FrameError, TextCodec, command_text, decode_frame, encode_frame, event_payload
+
+_LEADING_INT = re.compile(r"\s*([+-]?\d+)")
+TIOCPKT_DATA = 0  # Packet mode status bytes on the pseudo-terminal master (see tty_ioctl(4))
+TIOCPKT_FLUSHREAD = 1  # The other end flushed its input, as pyserial does on open
+
+
+def to_int(text):
+    """Parse text the way Arduino's String.toInt() does: leading digits, else 0"""
+    match = _LEADING_INT.match(text)
+    return int(match.group(1)) if match else 0
+
+
+def parse_step(command):
+    """Returns (movement, motor seconds, LED seconds) for a step line, or None"""
+    index = command.find(" LED ")
+    if index == -1:
+        return None
+    for movement in ("FORWARD", "BACKWARD"):
+        if command.startswith(movement + " "):
+            return movement, to_int(command[len(movement) + 1:index]), to_int(command[index + 5:])
+    return None
+
+
+class Firmware:
+    """Model of the Arduino sketch, driven by an explicit millis() value
+
+    Mirrors arduino/serial_command/serial_command.ino, including the CONTINUE
+    button. Every method returns the lines the sketch would print.
+    """
+
+    MAX_PLAN_STEPS = 32
+    BAUD_RATES = (115200, 230400, 250000, 500000, 1000000)
+    BAUD_TIMEOUT = 1000  # ms to wait for PING at the new rate before falling back to text
+
+    def __init__(self):
+        self.direction = None
+        self.motor_running = False
+        self.led_on = False
+        self.start_millis = 0
+        self.led_start_millis = 0
+        self.duration = 0
+        self.led_duration = 0
+        self.plan = []  # Uploaded step table
+        self.plan_loading = 0
+        self.plan_step = -1
+        self.paused = False
+        self.held = (False, False)  # Whether the motor and LED were running at PAUSE
+        self.remaining = (0, 0)  # Motor and LED ms left at PAUSE
+        self.binary = False  # Speaking COBS/CRC16 frames instead of text lines
+        self.baud_millis = None  # When BAUD was accepted, until the first PING confirms it
+        self.telemetry_interval = 0  # ms between T samples, 0 for none
+        self.telemetry_millis = 0  # When the last sample was due
+        self.commands = []  # Every command line received, for inspection
+
+    def feed(self, line, now):
+        """Handle one command line received at millis() == now"""
+        command = line.strip()
+        self.commands.append(command)
+        step = parse_step(command)
+        if step is not None:
+            if self.plan_loading > 0:
+                self.plan.append(step)
+                self.plan_loading -= 1
+                return [f"PLANNED {len(self.plan)}"] if self.plan_loading == 0 else []
+            if self.plan_step >= 0:
+                return ["ERR BUSY"]
+            self.direction, motor_seconds, led_seconds = step
+            self.duration = motor_seconds * 1000
+            self.led_duration = led_seconds * 1000
+            self.paused = False
+            self.motor_running = self.led_on = True
+            self.start_millis = self.led_start_millis = now
+            return ["ACK"]
+        if command.startswith("PLAN "):
+            steps = to_int(command[5:])
+            if self.plan_step >= 0 or not 1 <= steps <= self.MAX_PLAN_STEPS:
+                return ["ERR PLAN"]
+            self.plan = []
+            self.plan_loading = steps
+            return [f"ACK PLAN {steps}"]
+        if command == "RUN":
+            if not self.plan or self.plan_loading > 0 or self.plan_step >= 0:
+                return ["ERR RUN"]
+            self.paused = False
+            self.start_millis = now
+            return ["ACK RUN"] + self._next_plan_step()
+        if command == "PAUSE":
+            if not self.paused:
+                self.held = (self.motor_running, self.led_on)
+                self.remaining = (
+                    max(self.start_millis + self.duration - now, 0) if self.motor_running else 0,
+                    max(self.led_start_millis + self.led_duration - now, 0) if self.led_on else 0,
+                )
+                self.motor_running = self.led_on = False
+                self.paused = True
+            return [f"PAUSED {self.remaining[0]} {self.remaining[1]}"]
+        if command == "RESUME":
+            if self.paused:
+                self.paused = False
+                self.motor_running, self.led_on = self.held
+                if self.motor_running:
+                    self.start_millis, self.duration = now, self.remaining[0]
+                if self.led_on:
+                    self.led_start_millis, self.led_duration = now, self.remaining[1]
+            return ["RESUMED"]
+        if command.startswith("BAUD ") and not self.binary:
+            baud = to_int(command[5:])
+            if baud not in self.BAUD_RATES:
+                return ["ERR"]
+            self.binary = True  # The ACK still goes out as text, then the sketch switches
+            self.baud_millis = now
+            return [f"ACK BAUD {baud}"]
+        if command.startswith("TELEMETRY "):
+            self.telemetry_interval = to_int(command[10:])
+            self.telemetry_millis = now
+            return [f"ACK TELEMETRY {self.telemetry_interval}"]
+        if command == "PING":
+            self.baud_millis = None
+            return ["PONG"]
+        if command in ("ABORT", "STOP"):
+            self.motor_running = self.led_on = False
+            self.plan_step = -1
+            self.plan_loading = 0
+            self.paused = False
+            return ["ABORTED"]
+        if command:
+            self.plan_loading = 0
+            return ["ERR"]
+        return []
+
+    def tick(self, now):
+        """Run the timer checks of loop() at millis() == now"""
+        out = []
+        if self.baud_millis is not None and now - self.baud_millis > self.BAUD_TIMEOUT:
+            self.binary = False  # The host never reached us at the new rate
+            self.baud_millis = None
+        while self.telemetry_interval and now - self.telemetry_millis >= self.telemetry_interval:
+            self.telemetry_millis += self.telemetry_interval
+            out.append(self.sample(self.telemetry_millis))
+        if self.motor_running and now - self.start_millis > self.duration:
+            if self.plan_step >= 0:
+                self.start_millis += self.duration
+                out += self._next_plan_step()
+            else:
+                self.motor_running = False
+                out.append("DONE MOTOR")
+        if self.led_on and now - self.led_start_millis > self.led_duration:
+            self.led_on = False
+            out.append("DONE LED")
+        return out
+
+    def next_deadline(self):
+        """Returns the millis() value at which tick() will next have something to do"""
+        deadlines = []
+        if self.baud_millis is not None:
+            deadlines.append(self.baud_millis + self.BAUD_TIMEOUT + 1)
+        if self.telemetry_interval:
+            deadlines.append(self.telemetry_millis + self.telemetry_interval)
+        if self.motor_running:
+            deadlines.append(self.start_millis + self.duration + 1)
+        if self.led_on:
+            deadlines.append(self.led_start_millis + self.led_duration + 1)
+        return min(deadlines) if deadlines else None
+
+    def sample(self, now):
+        """Returns the telemetry line the sketch would print at millis() == now"""
+        flags = (1 if self.motor_running else 0) | (2 if self.led_on else 0) | \
+            (4 if self.direction == "FORWARD" else 0) | (8 if self.paused else 0)
+        motor = 255 if self.motor_running else 0
+        led = 255 if self.led_on else 0
+        return f"T {now} {flags} {motor} {led} {self.plan_step}"
+
+    def press_button(self):
+        """The operator pressed the hardware button"""
+        return ["CONTINUE"]
+
+    def boot(self):
+        """Opening the port resets the Arduino: everything stops, and setup() prints its banner"""
+        commands = self.commands
+        self.__init__()
+        self.commands = commands  # Kept across resets, for inspection
+        return ["READY"]
+
+    def _next_plan_step(self):
+        self.plan_step += 1
+        if self.plan_step >= len(self.plan):
+            self.motor_running = False  # The LED runs out its own timer, as in the sketch
+            self.plan_step = -1
+            return ["PLAN DONE"]
+        self.direction, motor_seconds, led_seconds = self.plan[self.plan_step]
+        self.duration = motor_seconds * 1000
+        self.led_duration = led_seconds * 1000
+        self.motor_running = self.led_on = True
+        self.led_start_millis = self.start_millis
+        return [f"STEP {self.plan_step}"]
+
+
+class VirtualDesicurer:
+    """A Firmware model behind a pseudo-terminal, so unmodified serial code can open it
+
+    Device time runs scale times faster than wall time: at scale=1000 a 30 s step
+    takes 30 ms. POSIX only.
+    """
+
+    def __init__(self, scale=1, firmware=None, link=None):
+        self.scale = scale
+        self.firmware = firmware or Firmware()
+        self.link = link  # Optional extra name such as /dev/ttyACM9 so list_ports finds the device
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._wake = None
+        self._thread = None
+        self._running = False
+        self._lock = Lock()
+        self._t0 = None
+        self._packets = False  # Reads on the master carry a status byte
+
+    def millis(self):
+        """Returns the simulated Arduino millis() value"""
+        return int((time.monotonic() - self._t0) * 1000 * self.scale)
+
+    def start(self):
+        """Create the pseudo-terminal and start answering on it"""
+        import tty
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # Held open so the master never sees EOF between clients
+        self._packet_mode()
+        self.port = os.ttyname(self._slave)
+        if self.link:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.port, self.link)
+        self._wake = os.pipe()
+        self._t0 = time.monotonic()
+        self._running = True
+        self._thread = Thread(target=self._run, name="virtual-desicurer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop answering and remove the pseudo-terminal"""
+        if not self._running:
+            return
+        self._running = False
+        os.write(self._wake[1], b"x")
+        self._thread.join()
+        for fd in (self._master, self._slave) + self._wake:
+            os.close(fd)
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def press_button(self):
+        """Simulate the operator pressing the hardware button"""
+        with self._lock:
+            self._write(self.firmware.press_button())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _packet_mode(self):
+        """Have reads on the master report flushes, so a host opening the port resets the firmware"""
+        import fcntl
+        import struct
+        import termios
+        request = getattr(termios, "TIOCPKT", None)
+        if request is not None:
+            try:
+                fcntl.ioctl(self._master, request, struct.pack("i", 1))
+                self._packets = True
+            except OSError:
+                pass  # No banner then; hosts wait out their settle_time
+
+    def _write(self, lines, binary=None):
+        if binary is None:
+            binary = self.firmware.binary
+        for line in lines:
+            if binary:
+                os.write(self._master, encode_frame(event_payload(line)))
+            else:
+                os.write(self._master, (line + "\r\n").encode())
+
+    def _receive(self, buffer):
+        """Feed every complete command in buffer to the firmware"""
+        firmware = self.firmware
+        while True:
+            binary = firmware.binary
+            end = buffer.find(b"\x00" if binary else b"\n")
+            if end < 0:
+                return
+            data = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if not binary:
+                self._write(firmware.feed(data.decode("utf-8", "replace"), self.millis()), binary)
+            elif data:
+                try:
+                    payload = decode_frame(data)
+                except FrameError:
+                    self._write(["ERR CRC"], binary)
+                    continue
+                try:
+                    line = command_text(payload)
+                except FrameError:
+                    firmware.plan_loading = 0
+                    self._write(["ERR FRAME"], binary)
+                    continue
+                self._write(firmware.feed(line, self.millis()), binary)
+
+    def _run(self):
+        buffer = bytearray()
+        while self._running:
+            deadline = self.firmware.next_deadline()
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - self.millis(), 0) / 1000 / self.scale
+            readable, _, _ = select.select([self._master, self._wake[0]], [], [], timeout)
+            if self._wake[0] in readable:
+                os.read(self._wake[0], 64)
+            with self._lock:
+                if self._master in readable:
+                    data = os.read(self._master, 1025)
+                    if not self._packets:
+                        buffer += data
+                    elif data[0] == TIOCPKT_DATA:
+                        buffer += memoryview(data)[1:]
+                    elif data[0] & TIOCPKT_FLUSHREAD:
+                        del buffer[:]
+                        self._write(self.firmware.boot(), False)
+                    self._receive(buffer)
+                self._write(self.firmware.tick(self.millis()))
+
+
+class LoopbackTransport:
+    """In-process stand-in for SerialTransport talking straight to a Firmware model
+
+    Device millis() follow the given clock, so with a VirtualClock a whole protocol
+    runs in the time it takes to execute its Python.
+    """
+
+    def __init__(self, firmware=None, clock=None, port="loopback"):
+        self.port = port
+        self.firmware = firmware or Firmware()
+        self.clock = clock or VirtualClock()
+        self.acked = False
+        self.uploads = None
+        self.pauses = None
+        self.codec = TextCodec()  # The loopback always speaks text
+        self.is_open = False
+        self._listeners = []
+        self._subscribers = {}
+        self._lines = deque()
+        self._line_ready = None
+        self._timer = None
+
+    def millis(self):
+        return int(self.clock.monotonic() * 1000 + 1e-6)  # Guard against 29.999999 s reading as 29999 ms
+
+    async def connect(self):
+        self._line_ready = asyncio.Event()
+        self.is_open = True
+
+    async def send(self, command, kind=None):
+        if isinstance(command, bytes):
+            command = command.decode()
+        for line in command.splitlines() or [""]:
+            self._emit(self.firmware.feed(line, self.millis()))
+        self._schedule()
+
+    async def readline(self, timeout=None):
+        async def next_line():
+            while not self._lines:
+                self._line_ready.clear()
+                await self._line_ready.wait()
+            return self._lines.popleft()
+        try:
+            return await self.clock.wait_for(next_line(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def press_button(self):
+        self._emit(self.firmware.press_button())
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def subscribe(self, event, callback):
+        self._subscribers[event] = self._subscribers.get(event, []) + [callback]
+
+    def unsubscribe(self, event, callback):
+        callbacks = [c for c in self._subscribers.get(event, []) if c != callback]
+        if callbacks:
+            self._subscribers[event] = callbacks
+        else:
+            self._subscribers.pop(event, None)
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.is_open = False
+
+    def _emit(self, lines):
+        for line in lines:
+            callbacks = self._subscribers.get(line.partition(" ")[0])
+            if callbacks:
+                for callback in callbacks:
+                    callback(line)
+            elif not any(listener(line) for listener in tuple(self._listeners)):
+                self._lines.append(line)
+                self._line_ready.set()
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        deadline = self.firmware.next_deadline()
+        if deadline is not None:
+            self._timer = self.clock.call_at(deadline / 1000, self._tick)
+
+    def _tick(self):
+        self._timer = None
+        self._emit(self.firmware.tick(self.millis()))
+        self._schedule()
+
+
+async def simulate(steps, runs=1, clock_factory=VirtualClock):
+    """Run steps against simulated devices on virtual time; returns the finished ProtocolRuns
+
+    Each run gets its own clock and firmware, so thousands of runs finish in seconds
+    and their records show the timeline each one would have had.
+    """
+    from .runner import ProtocolRun  # Imported here to keep the simulator free of host-side imports
+
+    async def one():
+        clock = clock_factory()
+        transport = LoopbackTransport(clock=clock)
+        await transport.connect()
+        run = ProtocolRun(transport, steps, clock=clock)
+        await run.run()
+        await transport.close()
+        return run
+
+    return await asyncio.gather(*(one() for _ in range(runs)))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a virtual desicurer on a pseudo-terminal")
+    parser.add_argument("--scale", type=float, default=1, help="device time speed-up, e.g. 1000")
+    parser.add_argument("--link", help="also expose the device under this path, e.g. /dev/ttyACM9")
+    args = parser.parse_args()
+    with VirtualDesicurer(args.scale, link=args.link) as device:
+        print(f"Virtual desicurer on {device.port}" + (f" ({args.link})" if args.link else ""))
+        print(f"export DESICURER_PORTS={device.port}")
+        print("Press Enter to press the button, Ctrl-C to quit.")
+        try:
+            while True:
+                input()
+                device.press_button()
+        except (KeyboardInterrupt, EOFError):
+            pass
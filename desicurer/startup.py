@@ -0,0 +1,94 @@
+import json
+import os
+import sys
+import time
+
+PROFILE_ENV = "DESICURER_STARTUP_PROFILE"  # "1" or a file path to save the startup profile to
+
+
+def process_start_time(pid=None):
+    """Returns the wall-clock time a process was created, or None where that is unknown"""
+    pid = pid or os.getpid()
+    try:
+        if sys.platform.startswith("linux"):
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()  # The command name may contain spaces
+            with open("/proc/uptime") as f:
+                uptime = float(f.read().split()[0])  # Finer than the whole seconds of btime
+            return time.time() - (uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+        if sys.platform == "win32":
+            import ctypes
+            from ctypes import wintypes
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+            if not handle:
+                return None
+            times = [wintypes.FILETIME() for _ in range(4)]
+            ok = kernel32.GetProcessTimes(handle, *(ctypes.byref(t) for t in times))
+            kernel32.CloseHandle(handle)
+            if not ok:
+                return None
+            created = times[0].dwHighDateTime << 32 | times[0].dwLowDateTime
+            return created / 1e7 - 11644473600  # FILETIME counts 100 ns from 1601
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    return None
+
+
+class StartupProfile:
+    """Wall time spent in each phase of application start
+
+    The first phase runs from process creation to the import of this module. In a
+    one-file PyInstaller build the bootloader's parent process does the unpacking,
+    so that phase is measured from the parent's creation and covers the unpack.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # (name, seconds) in order
+        self._last = self.started
+        self._finished = False
+        onefile = getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS") and os.getppid() > 1
+        launched = process_start_time(os.getppid() if onefile else None)
+        if launched is not None:
+            self.phases.append(("unpack" if onefile else "interpreter start", max(time.time() - launched, 0)))
+
+    def mark(self, phase):
+        """End the current phase and name it"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self):
+        """Returns the profile as text, one phase per line"""
+        lines = [f"{name:<20}{seconds * 1000:8.1f} ms" for name, seconds in self.phases]
+        lines.append(f"{'total':<20}{self.total * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+    def finish(self, path=None):
+        """Save the profile once, if asked to with $DESICURER_STARTUP_PROFILE or path"""
+        if self._finished:
+            return
+        self._finished = True
+        path = path or os.environ.get(PROFILE_ENV)
+        if not path:
+            return
+        if path == "1":
+            path = os.path.join(os.path.expanduser("~"), ".desicurer", "startup.json")
+        record = {"time": time.time(), "frozen": bool(getattr(sys, "frozen", False)),
+                  "phases": dict(self.phases), "total": self.total}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(record, f, indent=2)
+        except OSError:
+            pass
+        if sys.stdout is not None:  # None in a windowed exe
+            print(self.report())
+
+
+PROFILE = StartupProfile()  # Started by the first import, which should be the first thing the app does
@@ -0,0 +1,121 @@
+from threading import Lock
+
+# Flag bits of a telemetry sample
+FLAG_MOTOR = 1
+FLAG_LED = 2
+FLAG_FORWARD = 4
+FLAG_PAUSED = 8
+
+DEFAULT_CAPACITY = 1 << 16  # Samples kept; at 10 Hz about 1.8 hours
+TELEMETRY_TIMEOUT = 0.5  # Wall time the firmware gets to acknowledge TELEMETRY
+
+
+def parse_sample(line):
+    """Returns (millis, flags, motor PWM, LED PWM, plan step) for a T line"""
+    millis, flags, motor, led, step = (int(word) for word in line.split()[1:6])
+    return millis, flags, motor, led, step
+
+
+class TelemetryBuffer:
+    """Fixed-size ring buffer of device state samples, backed by a NumPy structured array
+
+    Memory is allocated once; when full, the oldest samples are overwritten.
+    append() is cheap enough to call for every line on the transport's reader,
+    and readers get copies, so drawing never holds up ingestion.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        import numpy as np  # Deferred: only telemetry needs NumPy
+        self._np = np
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=[
+            ("time", "f8"),  # Host clock when the sample arrived
+            ("millis", "u4"),  # Device millis() when it was taken
+            ("flags", "u1"),
+            ("motor", "u1"),
+            ("led", "u1"),
+            ("step", "i1"),
+        ])
+        self.count = 0  # Samples ever appended
+        self._lock = Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time, millis, flags, motor, led, step):
+        with self._lock:
+            self.data[self.count % self.capacity] = (time, millis, flags, motor, led, step)
+            self.count += 1
+
+    def clear(self):
+        with self._lock:
+            self.count = 0
+
+    def latest(self):
+        """Returns the newest sample as a record, or None"""
+        with self._lock:
+            if not self.count:
+                return None
+            return self.data[(self.count - 1) % self.capacity].copy()
+
+    def samples(self):
+        """Returns every sample held, oldest first, as a new array"""
+        with self._lock:
+            if self.count <= self.capacity:
+                return self.data[:self.count].copy()
+            start = self.count % self.capacity
+            return self._np.concatenate((self.data[start:], self.data[:start]))
+
+    def decimated(self, points):
+        """Returns (time, motor, LED) arrays of at most points entries for drawing
+
+        Each output point is the maximum over its bucket of samples, so a motor or
+        LED pulse shorter than a bucket still shows up.
+        """
+        np = self._np
+        samples = self.samples()
+        if len(samples) <= points:
+            return samples["time"], samples["motor"], samples["led"]
+        size = len(samples) // points
+        whole = samples[len(samples) - size * points:]  # Drop the oldest partial bucket
+        time = whole["time"][::size]
+        motor = whole["motor"].reshape(points, size).max(axis=1)
+        led = whole["led"].reshape(points, size).max(axis=1)
+        return time, np.asarray(motor), np.asarray(led)
+
+
+class TelemetryStream:
+    """Feeds a transport's T lines into a TelemetryBuffer
+
+    The subscriber runs wherever the transport reads (its event loop or reader
+    thread), so samples are stored as they arrive and never reach readline().
+    """
+
+    def __init__(self, transport, buffer=None, clock=None):
+        self.transport = transport
+        self.buffer = buffer if buffer is not None else TelemetryBuffer()
+        self.clock = clock or transport.clock
+        self.interval = 0
+
+    async def start(self, interval):
+        """Ask the firmware for a sample every interval ms; returns False if it does not support telemetry"""
+        self.transport.subscribe("T", self._on_line)
+        await self.transport.send(f"TELEMETRY {interval}")
+        if await self.transport.expect(f"ACK TELEMETRY {interval}", TELEMETRY_TIMEOUT) is None:
+            self.transport.unsubscribe("T", self._on_line)
+            return False
+        self.interval = interval
+        return True
+
+    async def stop(self):
+        self.transport.unsubscribe("T", self._on_line)
+        if self.interval and self.transport.is_open:
+            self.interval = 0
+            await self.transport.send("TELEMETRY 0")
+
+    def _on_line(self, line):
+        try:
+            sample = parse_sample(line)
+        except ValueError:
+            return  # A damaged sample is dropped
+        self.buffer.append(self.clock.monotonic(), *sample)
@@ -0,0 +1,313 @@
+import asyncio
+import os
+import time
+from threading import Thread
+
+from .backends import open_port
+from .capture import CAPTURE_ENV, TrafficRecorder
+from .clock import REAL_CLOCK
+from .framing import BinaryCodec, TextCodec
+from .metrics import METRICS
+
+LINE_QUEUE_SIZE = 256  # Oldest unread lines are dropped past this
+RX_BUFFER_SIZE = 4096  # Receive buffer; a line that fills it without ending is noise and is dropped
+NEGOTIATE_TIMEOUT = 0.5  # Wall time the firmware gets to answer BAUD and PING
+FALLBACK_TIME = 1.1  # The firmware drops back to 9600 baud text if no PING follows BAUD within 1 s
+
+
+class SerialTransport:
+    """Asyncio wrapper around a pyserial port speaking the line-based Arduino protocol
+
+    On POSIX the port's file descriptor is registered with the event loop, so an idle
+    connection costs no thread and no CPU. Where the loop cannot watch the port
+    (Windows) a single blocking reader thread feeds the loop instead.
+
+    With binary_baud set, connect() asks the firmware to switch to COBS/CRC16
+    frames at that baud rate and stays on the text protocol if it does not answer.
+    Callers keep sending and receiving text lines either way.
+
+    port may be any name open_port() accepts. Plain port names go through the
+    local broker while one is running, unless brokered is false.
+
+    With $DESICURER_CAPTURE set, every connection records its traffic into a
+    capture file in that directory; see desicurer.replay.
+    """
+
+    def __init__(self, port, baudrate=9600, settle_time=2, write_timeout=1, clock=None, binary_baud=None,
+                 brokered=True):
+        self.port = port
+        self.brokered = brokered
+        self.clock = clock or REAL_CLOCK
+        self.baudrate = baudrate
+        self.binary_baud = binary_baud
+        self.codec = TextCodec()
+        self.settle_time = settle_time  # Longest the Arduino may take to reset after the port opens
+        self.write_timeout = write_timeout
+        self.ser = None
+        self._loop = None
+        self._lines = None
+        self._error = None
+        self._reader_fd = None
+        self._reader_thread = None
+        self._listeners = []
+        self._subscribers = {}  # First word of a line -> callbacks, e.g. "CONTINUE"
+        self._rx = bytearray(RX_BUFFER_SIZE)  # Reused for every read
+        self._rx_length = 0  # Bytes of a partial line at the start of _rx
+        self.overflows = 0  # Lines dropped for not fitting in the receive buffer
+        self.acked = False  # Set once the firmware has acknowledged a command
+        self.uploads = None  # Whether the firmware accepts uploaded plans, once known
+        self.pauses = None  # Whether the firmware can freeze a step with PAUSE, once known
+        self.ready = False  # Set when the firmware announced itself with READY
+        self.written = None  # perf_counter() of the last write, while metrics are enabled
+        self.recorder = None  # TrafficRecorder while the connection is being captured
+
+    @property
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    async def connect(self):
+        """Open the port and wait for the Arduino to come out of reset
+
+        Firmware that prints READY at the end of setup() is ready as soon as that
+        line arrives; older firmware gets the full settle_time.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._lines = asyncio.Queue(LINE_QUEUE_SIZE)
+        self.codec = TextCodec()
+        self._error = None
+        self.acked = False
+        self.uploads = None  # The firmware may have changed since the last connection
+        self.pauses = None
+        self.ready = False
+        self.ser = await self._open_port()
+        self._start_capture()
+        self._start_reader()
+        if self.settle_time:
+            await self._wait_ready(self.settle_time)
+        if self.binary_baud:
+            await self.negotiate(self.binary_baud)
+
+    async def _open_port(self):
+        return await self._loop.run_in_executor(
+            None, lambda: open_port(self.port, self.baudrate, self.brokered, timeout=0, write_timeout=self.write_timeout))
+
+    def _start_capture(self):
+        directory = os.environ.get(CAPTURE_ENV)
+        if directory:
+            self.recorder = TrafficRecorder.create(directory, self.port, self.clock, baudrate=self.baudrate,
+                                                   binary_baud=self.binary_baud, settle_time=self.settle_time)
+
+    def _note(self, event, **fields):
+        if self.recorder is not None:
+            self.recorder.note(event, **fields)
+
+    async def _wait_ready(self, timeout):
+        deadline = self.clock.monotonic() + timeout
+        while not self.ready:
+            line = await self.readline(max(deadline - self.clock.monotonic(), 0))
+            if line is None:
+                return  # No banner: the reset is over by now anyway
+            self.ready = line == "READY"  # Anything before it is boot noise
+
+    async def negotiate(self, baudrate):
+        """Switch the link to binary frames at baudrate; returns False if the firmware stays on text"""
+        await self.send(f"BAUD {baudrate}")
+        if await self.expect(f"ACK BAUD {baudrate}") is None:
+            return False
+        self.ser.baudrate = baudrate
+        self.codec = BinaryCodec()
+        self._rx_length = 0  # Whatever arrived at the old rate is no use to the new codec
+        self._note("codec", codec=self.codec.name, baudrate=baudrate)
+        await self.send("PING")
+        if await self.expect("PONG") is not None:
+            self.baudrate = baudrate
+            return True
+        # No answer at the new rate: go back and wait for the firmware to give up too
+        self.ser.baudrate = self.baudrate
+        self.codec = TextCodec()
+        self._rx_length = 0
+        self._note("codec", codec=self.codec.name, baudrate=self.baudrate)
+        await self.clock.asleep(self.clock.from_real(FALLBACK_TIME))
+        return False
+
+    async def expect(self, wanted, timeout=NEGOTIATE_TIMEOUT):
+        """Returns wanted once it arrives, or None on ERR or after timeout (wall time); skips other lines"""
+        deadline = self.clock.monotonic() + self.clock.from_real(timeout)
+        while True:
+            line = await self.readline(max(deadline - self.clock.monotonic(), 0))
+            if line is None or line == wanted:
+                return line
+            if line.startswith("ERR"):
+                return None  # Firmware without this command
+
+    async def send(self, command, kind=None):
+        """Write one command (a text line, or bytes already in the link's codec) to the device
+
+        kind names the command in the metrics; a text line defaults to its first word.
+        """
+        if not self.is_open:
+            raise ConnectionError(f"{self.port} is not open")
+        created = time.perf_counter() if METRICS.enabled else None
+        if isinstance(command, str):
+            kind = kind or command.split(" ", 1)[0]
+            command = self.codec.encode(command)
+        if created is None:
+            self.ser.write(command)  # A command fits in the OS buffer, so this returns at once
+        else:
+            encoded = time.perf_counter()
+            self.ser.write(command)
+            self.written = METRICS.sent(self.port, kind or "FRAME", created, encoded)
+        if self.recorder is not None:
+            self.recorder.sent(command)
+
+    async def abort(self):
+        """Send ABORT ahead of anything still waiting in the output buffer, which is thrown away"""
+        if not self.is_open:
+            raise ConnectionError(f"{self.port} is not open")
+        command = self.codec.encode("ABORT")
+        try:
+            if self.ser.out_waiting:
+                self.ser.reset_output_buffer()
+                command = self.codec.delimiter + command  # Ends whatever was cut off mid-command
+        except (AttributeError, NotImplementedError, OSError):
+            pass  # Network ports have no output buffer to skip
+        await self.send(command, "ABORT")
+
+    async def readline(self, timeout=None):
+        """Returns the next line from the device, or None if nothing arrives within timeout"""
+        if self._error is not None and self._lines.empty():
+            raise self._error
+        try:
+            line = await self.clock.wait_for(self._lines.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if line is None:  # Reader failed while we were waiting
+            raise self._error
+        return line
+
+    def add_listener(self, listener):
+        """Offer every incoming line to listener first; lines it returns True for are not queued"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def subscribe(self, event, callback):
+        """Call callback(line) for every line whose first word is event, instead of queueing it
+
+        Callbacks run wherever the transport reads (its event loop or reader thread)
+        and must return quickly. Safe to call from any thread.
+        """
+        self._subscribers[event] = self._subscribers.get(event, []) + [callback]  # Never mutated while dispatching
+
+    def unsubscribe(self, event, callback):
+        callbacks = [c for c in self._subscribers.get(event, []) if c != callback]
+        if callbacks:
+            self._subscribers[event] = callbacks
+        else:
+            self._subscribers.pop(event, None)
+
+    async def close(self):
+        """Stop reading and close the port"""
+        self._stop_reader()
+        if self.ser is not None:
+            ser, self.ser = self.ser, None
+            ser.close()
+        if self._reader_thread is not None:
+            await self._loop.run_in_executor(None, self._reader_thread.join, 1)
+            self._reader_thread = None
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            await self._loop.run_in_executor(None, recorder.close)
+        self._listeners = []
+        self._subscribers = {}
+        self._rx_length = 0
+        self.acked = False  # Set once the firmware has acknowledged a command
+        self.uploads = None  # Whether the firmware accepts uploaded plans, once known
+        self.pauses = None  # Whether the firmware can freeze a step with PAUSE, once known
+
+    # -- Reading --
+
+    def _start_reader(self):
+        try:
+            fd = self.ser.fileno()
+            self._loop.add_reader(fd, self._on_readable)
+            self._reader_fd = fd
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            self.ser.timeout = 0.5  # The reader thread blocks in read() for at most this long
+            self._reader_thread = Thread(target=self._read_blocking, name=f"reader-{self.port}", daemon=True)
+            self._reader_thread.start()
+
+    def _stop_reader(self):
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+    def _on_readable(self):
+        """Read everything waiting straight into the receive buffer"""
+        try:
+            with memoryview(self._rx) as view:
+                count = os.readv(self._reader_fd, [view[self._rx_length:]])
+            if not count:
+                raise ConnectionError(f"{self.port} was disconnected")
+        except OSError as e:
+            self._stop_reader()
+            self._fail(e)
+            return
+        self._received(count)
+
+    def _read_blocking(self):
+        import serial
+        ser = self.ser
+        while ser.is_open:
+            try:
+                data = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError) as e:
+                if ser.is_open:
+                    self._loop.call_soon_threadsafe(self._fail, e)
+                return
+            if data:
+                self._loop.call_soon_threadsafe(self._feed, data)
+
+    def _feed(self, data):
+        """Take bytes read elsewhere, e.g. by the reader thread"""
+        data = memoryview(data)
+        while data:
+            count = min(len(data), len(self._rx) - self._rx_length)
+            self._rx[self._rx_length:self._rx_length + count] = data[:count]
+            data = data[count:]
+            self._received(count)
+
+    def _received(self, count):
+        """Dispatch the lines completed by count new bytes at the end of the receive buffer"""
+        length = self._rx_length + count
+        if self.recorder is not None:
+            self.recorder.received(self._rx[self._rx_length:length])
+        lines, consumed = self.codec.split(self._rx, length)
+        if consumed:
+            self._rx[:length - consumed] = self._rx[consumed:length]  # Only a partial line is left to move
+            length -= consumed
+        if length == len(self._rx):
+            length = 0  # Full without a line end: noise, not a line
+            self.overflows += 1
+        self._rx_length = length
+        for line in lines:
+            self._dispatch(line)
+
+    def _dispatch(self, line):
+        callbacks = self._subscribers.get(line.partition(" ")[0])
+        if callbacks:
+            for callback in callbacks:
+                callback(line)
+        elif not any(listener(line) for listener in tuple(self._listeners)):
+            self._put(line)
+
+    def _put(self, line):
+        if self._lines.full():
+            self._lines.get_nowait()  # Drop the oldest line rather than grow without bound
+        self._lines.put_nowait(line)
+
+    def _fail(self, error):
+        self._error = error
+        self._put(None)
@@ -14,17 +14,18 @@ def send_command(movement, motor_duration, led_duration):
 one_minute = 6
 two_minute = 12 
 
-def main_loop():
+def main_loop(clock=time):
+    """Run cycles until the device sends STOP; clock is anything with sleep(), e.g. desicurer.clock.ScaledClock"""
     while True:
         print("Press Button Twice to Start")
         while ser.readline().decode('utf-8').strip() != 'CONTINUE':
             pass  # Wait for button press signal from Arduino
         
         send_command("FORWARD", two_minute, 0)
-        time.sleep(two_minute + 1)
+        clock.sleep(two_minute + 1)
         
         send_command("FORWARD", one_minute, one_minute)
-        time.sleep(one_minute + 1)
+        clock.sleep(one_minute + 1)
         
         print("Rotate Device")
         print("Press Button for Next Step")
@@ -32,10 +33,10 @@ def main_loop():
             pass  # Wait for button press signal from Arduino
 
         send_command("FORWARD", one_minute, one_minute)
-        time.sleep(one_minute + 1)
+        clock.sleep(one_minute + 1)
         
         send_command("FORWARD", two_minute, 0)
-        time.sleep(two_minute + 1)
+        clock.sleep(two_minute + 1)
 
         print("Cycle Complete")
         if ser.readline().decode('utf-8').strip() == 'STOP':
@@ -8,8 +8,8 @@ int buttonPin = 2;  // Button connected to pin D2
 
 unsigned long startMillis;
 unsigned long ledStartMillis;
-int duration;
-int ledDuration;
+unsigned long duration;
+unsigned long ledDuration;
 bool motorRunning = false;
 bool ledOn = false;
 
@@ -28,17 +28,25 @@ void loop() {
     command.trim();
 
     int index = command.indexOf(" LED ");
-    if (index == -1) return;  // Return if format is incorrect
+    if (index == -1) {
+      Serial.println("ERR");  // Tell the host the format is incorrect
+      return;
+    }
 
     if (command.startsWith("FORWARD ")) {
-      duration = command.substring(8, index).toInt() * 1000;
+      duration = command.substring(8, index).toInt() * 1000UL;
+      Serial.println("ACK");  // Tell the host the command was accepted
       startMotor(HIGH);
     } else if (command.startsWith("BACKWARD ")) {
-      duration = command.substring(9, index).toInt() * 1000;
+      duration = command.substring(9, index).toInt() * 1000UL;
+      Serial.println("ACK");
       startMotor(LOW);
+    } else {
+      Serial.println("ERR");
+      return;
     }
 
-    ledDuration = command.substring(index + 5).toInt() * 1000;
+    ledDuration = command.substring(index + 5).toInt() * 1000UL;
     startLED();
     soundBuzzer(500); // Sound buzzer for 500 ms
   }
@@ -46,11 +54,13 @@ void loop() {
   // Check to stop motor after duration
   if (motorRunning && millis() - startMillis > duration) {
     stopMotor();
+    Serial.println("DONE MOTOR");  // Motor timer expired
   }
 
   // Check to turn off LED after duration
   if (ledOn && millis() - ledStartMillis > ledDuration) {
     stopLED();
+    Serial.println("DONE LED");  // LED timer expired
   }
 
   // Check if button is pressed (assuming active low)